@@ -19,6 +19,8 @@ from dateutil import parser as dateparser
 from bson import ObjectId
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from text_signals import threat_sentences
+
 # Optional content extraction
 try:
     from readability import Document
@@ -106,12 +108,7 @@ def threat_points_for_pro(text: str):
     if not text: return ""
     body = re.sub(r"<[^>]+>", " ", text)
     body = re.sub(r"\s+", " ", body)
-    sentences = re.split(r"(?<=[。.!?])\s+", body)
-    SIGNALS = ("critical", "remote execution", "RCE", "exploit", "zero-day",
-               "in the wild", "privilege escalation", "bypass", "vulnerability", "attack")
-    picked = [s for s in sentences if any(k.lower() in s.lower() for k in SIGNALS)]
-    if not picked and sentences: picked = sentences[:2]
-    return " ".join(picked[:2])
+    return " ".join(threat_sentences(body, limit=2))
 
 def extract_main_content(html: str):
     title = ""; text = ""
@@ -346,7 +343,16 @@ def feed():
                 if until: rng["$lte"] = until
                 branch["timestamp"] = rng
 
-            filt = branch
+            # 近重复条目只在其规范条目本身也会出现在结果中时隐藏（见 task_fetch 的 MinHash 近重复聚类；
+            # 规范条目与重复条目的 allowed_roles 相同）。无 q/since/until 时只需规范条目的来源在本次查询中；
+            # 否则先查出被命中的重复条目所指向、且自身也命中同一过滤条件的规范条目
+            if q or since or until:
+                cand = coll.distinct("dup_of", {**branch, "dup_source": {"$in": allowed_sources}})
+                shown = coll.distinct("source_id", {**branch, "source_id": {"$in": cand}}) if cand else []
+                collapse = {"$or": [{"dup_of": None}, {"dup_of": {"$nin": shown}}]}
+            else:
+                collapse = {"$or": [{"dup_of": None}, {"dup_source": {"$nin": allowed_sources}}]}
+            filt = {"$and": [branch, collapse]}
             total = coll.count_documents(filt)
             items = list(
                 coll.find(
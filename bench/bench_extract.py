@@ -0,0 +1,208 @@
+# bench/bench_extract.py
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark: single-parse lxml extraction (task_fetch.HtmlPage) vs the previous
+readability + BeautifulSoup(html.parser) path, on saved MSRC / Krebs pages.
+
+    python bench/bench_extract.py [PAGES_DIR] [--pages 20] [--rounds 3]
+
+PAGES_DIR holds saved article pages named msrc_*.html / krebs_*.html. Without it,
+a deterministic synthetic set is generated (--pages of each kind): MSRC / Krebs
+page skeletons with navigation, sidebar, script and style noise around the body.
+Importing task_fetch opens a (lazy) Mongo client; point MONGODB_URI at a local or
+unreachable host with a short serverSelectionTimeoutMS when running offline.
+"""
+import argparse
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import task_fetch as tf  # noqa: E402
+from task_fetch import clean_text, _brand_tail_cut, _strip_noise, _is_human_line, _first_good_sentences  # noqa: E402
+
+
+# ---- previous implementation (kept verbatim for comparison) ----
+def legacy_extract_main_content(html_doc: str) -> tuple[str, str]:
+    title, text = "", ""
+    try:
+        from readability import Document as _Doc  # type: ignore
+        from bs4 import BeautifulSoup as _BS     # type: ignore
+
+        doc = _Doc(html_doc)
+        title = clean_text(doc.short_title() or "")
+        summary_html = doc.summary(html_partial=True)
+        soup = _BS(summary_html, "html.parser")
+
+        for tag in soup(["script", "style", "noscript", "template"]):
+            tag.decompose()
+
+        containers = []
+        for sel in [
+            "article", "main", ".entry-content", ".post-content",
+            ".article-content", ".content", "#content", ".post-body",
+            ".blog-post-content"
+        ]:
+            containers.extend(soup.select(sel))
+
+        lines = []
+        def push_lines(node):
+            for p in node.select("p, li"):
+                t = clean_text(p.get_text(" "))
+                t = _brand_tail_cut(_strip_noise(t))
+                if _is_human_line(t):
+                    lines.append(t)
+
+        for c in containers:
+            push_lines(c)
+
+        if not lines:
+            all_text = clean_text(soup.get_text(" "))
+            all_text = _brand_tail_cut(_strip_noise(all_text))
+            primer = _first_good_sentences(all_text, max_sents=6)
+            lines = [primer] if primer else []
+
+        text = _strip_noise(" ".join(lines))
+
+        if not title:
+            soup2 = _BS(html_doc, "html.parser")
+            t = soup2.find("title")
+            if t:
+                title = clean_text(t.get_text())
+        title = _brand_tail_cut(title)
+    except Exception:
+        title = ""
+        text = clean_text(re.sub("<[^>]+>", " ", html_doc))
+        text = _brand_tail_cut(_strip_noise(text))
+    return title, text
+
+def legacy_extract_msrc_body(html_doc: str) -> str:
+    from bs4 import BeautifulSoup as _BS  # type: ignore
+    soup = _BS(html_doc, "html.parser")
+    box = soup.select_one("div.blog-post-content")
+    paras = []
+    if box:
+        for p in box.select("p"):
+            t = _brand_tail_cut(_strip_noise(clean_text(p.get_text(" "))))
+            if _is_human_line(t):
+                paras.append(t)
+    raw = " ".join(paras[:3]).strip()
+    return raw or legacy_extract_main_content(html_doc)[1]
+
+def legacy_extract_krebs_body(html_doc: str) -> str:
+    from bs4 import BeautifulSoup as _BS  # type: ignore
+    soup = _BS(html_doc, "html.parser")
+    container = soup.select_one("#content.site-content article") or \
+                soup.select_one("#primary.site-content article")
+    ban_substr = ("wpemojiSettings", "s.w.org/images/core/emoji", "SVGAnimated")
+    paras = []
+    if container:
+        for p in container.select("p"):
+            t = clean_text(p.get_text(" "))
+            if any(b in t for b in ban_substr):
+                continue
+            t = _strip_noise(t)
+            if _is_human_line(t):
+                paras.append(t)
+    raw = " ".join(paras[:3]).strip()
+    return raw or legacy_extract_main_content(html_doc)[1]
+
+
+# ---- synthetic pages (used when no PAGES_DIR is given) ----
+_WORDS = ("exploit vulnerability patch attacker remote code execution windows kernel privilege escalation "
+          "analysts customers update security advisory ransomware phishing credentials bank fraud police "
+          "arrested").split()
+
+def _para(rng: random.Random, n: int = 60) -> str:
+    return (" ".join(rng.choice(_WORDS) for _ in range(n)).capitalize() + ". "
+            + " ".join(rng.choice(_WORDS) for _ in range(30)) + ".")
+
+def _nav() -> str:
+    return "<nav><ul>" + "".join(f"<li><a href='/x{i}'>Menu item {i}</a></li>" for i in range(40)) + "</ul></nav>"
+
+def _krebs_page(rng: random.Random, i: int) -> str:
+    ps = "".join(f"<p>{_para(rng)}</p>" for _ in range(14))
+    side = "".join(f"<p>Sidebar {k} search cookie</p>" for k in range(10))
+    return (f"<!DOCTYPE html><html><head><title>Story {i} &#8211; Krebs on Security</title>"
+            "<script>window._wpemojiSettings = {\"baseUrl\":\"https://s.w.org/images/core/emoji\"};</script>"
+            "<style>body{}</style></head>"
+            f"<body>{_nav()}<div id=\"content\" class=\"site-content\"><div id=\"primary\"><main>"
+            f"<article id=\"post-{i}\"><header><h1 class=\"entry-title\">Story {i}</h1></header>"
+            f"<div class=\"entry-content\">{ps}</div></article></main></div>"
+            f"<aside>{side}</aside></div><footer>{_nav()}</footer>{'<script>var a=1;</script>' * 20}</body></html>")
+
+_LINKS = "<link rel='stylesheet' href='/a.css'>" * 20
+
+def _msrc_page(rng: random.Random, i: int) -> str:
+    ps = "".join(f"<p>{_para(rng)}</p>" for _ in range(10))
+    return (f"<!DOCTYPE html><html lang=\"en\"><head><title>Advisory {i} | MSRC Blog | "
+            f"Microsoft Security Response Center</title>{_LINKS}</head>"
+            f"<body>{_nav()}<main><div class=\"container\"><div class=\"blog-post\"><h1>Advisory {i}</h1>"
+            f"<div class=\"blog-post-content\">{ps}<ul><li>{_para(rng, 20)}</li></ul></div></div></div></main>"
+            f"<footer>{_nav()}</footer>{'<script>function(){}</script>' * 30}</body></html>")
+
+def synthetic_pages(n: int, seed: int = 1) -> list[tuple[str, str]]:
+    rng = random.Random(seed)
+    pages = []
+    for i in range(n):
+        pages.append(("krebs", _krebs_page(rng, i)))
+        pages.append(("msrc", _msrc_page(rng, i)))
+    return pages
+
+def _crawl_legacy(kind: str, html_doc: str):
+    # 旧爬虫路径：站点特化正文
+    if kind == "msrc":
+        return legacy_extract_msrc_body(html_doc)
+    return legacy_extract_krebs_body(html_doc)
+
+def _crawl_new(kind: str, html_doc: str):
+    if kind == "msrc":
+        return tf.extract_msrc_body(html_doc)
+    return tf.extract_krebs_body(html_doc)
+
+def _generic_legacy(_kind, html_doc):
+    return legacy_extract_main_content(html_doc)
+
+def _generic_new(_kind, html_doc):
+    return tf.extract_main_content(html_doc)
+
+def _bench(fn, pages, rounds: int) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        for kind, html_doc in pages:
+            fn(kind, html_doc)
+        best = min(best, time.perf_counter() - t0)
+    return len(pages) / best
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("pages_dir", nargs="?")
+    ap.add_argument("--pages", type=int, default=20, help="synthetic pages of each kind (without PAGES_DIR)")
+    ap.add_argument("--rounds", type=int, default=3)
+    args = ap.parse_args(argv)
+
+    if args.pages_dir:
+        pages = []
+        for f in sorted(Path(args.pages_dir).glob("*.html")):
+            kind = "msrc" if f.name.startswith("msrc") else "krebs"
+            pages.append((kind, f.read_text(encoding="utf-8", errors="replace")))
+        if not pages:
+            sys.exit(f"no *.html pages in {args.pages_dir}")
+    else:
+        pages = synthetic_pages(args.pages)
+
+    same_body = sum(_crawl_legacy(k, h) == _crawl_new(k, h) for k, h in pages)
+    same_generic = sum(_generic_legacy(k, h) == _generic_new(k, h) for k, h in pages)
+    print(f"pages={len(pages)} identical output: site body {same_body}/{len(pages)}, "
+          f"generic {same_generic}/{len(pages)}")
+    for label, old, new in (("site body", _crawl_legacy, _crawl_new),
+                            ("generic (readability)", _generic_legacy, _generic_new)):
+        a, b = _bench(old, pages, args.rounds), _bench(new, pages, args.rounds)
+        print(f"{label:24s} legacy {a:8.1f} pages/s   lxml {b:8.1f} pages/s   x{b / a:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# bench/bench_reco_setup.py
+# -*- coding: utf-8 -*-
+"""
+Per-run setup time of the CyBOK recommender: the previous subprocess-per-task path
+(every run re-imports torch / sentence-transformers, loads the model and the FAISS
+index) vs the in-process holder used by the worker (cold once per worker process,
+then only the GridFS version check).
+
+    python bench/bench_reco_setup.py [--runs 5]
+
+Needs the real environment: MONGODB_URI with the CyBOK index in GridFS and the
+embedding model available locally (or downloadable). Only setup is timed; the
+recommendation pass itself is the same on both paths.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+# 旧路径：每次任务都 `python task_cybok_reco_gridfs.py`，setup = 解释器启动 + import + 模型 + 索引
+_SUBPROCESS_SETUP = "import task_cybok_reco_gridfs as r; r.warm()"
+
+
+def _subprocess_setup() -> float:
+    t0 = time.monotonic()
+    subprocess.run([sys.executable, "-c", _SUBPROCESS_SETUP], cwd=ROOT, check=True,
+                   env={**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [str(ROOT), os.getenv("PYTHONPATH")]))})
+    return time.monotonic() - t0
+
+
+def _fmt(xs: list[float]) -> str:
+    return f"median {statistics.median(xs):7.3f}s  min {min(xs):7.3f}s  max {max(xs):7.3f}s"
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--runs", type=int, default=5)
+    args = ap.parse_args(argv)
+
+    old = [_subprocess_setup() for _ in range(args.runs)]
+
+    t0 = time.monotonic()
+    import task_cybok_reco_gridfs as reco  # noqa: E402
+    cold = time.monotonic() - t0
+    cold += reco.warm()
+    warm = []
+    for _ in range(args.runs):
+        t0 = time.monotonic()
+        reco.get_index()   # run() 的 setup 部分
+        warm.append(time.monotonic() - t0)
+
+    print(f"subprocess per run          {_fmt(old)}")
+    print(f"in-process, first run       {cold:7.3f}s (import + model + index, once per worker process)")
+    print(f"in-process, later runs      {_fmt(warm)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,17 @@
 """
 Reads CyBOK section-level index (FAISS + meta) from GridFS,
 performs similarity matching against the `threats` collection
-(default only MSRC Blog items), and writes recommendations back
-to `threats.recommendations.cybok`.
+(default only MSRC Blog items), and writes
+recommendations back to `threats.recommendations.cybok`.
+
+Incremental by default: each doc is stamped with the model, index version and
+content_hash its recommendations came from (`recommendations.cybok_stamp`), and
+only docs whose stamp is missing or stale are processed. `--full` / run(full=True)
+recomputes the whole window.
+
+Runs either as a script (one-shot) or in-process inside a Celery worker via
+`run()`, which reuses a per-process Mongo client, SentenceTransformer model and
+CybokIndex (see `warm()`, called from worker_process_init in worker/tasks.py).
 
 Write-back example:
 threats.recommendations.cybok = [
@@ -18,14 +27,20 @@ threats.recommendations.cybok = [
     "url": "/cybok/64f2...c9b1"
   }
 ]
+threats.recommendations.cybok_stamp = {
+  "model": "all-MiniLM-L6-v2", "index_version": "<version key>",
+  "content_hash": "<threats.content_hash>", "computed_at": ISODate
+}
 """
-import os, json, logging, re
+import os, json, logging, re, threading, time, hashlib, tempfile, argparse
 from datetime import datetime, timezone, timedelta
 
 import faiss
 import gridfs
 import numpy as np
+from bson.binary import Binary
 from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 from sentence_transformers import SentenceTransformer
 
 # ---------- Configuration ----------
@@ -40,6 +55,14 @@ CYBOK_VERSION = os.getenv("CYBOK_VERSION", "v1")
 IDX_NAME  = f"cybok.index.{CYBOK_VERSION}"
 META_NAME = f"cybok_meta.json.{CYBOK_VERSION}"
 
+# 本地索引缓存（按 GridFS 版本命名，同一节点上的多个 worker 进程共享 mmap 页）
+CACHE_DIR = os.getenv("CYBOK_CACHE_DIR", os.path.join(tempfile.gettempdir(), "cybok_cache"))
+
+# 持久化向量缓存（_id = "<model>:sha1(query text)"，向量以 float16 / int8 存为 BSON Binary；off 关闭）
+EMBED_CACHE_COLL  = os.getenv("EMBED_CACHE_COLL", "threat_embeddings")
+EMBED_CACHE_DTYPE = os.getenv("EMBED_CACHE_DTYPE", "float16")   # float16 | int8 | off
+EMBED_CACHE_TTL_DAYS = int(os.getenv("EMBED_CACHE_TTL_DAYS", "60"))  # TTL on created_at（旧模型 / 旧正文的向量自动过期）
+
 MODEL_NAME  = os.getenv("CYBOK_MODEL", "all-MiniLM-L6-v2")
 SOURCE_LIST = os.getenv("RECO_SOURCES", "msrc_blog").split(",")
 DAYS_LIMIT  = int(os.getenv("RECO_DAYS", "30"))
@@ -47,54 +70,280 @@ TOPK        = int(os.getenv("RECO_TOPK", "5"))
 BATCH       = int(os.getenv("RECO_BATCH", "48"))
 MIN_SCORE   = float(os.getenv("RECO_MIN_SCORE", "0.25"))
 
+QUERY_CHARS = 2000                 # 查询文本（title + content）截断长度
+CONTENT_PREFIX_CHARS = QUERY_CHARS * 4   # 服务端只返回 content 前缀（留足空白折叠 / 实体反转义的余量）
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
 # ---------- CyBOK Index Loader ----------
-class CybokIndex:
+META_COLUMNS = ("sid", "ka_id", "title", "section", "chapter", "url")
+
+class CybokMeta:
     """
-    Wrapper for loading CyBOK FAISS index + metadata from Mongo GridFS.
+    Columnar CyBOK metadata: one list per field instead of a dict per section
+    (`sid` resolved once at cache time). meta[i] still returns a dict.
     """
-    def __init__(self, mongo: MongoClient):
-        db = mongo[DB_NAME]
-        fs = gridfs.GridFS(db)
+    def __init__(self, columns: dict):
+        self.columns = {c: columns.get(c) or [] for c in META_COLUMNS}
+        self.count = len(self.columns["sid"])
+
+    @classmethod
+    def from_records(cls, records: list) -> "CybokMeta":
+        cols = {c: [] for c in META_COLUMNS}
+        for m in records:
+            cols["sid"].append(_extract_sid_from_meta(m) or None)
+            for c in META_COLUMNS[1:]:
+                cols[c].append(m.get(c))
+        return cls(cols)
+
+    @classmethod
+    def load(cls, path: str) -> "CybokMeta":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f)["columns"])
+
+    def dump(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"count": self.count, "columns": self.columns}, f, ensure_ascii=False, separators=(",", ":"))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i: int) -> dict:
+        return {c: self.columns[c][i] for c in META_COLUMNS}
+
+def _gridfs_files(mongo: MongoClient):
+    fs = gridfs.GridFS(mongo[DB_NAME])
+    fidx  = fs.find_one({"filename": IDX_NAME})
+    fmeta = fs.find_one({"filename": META_NAME})
+    if not fidx or not fmeta:
+        raise RuntimeError(f"GridFS did not contain {IDX_NAME} or {META_NAME}")
+    return fidx, fmeta
+
+def _version_key(fidx, fmeta) -> str:
+    """Identity of the stored index: GridFS _id / md5 / uploadDate of both files."""
+    parts = []
+    for f in (fidx, fmeta):
+        up = getattr(f, "upload_date", None)
+        parts.append(f"{f._id}|{getattr(f, 'md5', None) or ''}|{up.isoformat() if up else ''}|{f.length}")
+    return hashlib.sha1("\n".join(parts).encode()).hexdigest()[:16]
 
-        fidx  = fs.find_one({"filename": IDX_NAME})
-        fmeta = fs.find_one({"filename": META_NAME})
-        if not fidx or not fmeta:
-            raise RuntimeError(f"GridFS did not contain {IDX_NAME} or {META_NAME}")
+def current_version(mongo: MongoClient) -> str:
+    """Version key of the index currently in GridFS (two small file-doc lookups)."""
+    return _version_key(*_gridfs_files(mongo))
 
-        idx_bytes  = fidx.read()
-        meta_bytes = fmeta.read()
+def _atomic_write(path: str, write):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def _fill_cache(fidx, fmeta, idx_path: str, meta_path: str):
+    """Download the GridFS files once into the local cache and drop older versions."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    def _write_idx(tmp):
+        with open(tmp, "wb") as out:
+            for chunk in fidx:      # GridOut 按 chunk 迭代，不整体读入内存
+                out.write(chunk)
+    _atomic_write(idx_path, _write_idx)
+    records = json.loads(fmeta.read().decode("utf-8"))
+    _atomic_write(meta_path, CybokMeta.from_records(records).dump)
+
+    keep = {os.path.basename(idx_path), os.path.basename(meta_path)}
+    for name in os.listdir(CACHE_DIR):
+        if name.startswith((IDX_NAME + ".", META_NAME + ".")) and name not in keep and not name.endswith(".tmp"):
+            try:
+                os.remove(os.path.join(CACHE_DIR, name))   # 仍在 mmap 的进程不受影响
+            except OSError:
+                pass
+
+def _read_index(path: str):
+    """read_index with mmap IO flags (pages shared across processes); plain read as fallback."""
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    try:
+        return faiss.read_index(path, flags)
+    except Exception as e:
+        logging.info("mmap read_index not supported for this index (%s); reading into memory", e)
+        return faiss.read_index(path)
+
+class EmbeddingCache:
+    """
+    Durable store of normalized query embeddings keyed by model + text hash.
+    float16 keeps ~3 significant digits; int8 stores round(v * 127) (embeddings
+    are L2-normalized, so components lie in [-1, 1]). Vectors are re-normalized
+    after decoding so inner products stay cosine similarities.
+    """
+    def __init__(self, coll, model_name: str = MODEL_NAME, dtype: str = EMBED_CACHE_DTYPE):
+        self.coll = coll
+        self.model_name = model_name
+        self.dtype = dtype
+        self.hits = 0
+        self.misses = 0
+        try:
+            coll.create_index("created_at", expireAfterSeconds=EMBED_CACHE_TTL_DAYS * 86400)
+        except Exception as e:
+            logging.warning("embedding cache TTL index not created: %s", e)
+
+    def key(self, text: str) -> str:
+        return f"{self.model_name}:{hashlib.sha1(text.encode('utf-8')).hexdigest()}"
+
+    def _encode(self, v: np.ndarray) -> bytes:
+        if self.dtype == "int8":
+            return np.clip(np.rint(v * 127), -127, 127).astype(np.int8).tobytes()
+        return v.astype(np.float16).tobytes()
+
+    @staticmethod
+    def _decode(doc: dict) -> np.ndarray:
+        if doc.get("dtype") == "int8":
+            return np.frombuffer(doc["vec"], dtype=np.int8).astype(np.float32) / 127.0
+        return np.frombuffer(doc["vec"], dtype=np.float16).astype(np.float32)
+
+    def get_many(self, keys) -> dict:
+        """{key: float32 vector} for the keys present in the store."""
+        found = {}
+        try:
+            for d in self.coll.find({"_id": {"$in": list(set(keys))}}, {"vec": 1, "dtype": 1}):
+                found[d["_id"]] = self._decode(d)
+        except Exception as e:
+            logging.warning("embedding cache lookup failed: %s", e)
+        return found
 
-        # Try deserializing FAISS index directly from bytes,
-        # if not possible, fallback to uint8 numpy buffer
+    def put_many(self, items):
+        """items: [(key, float32 vector)]; concurrent writers racing on a key are fine."""
+        now = datetime.now(timezone.utc)
+        docs = [{"_id": k, "model": self.model_name, "dtype": self.dtype, "dim": int(v.shape[0]),
+                 "vec": Binary(self._encode(v)), "created_at": now} for k, v in items]
+        if not docs:
+            return
         try:
-            self.index = faiss.deserialize_index(idx_bytes)
-        except Exception:
-            idx_arr = np.frombuffer(idx_bytes, dtype='uint8')
-            self.index = faiss.deserialize_index(idx_arr)
+            self.coll.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # duplicate _id（code 11000）：另一个 worker 已写入；其余错误照常记录
+            errors = [w for w in (e.details or {}).get("writeErrors", []) if w.get("code") != 11000]
+            if errors or (e.details or {}).get("writeConcernErrors"):
+                logging.warning("embedding cache write failed for %d docs: %s",
+                                len(errors), (errors or e.details["writeConcernErrors"])[0].get("errmsg"))
+        except Exception as e:
+            logging.warning("embedding cache write failed: %s", e)
 
-        self.meta  = json.loads(meta_bytes.decode("utf-8"))
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else None}
+
+class CybokIndex:
+    """
+    Wrapper for the CyBOK FAISS index + metadata stored in Mongo GridFS, served
+    from a local on-disk cache keyed by the GridFS version (see _version_key).
+    """
+    def __init__(self, mongo: MongoClient, model: SentenceTransformer | None = None):
+        fidx, fmeta = _gridfs_files(mongo)
+        self.version = _version_key(fidx, fmeta)
+
+        idx_path  = os.path.join(CACHE_DIR, f"{IDX_NAME}.{self.version}.faiss")
+        meta_path = os.path.join(CACHE_DIR, f"{META_NAME}.{self.version}.cols.json")
+        cached = os.path.exists(idx_path) and os.path.exists(meta_path)
+        if not cached:
+            _fill_cache(fidx, fmeta, idx_path, meta_path)
+
+        self.index = _read_index(idx_path)
+        self.meta  = CybokMeta.load(meta_path)
         self.count = len(self.meta)
-        logging.info("Cybok index loaded: items=%d", self.count)
+        logging.info("Cybok index loaded: items=%d version=%s (%s)",
+                     self.count, self.version, "local cache" if cached else "downloaded")
 
-        self.model = SentenceTransformer(MODEL_NAME)
+        self.model = model or SentenceTransformer(MODEL_NAME)
+        self.embed_cache = None
+        if EMBED_CACHE_DTYPE != "off":
+            self.embed_cache = EmbeddingCache(mongo[DB_NAME][EMBED_CACHE_COLL])
+
+    def embed(self, texts) -> np.ndarray:
+        """
+        Normalized float32 embeddings for `texts`; served from the embedding cache
+        where possible, only the misses go through the model.
+        """
+        if self.embed_cache is None:
+            return self.model.encode(texts, batch_size=64, normalize_embeddings=True).astype("float32")
+
+        cache = self.embed_cache
+        keys = [cache.key(t) for t in texts]
+        found = cache.get_many(keys)
+        missing = [i for i, k in enumerate(keys) if k not in found]
+        cache.hits += len(texts) - len(missing)
+        cache.misses += len(missing)
+        if missing:
+            fresh = self.model.encode(
+                [texts[i] for i in missing],
+                batch_size=64,
+                normalize_embeddings=True
+            ).astype("float32")
+            new_items = {}
+            for i, v in zip(missing, fresh):
+                found[keys[i]] = v
+                new_items[keys[i]] = v
+            cache.put_many(new_items.items())
+
+        vecs = np.stack([found[k] for k in keys]).astype("float32")
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        return vecs / np.where(norms > 0, norms, 1.0)
 
     def search_texts(self, texts, topk=TOPK):
         """
-        Encode and search multiple texts against the FAISS index.
+        Embed (cache first) and search multiple texts against the FAISS index.
         Returns distances and indices.
         """
         if not texts:
             return None, None
-        vecs = self.model.encode(
-            texts,
-            batch_size=64,
-            normalize_embeddings=True
-        ).astype("float32")
+        vecs = self.embed(texts)
         D, I = self.index.search(vecs, topk)
         return D, I
 
+# ---------- Per-process holder (long-lived workers) ----------
+_holder_lock = threading.Lock()
+_mongo: MongoClient | None = None
+_model: SentenceTransformer | None = None
+_index: CybokIndex | None = None
+
+def get_mongo() -> MongoClient:
+    """Process-wide MongoClient (create after fork, never share across processes)."""
+    global _mongo
+    with _holder_lock:
+        if _mongo is None:
+            _mongo = MongoClient(MONGODB_URI, serverSelectionTimeoutMS=20000, connectTimeoutMS=20000)
+        return _mongo
+
+def get_index() -> CybokIndex:
+    """
+    Process-wide CybokIndex + embedding model, loaded on first use; the index is
+    reloaded (model kept) only when the GridFS version changes.
+    """
+    global _model, _index
+    mongo = get_mongo()
+    with _holder_lock:
+        if _index is not None:
+            try:
+                if current_version(mongo) == _index.version:
+                    return _index
+                logging.info("Cybok index version changed; reloading")
+            except Exception as e:
+                logging.warning("Cybok index version check failed, keeping loaded index: %s", e)
+                return _index
+        t0 = time.monotonic()
+        if _model is None:
+            _model = SentenceTransformer(MODEL_NAME)
+        _index = CybokIndex(mongo, model=_model)
+        logging.info("Cybok model + index ready in %.2fs", time.monotonic() - t0)
+        return _index
+
+def warm() -> float:
+    """Load model + index now (worker_process_init); returns seconds spent."""
+    t0 = time.monotonic()
+    get_index()
+    return time.monotonic() - t0
+
 # ---------- Recommendation Logic ----------
 def normalize_text(s: str):
     import html
@@ -109,16 +358,31 @@ def doc_to_query_text(doc):
     """
     title = normalize_text(doc.get("title") or "")
     content = normalize_text(doc.get("content") or "")
-    return (title + " " + content)[:2000]
+    return (title + " " + content)[:QUERY_CHARS]
 
-def recommend_for_docs(mongo: MongoClient):
+def _stale_filter(idx: CybokIndex) -> dict:
+    """Docs whose cybok_stamp is missing or was computed from another model / index / content."""
+    stamp = "recommendations.cybok_stamp"
+    return {"$or": [
+        {f"{stamp}.model": {"$ne": MODEL_NAME}},
+        {f"{stamp}.index_version": {"$ne": idx.version}},
+        {"$expr": {"$ne": [{"$ifNull": [f"${stamp}.content_hash", None]},
+                           {"$ifNull": ["$content_hash", None]}]}},
+    ]}
+
+def recommend_for_docs(mongo: MongoClient, idx: CybokIndex | None = None, full: bool = False) -> dict:
     """
     Generate CyBOK recommendations for matching docs in `threats`.
+    `idx` defaults to a freshly loaded CybokIndex; full=False only processes docs
+    with a missing / stale cybok_stamp. Streams a server cursor (only a content
+    prefix is projected) and writes after every BATCH docs, so memory stays flat
+    and a crash keeps the batches already written. Returns counters.
     """
     db = mongo[DB_NAME]
     coll = db[COLL_NAME]
 
-    idx = CybokIndex(mongo)
+    if idx is None:
+        idx = CybokIndex(mongo)
 
     since = datetime.now(timezone.utc) - timedelta(days=DAYS_LIMIT)
     filt = {
@@ -126,38 +390,55 @@ def recommend_for_docs(mongo: MongoClient):
         "timestamp": {"$gte": since},
         "content": {"$exists": True, "$ne": ""},
     }
-    fields = {"_id": 1, "title": 1, "content": 1, "source": 1}
-    docs = list(coll.find(filt, fields).sort([("timestamp", -1)]))
-    logging.info("Docs to process: %d", len(docs))
+    if not full:
+        # $and：不覆盖基础条件里已有（或以后加入）的 $or
+        filt = {"$and": [filt, _stale_filter(idx)]}
+    cache_before = idx.embed_cache.stats() if idx.embed_cache else None
+    fields = {
+        "_id": 1, "title": 1, "content_hash": 1,
+        "content": {"$substrCP": [{"$ifNull": ["$content", ""]}, 0, CONTENT_PREFIX_CHARS]},
+    }
+    cursor = coll.find(filt, fields).sort([("timestamp", -1)]).batch_size(BATCH)
 
-    ops = []
-    batch_texts, batch_ids = [], []
-    for d in docs:
+    now = datetime.now(timezone.utc)
+    stats = {"docs": 0, "full": full, "batches": 0, "matched": 0, "modified": 0}
+
+    def _flush(texts, ids, stamps):
+        D, I = idx.search_texts(texts, TOPK)
+        ops = make_ops(ids, D, I, idx.meta, stamps) if D is not None else []
+        if ops:
+            res = coll.bulk_write(ops, ordered=False)
+            stats["matched"] += getattr(res, "matched_count", 0)
+            stats["modified"] += getattr(res, "modified_count", 0)
+        stats["batches"] += 1
+
+    batch_texts, batch_ids, batch_stamps = [], [], []
+    for d in cursor:
+        stats["docs"] += 1
         q = doc_to_query_text(d)
         if not q:
             continue
         batch_texts.append(q); batch_ids.append(d["_id"])
+        batch_stamps.append({"model": MODEL_NAME, "index_version": idx.version,
+                             "content_hash": d.get("content_hash"), "computed_at": now})
 
         if len(batch_texts) >= BATCH:
-            D, I = idx.search_texts(batch_texts, TOPK)
-            if D is not None:
-                ops.extend(make_ops(batch_ids, D, I, idx.meta))
-            batch_texts, batch_ids = [], []
+            _flush(batch_texts, batch_ids, batch_stamps)
+            batch_texts, batch_ids, batch_stamps = [], [], []
 
     if batch_texts:
-        D, I = idx.search_texts(batch_texts, TOPK)
-        if D is not None:
-            ops.extend(make_ops(batch_ids, D, I, idx.meta))
-
-    if ops:
-        res = coll.bulk_write(ops, ordered=False)
-        logging.info(
-            "Updated docs: matched=%s modified=%s",
-            getattr(res, "matched_count", 0),
-            getattr(res, "modified_count", 0)
-        )
-    else:
-        logging.info("No updates to write.")
+        _flush(batch_texts, batch_ids, batch_stamps)
+
+    logging.info("Docs processed: %d (%s) in %d batches; matched=%s modified=%s",
+                 stats["docs"], "full" if full else "incremental",
+                 stats["batches"], stats["matched"], stats["modified"])
+    if cache_before is not None:
+        now_st = idx.embed_cache.stats()
+        hits, misses = now_st["hits"] - cache_before["hits"], now_st["misses"] - cache_before["misses"]
+        stats["embed_cache"] = {"hits": hits, "misses": misses,
+                                "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None}
+        logging.info("Embedding cache: hits=%d misses=%d hit_rate=%s", hits, misses, stats["embed_cache"]["hit_rate"])
+    return stats
 
 def _extract_sid_from_meta(m):
     """
@@ -177,9 +458,11 @@ def _extract_sid_from_meta(m):
             sid = m2.group(1)
     return sid
 
-def make_ops(ids, D, I, meta):
+def make_ops(ids, D, I, meta, stamps=None):
     """
     Construct MongoDB bulk update operations with recommendations.
+    With `stamps` (one per id), every doc is written (also when no section clears
+    MIN_SCORE) together with its cybok_stamp, so it is not selected again.
     """
     ops = []
     for row, _id in enumerate(ids):
@@ -192,7 +475,7 @@ def make_ops(ids, D, I, meta):
                 continue
 
             m = meta[midx]
-            sid = _extract_sid_from_meta(m)
+            sid = m["sid"] if "sid" in m else _extract_sid_from_meta(m)
             url = f"/cybok/{sid}" if sid else (m.get("url") or None)
 
             recs.append({
@@ -205,14 +488,35 @@ def make_ops(ids, D, I, meta):
                 "url": url,
             })
 
-        if recs:
+        if stamps is not None:
+            ops.append(UpdateOne({"_id": _id}, {"$set": {"recommendations.cybok": recs,
+                                                         "recommendations.cybok_stamp": stamps[row]}}))
+        elif recs:
             ops.append(UpdateOne({"_id": _id}, {"$set": {"recommendations.cybok": recs}}))
     return ops
 
 # ---------- Entry ----------
-def main():
+def run(full: bool = False) -> dict:
+    """
+    In-process entry for workers: reuse the warm holder and report how long this
+    run spent on setup (model/index load; ~0 once warm) vs the reco pass itself.
+    """
+    t0 = time.monotonic()
+    idx = get_index()
+    setup = time.monotonic() - t0
+    stats = recommend_for_docs(get_mongo(), idx, full=full)
+    stats["setup_seconds"] = round(setup, 3)
+    stats["seconds"] = round(time.monotonic() - t0, 3)
+    logging.info("[reco] setup=%.2fs total=%.2fs", setup, stats["seconds"])
+    return stats
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="CyBOK recommendations for threats")
+    ap.add_argument("--full", action="store_true",
+                    help="recompute every doc in the RECO_DAYS window, ignoring cybok_stamp")
+    args = ap.parse_args(argv)
     mongo = MongoClient(MONGODB_URI, serverSelectionTimeoutMS=20000, connectTimeoutMS=20000)
-    recommend_for_docs(mongo)
+    return recommend_for_docs(mongo, full=args.full)
 
 if __name__ == "__main__":
     main()
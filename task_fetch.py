@@ -5,22 +5,42 @@ import os
 import re
 import time
 import html
+import json
 import random
+import socket
 import hashlib
 import logging
+import argparse
+import gzip
+import codecs
+import email.utils
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime, timezone, timedelta
+from pathlib import Path
 from typing import Tuple, Optional
-from urllib.parse import urlparse, urlsplit, urlunsplit
+from urllib.parse import urlparse, urlsplit, urlunsplit, parse_qsl, urlencode
+import gridfs
 import requests
-from pymongo import MongoClient, UpdateOne
+import urllib3
+from requests.adapters import HTTPAdapter
+from pymongo import MongoClient, UpdateOne, UpdateMany, DeleteOne
 from pymongo.errors import (
     AutoReconnect,
     ConnectionFailure,
     NetworkTimeout,
     ExecutionTimeout,
     BulkWriteError,
+    DuplicateKeyError,
 )
 
+try:
+    from text_signals import is_human_line
+except ImportError:
+    from worker.text_signals import is_human_line
+
 # feedparser 作为可选依赖：若缺失，依赖它的函数会抛出更友好的错误
 try:
     import feedparser
@@ -36,6 +56,21 @@ try:
     from bs4 import BeautifulSoup  # type: ignore
 except Exception:
     BeautifulSoup = None  # type: ignore
+try:
+    import lxml.html as _lxml_html  # type: ignore
+    from lxml import etree as _etree  # type: ignore
+except Exception:
+    _lxml_html = _etree = None  # type: ignore
+# zstandard 可选：缺失时快照使用 gzip
+try:
+    import zstandard as _zstd  # type: ignore
+except Exception:
+    _zstd = None  # type: ignore
+# redis 可选：缺失时 feed 租约锁退化为进程内锁
+try:
+    import redis as _redis  # type: ignore
+except Exception:
+    _redis = None  # type: ignore
 
 # ---------- Environment ----------
 MONGODB_URI = os.getenv(
@@ -52,6 +87,80 @@ BASE_DELAY = float(os.getenv("BACKOFF_BASE_SECONDS", "0.5"))     # initial delay
 MAX_DELAY = float(os.getenv("BACKOFF_MAX_SECONDS", "20"))        # cap delay
 JITTER_BOUND = float(os.getenv("BACKOFF_JITTER_SECONDS", "0.5")) # additional random jitter [0, JITTER_BOUND]
 
+# Article fetch concurrency (per crawler)
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "8"))            # worker pool size for article downloads
+FETCH_PER_HOST = int(os.getenv("FETCH_PER_HOST", "4"))          # max in-flight article requests per host
+SITE_TIMEOUT = float(os.getenv("SITE_TIMEOUT_SECONDS", "300"))  # default time budget per site crawler in main()
+HTTP_CACHE_ENABLED = os.getenv("HTTP_CACHE", "1") == "1"        # conditional GET (ETag / Last-Modified)
+HTTP_CACHE_TTL_DAYS = int(os.getenv("HTTP_CACHE_TTL_DAYS", "30"))  # validators not refreshed for this long expire (TTL index)
+WRITE_BATCH = int(os.getenv("WRITE_BATCH", "100"))              # streaming writer: flush every N docs ...
+WRITE_FLUSH_SECONDS = float(os.getenv("WRITE_FLUSH_SECONDS", "5"))  # ... or every T seconds
+ARTICLE_REFRESH_HOURS = float(os.getenv("ARTICLE_REFRESH_HOURS", "24"))  # re-check stored entries published within this window
+
+# NVD 2.0 incremental sync
+NVD_API_URL = "https://services.nvd.nist.gov/rest/json/cves/2.0"
+NVD_PAGE_SIZE = int(os.getenv("NVD_PAGE_SIZE", "2000"))              # API maximum is 2000
+NVD_MAX_RANGE_DAYS = 120                                             # API limit for lastMod ranges
+NVD_RATE_WINDOW = 30.0                                               # seconds (rolling window)
+NVD_RATE_LIMIT = int(os.getenv("NVD_RATE_LIMIT", "50" if NVD_API_KEY else "5"))  # requests per window
+NVD_CURSOR_OVERLAP = timedelta(minutes=int(os.getenv("NVD_CURSOR_OVERLAP_MINUTES", "5")))
+
+# Per-host token bucket + circuit breaker (state persisted in `host_state`)
+# 注意：令牌桶在 FETCH_PER_HOST 并发之上再限速——HOST_RPS=2 时一个 40 条的 feed 至少要 ~18s，
+# 与并发数无关。内置文章主机默认放宽到 FETCH_PER_HOST 个请求/秒，其余主机仍用 HOST_RPS；
+# 可用 HOST_RPS_OVERRIDES 覆盖任何主机（包括内置主机）。
+HOST_RPS = float(os.getenv("HOST_RPS", "2"))                    # default requests/sec per host
+HOST_BURST = float(os.getenv("HOST_BURST", "4"))                # bucket capacity
+BUILTIN_ARTICLE_HOSTS = ("krebsonsecurity.com", "msrc.microsoft.com")
+HOST_RPS_OVERRIDES = {
+    **{h: float(max(HOST_RPS, FETCH_PER_HOST)) for h in BUILTIN_ARTICLE_HOSTS},
+    **{                                                         # "host=rps,host=rps"
+        h.strip().lower(): float(r)
+        for h, _, r in (x.partition("=") for x in os.getenv("HOST_RPS_OVERRIDES", "").split(","))
+        if h.strip() and r.strip()
+    },
+}
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))      # consecutive failures before the breaker opens
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN_SECONDS", "900"))
+
+# Deferred article retries (processed by the worker.tasks.run_fetch_retries Celery task)
+DEFER_ARTICLE_RETRIES = os.getenv("DEFER_ARTICLE_RETRIES", "1") == "1"
+RETRY_MAX_ATTEMPTS = int(os.getenv("FETCH_RETRY_MAX_ATTEMPTS", "6"))
+RETRY_LEASE_SECONDS = 300                                       # claim time for one retry item
+
+# ---------- Raw HTML snapshots ----------
+SNAPSHOT_STORE = os.getenv("SNAPSHOT_STORE", "gridfs").lower()  # gridfs | local | off
+SNAPSHOT_DIR = Path(os.getenv("SNAPSHOT_DIR", os.path.join(os.getenv("TMP", os.getenv("TEMP", "/tmp")), "cti_snapshots")))
+SNAPSHOT_CODEC = os.getenv("SNAPSHOT_CODEC", "zstd" if _zstd is not None else "gzip")  # zstd | gzip
+SNAPSHOT_MAX_BYTES = int(float(os.getenv("SNAPSHOT_MAX_MB", "2048")) * 1024 * 1024)   # compressed size cap (eviction)
+SNAPSHOT_DELETE_STALE_SECONDS = 600                             # a blob "deleting" mark older than this was abandoned
+
+# ---------- Per-feed lease locks ----------
+FETCH_LOCK_REDIS_URL = os.getenv("FETCH_LOCK_REDIS_URL") or os.getenv("CELERY_BROKER_URL", "")  # default: Celery broker
+FETCH_LOCK_TTL = float(os.getenv("FETCH_LOCK_TTL_SECONDS", "300"))   # lease length, renewed before writing
+RSS_DEDUP_WORKERS = int(os.getenv("RSS_DEDUP_WORKERS", "4"))       # feeds processed in parallel per run
+# 租约只由 RSS_DEDUP_WORKERS 个线程各持有一把，连接池按此封顶（阻塞等待空闲连接，而不是无限新建）；
+# 默认与 Celery broker 共用 Redis，而 celery_app 已把 broker 连接压得很低，需要隔离时设 FETCH_LOCK_REDIS_URL
+FETCH_LOCK_REDIS_MAX_CONNECTIONS = int(os.getenv("FETCH_LOCK_REDIS_MAX_CONNECTIONS", str(max(1, RSS_DEDUP_WORKERS))))
+
+# ---------- Adaptive per-feed polling (user_rss_sources.next_poll_at) ----------
+RSS_POLL_MIN = float(os.getenv("RSS_POLL_MIN_SECONDS", "3600"))           # never poll a feed more often than this
+RSS_POLL_MAX = float(os.getenv("RSS_POLL_MAX_SECONDS", str(2 * 86400)))  # ... nor less often than this
+RSS_POLL_BACKOFF = float(os.getenv("RSS_POLL_BACKOFF", "1.5"))           # interval growth per 304 / unchanged poll
+RSS_DUE_SLACK = 300                                                      # seconds; absorbs beat timing jitter
+
+# ---------- Near-duplicate detection (MinHash-LSH) ----------
+NEAR_DUP_SOURCES = {s.strip() for s in os.getenv("NEAR_DUP_SOURCES", "krebsonsecurity,msrc_blog,user").split(",") if s.strip()}
+NEAR_DUP_MIN_JACCARD = float(os.getenv("NEAR_DUP_MIN_JACCARD", "0.6"))  # estimated word/word-pair Jaccard
+NEAR_DUP_WINDOW_DAYS = int(os.getenv("NEAR_DUP_WINDOW_DAYS", "30"))   # only cluster against recent items
+NEAR_DUP_MIN_WORDS = int(os.getenv("NEAR_DUP_MIN_WORDS", "12"))       # shorter texts are never fingerprinted
+
+# ---------- HTTP transport ----------
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))   # seconds; read timeout = per-call timeout
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "64"))              # hosts with a cached connection pool
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", str(max(4, FETCH_PER_HOST * 2))))  # keep-alive connections per host
+DNS_CACHE_SECONDS = float(os.getenv("DNS_CACHE_SECONDS", "300"))       # 0 disables the in-process DNS cache
+
 ROLES = ["public", "pro", "admin"]
 ROLE_ORDER = {"public": 0, "pro": 1, "admin": 2}
 def roles_at_or_above(min_role: str):
@@ -71,26 +180,168 @@ sources_coll = db["custom_sources"]
 user_rss_sources = db["user_rss_sources"]
 user_rss_items = db["user_rss_items"]
 
+# 条件请求校验器缓存（_id = URL）
+http_cache = db["http_cache"]
+
+# 增量同步游标（_id = 数据源名）
+sync_state = db["sync_state"]
+
+# 每主机限速/熔断状态（_id = host）
+host_state = db["host_state"]
+
+# 延后重试队列（_id = source_id）
+fetch_retries = db["fetch_retries"]
+
+# 原始 HTML 快照索引（_id = URL），正文按 body_hash 内容寻址存放在 GridFS / 本地目录
+html_snapshots = db["html_snapshots"]
+# 正文块状态（_id = body_hash, state = live | deleting, size）：协调并发的快照写入与正文块删除
+html_snapshot_blobs = db["html_snapshot_blobs"]
+# 正文块总字节数的运行计数在 sync_state（_id = "html_snapshots", bytes），evict_snapshots 据此跳过聚合
+
+# 按 (规范 URL, min_role) 的唯一索引：同一篇文章在每个可见范围内只入库一次
+# （可见范围不同的副本并存，见 _shadowing_copy）。已有重复数据时创建会失败，
+# 需先执行一次 `python task_fetch.py --migrate-canonical-urls` 合并重复。
+def _ensure_canonical_url_indexes():
+    only_set = {"canonical_url": {"$type": "string"}}
+    if coll.index_information().get("canonical_url_1", {}).get("unique"):
+        coll.drop_index("canonical_url_1")   # 旧版：每个规范 URL 全局唯一
+    coll.create_index([("canonical_url", 1), ("min_role", 1)], unique=True, partialFilterExpression=only_set)
+    user_rss_items.create_index([("owner_username", 1), ("canonical_url", 1)], unique=True,
+                                partialFilterExpression=only_set)
+
 # 创建索引（尽力而为，已存在则忽略）
 try:
     coll.create_index("source_id", unique=True)
     coll.create_index([("timestamp", -1)])
     coll.create_index([("allowed_roles", 1), ("timestamp", -1)])
+    coll.create_index([("lsh_bands", 1)])
+    fetch_retries.create_index([("due_at", 1)])
+    http_cache.create_index("updated_at", expireAfterSeconds=HTTP_CACHE_TTL_DAYS * 86400)
+    html_snapshots.create_index([("body_hash", 1)])
+    html_snapshots.create_index([("source", 1)])
     sources_coll.create_index("url", unique=True)
     user_rss_items.create_index([("owner_username", 1), ("url", 1)], unique=True)
     user_rss_sources.create_index([("owner_username", 1), ("url", 1)], unique=True)
+    _ensure_canonical_url_indexes()
 except Exception:
     pass
 
-# ---------- HTTP Sessions ----------
-# “文件2”中的会话（用于 per-user RSS 抓取）
-UA_RSS = "cti-portal/1.0 (+rss)"
-SESSION = requests.Session()
-SESSION.headers.update({"User-Agent": UA_RSS})
+# ---------- HTTP 传输层（所有抓取路径共用：feed / 文章 / NVD / KEV / per-user RSS）----------
+# 每主机连接池 + keep-alive、按已安装解码器协商 gzip/br、进程内 DNS 缓存、强制 connect/read 超时，
+# 并统计新建 vs 复用的连接数。
+UA_RSS = "cti-portal/1.0 (+rss)"           # per-user RSS（“文件2”）
+UA_HEADERS = {"User-Agent": "cti-crawler/1.0"}  # 站点爬取（“文件1”）
+
+_transport_stats = {"requests": 0, "new_connections": 0, "dns_hits": 0, "dns_misses": 0}
+_transport_lock = threading.Lock()
+
+def _count_transport(key: str, n: int = 1):
+    with _transport_lock:
+        _transport_stats[key] += n
+
+class _DnsCache:
+    """Tiny TTL cache of getaddrinfo() results (host, port) -> [ip, ...]."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: dict[tuple[str, int], tuple[float, list[str]]] = {}
+
+    def resolve(self, host: str, port: int) -> list[str]:
+        now = time.monotonic()
+        with self._lock:
+            hit = self._entries.get((host, port))
+        if hit and hit[0] > now:
+            _count_transport("dns_hits")
+            return hit[1]
+        _count_transport("dns_misses")
+        infos = socket.getaddrinfo(host, port, urllib3.util.connection.allowed_gai_family(), socket.SOCK_STREAM)
+        ips = list(dict.fromkeys(info[4][0] for info in infos))
+        with self._lock:
+            self._entries[(host, port)] = (now + self.ttl, ips)
+        return ips
+
+    def forget(self, host: str, port: int):
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+_dns_cache = _DnsCache(DNS_CACHE_SECONDS)
+
+class _CachedDnsMixin:
+    """urllib3 connection that connects via cached IPs (TLS SNI / cert checks still use the hostname)."""
+
+    def _new_conn(self):
+        host = self._dns_host
+        _count_transport("new_connections")
+        if DNS_CACHE_SECONDS <= 0 or urllib3.util.ssl_.is_ipaddress(host):
+            return super()._new_conn()
+        try:
+            ips = _dns_cache.resolve(host, self.port)
+        except OSError:
+            return super()._new_conn()   # 让 urllib3 按原路径报 NameResolutionError
+        for ip in ips:
+            self._dns_host = ip
+            try:
+                return super()._new_conn()
+            except (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError):
+                continue
+            finally:
+                self._dns_host = host
+        _dns_cache.forget(host, self.port)   # 缓存的地址都连不上：丢弃并按原始主机名再试一次
+        return super()._new_conn()
+
+class _HTTPConnection(_CachedDnsMixin, urllib3.connection.HTTPConnection):
+    pass
+
+class _HTTPSConnection(_CachedDnsMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+class _HTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+class _HTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+class _TunedAdapter(HTTPAdapter):
+    """Sized per-host pools, cached DNS and a hard (connect, read) timeout on every request."""
+
+    def __init__(self):
+        super().__init__(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_PER_HOST, max_retries=0)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _HTTPConnectionPool, "https": _HTTPSConnectionPool}
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = (HTTP_CONNECT_TIMEOUT, REQUEST_TIMEOUT)
+        elif not isinstance(timeout, tuple):
+            timeout = (min(HTTP_CONNECT_TIMEOUT, float(timeout)), float(timeout))
+        _count_transport("requests")
+        return super().send(request, timeout=timeout, **kwargs)
+
+def _build_session() -> requests.Session:
+    s = requests.Session()
+    adapter = _TunedAdapter()
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    s.headers.update({
+        "User-Agent": UA_HEADERS["User-Agent"],
+        # 只声明本机能解码的编码（安装 brotli 后自动包含 br）
+        "Accept-Encoding": urllib3.util.make_headers(accept_encoding=True)["accept-encoding"],
+        "Connection": "keep-alive",
+    })
+    return s
+
+def transport_stats() -> dict:
+    """Snapshot of transport counters; reused = requests that did not open a new connection."""
+    with _transport_lock:
+        st = dict(_transport_stats)
+    st["reused_connections"] = max(0, st["requests"] - st["new_connections"])
+    return st
 
-# “文件1”中的会话 + UA 头（用于站点爬取 + 带退避的请求）
-_session = requests.Session()
-UA_HEADERS = {"User-Agent": "cti-crawler/1.0"}
+# 唯一的共享会话（原 “文件1” _session 与 “文件2” SESSION 合并）
+SESSION = _build_session()
 
 # ---------- 通用小工具（两端共享） ----------
 def clean_text(s: str | None) -> str:
@@ -100,6 +351,49 @@ def clean_text(s: str | None) -> str:
     s = html.unescape(s)
     return re.sub(r"\s+", " ", s).strip()
 
+# 规范化 URL 时丢弃的跟踪参数（utm_* 前缀另行处理）
+_TRACKING_PARAMS = frozenset((
+    "fbclid", "gclid", "dclid", "gbraid", "wbraid", "msclkid", "yclid", "igshid",
+    "mc_cid", "mc_eid", "_hsenc", "_hsmi", "mkt_tok", "ref_src", "cmpid", "ncid", "ocid", "sr_share",
+))
+
+def canonical_url(u: str | None) -> str:
+    """
+    Canonical form of an article / feed URL, used for every source_id and URL index:
+    lowercase scheme + host, no default port / userinfo / fragment, tracking
+    parameters (utm_*, fbclid, ...) removed, remaining query sorted, duplicate
+    slashes collapsed and no trailing slash (except the root).
+    """
+    u = (u or "").strip()
+    if not u:
+        return ""
+    try:
+        parts = urlsplit(u)
+        port = parts.port
+    except ValueError:
+        return u
+    scheme = (parts.scheme or "http").lower()
+    host = (parts.hostname or "").rstrip(".")
+    if not host:
+        return u
+    if ":" in host:
+        host = f"[{host}]"
+    if port and port != {"http": 80, "https": 443}.get(scheme):
+        host = f"{host}:{port}"
+    path = re.sub(r"/{2,}", "/", parts.path or "/")
+    if len(path) > 1:
+        path = path.rstrip("/") or "/"
+    query = urlencode(sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.lower().startswith("utm_") and k.lower() not in _TRACKING_PARAMS
+    ))
+    return urlunsplit((scheme, host, path, query, ""))
+
+def _fingerprint(obj) -> str:
+    """Stable sha1 of a JSON-serialisable object (independent of key order)."""
+    raw = json.dumps(obj, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
 # 来自“文件1”的 CVE 抽取
 CVE_RE = re.compile(r"\bCVE-\d{4}-\d{4,7}\b", re.I)
 def extract_cves(s: str | None):
@@ -117,24 +411,162 @@ def _retryable_http(resp: requests.Response | None, err: Exception | None) -> bo
         return True
     return resp.status_code in (408, 409, 425, 429, 500, 502, 503, 504)
 
-def _sleep_backoff(attempt: int):
+def _backoff_delay(attempt: int) -> float:
     """Exponential backoff with bounded jitter."""
     delay = min(MAX_DELAY, BASE_DELAY * (2 ** attempt))
-    delay += random.uniform(0, JITTER_BOUND)
-    time.sleep(delay)
+    return delay + random.uniform(0, JITTER_BOUND)
+
+def _sleep_backoff(attempt: int):
+    time.sleep(_backoff_delay(attempt))
+
+class RetryDeferred(RuntimeError):
+    """A retryable failure that the caller asked to defer instead of sleeping on (http_get(defer=True))."""
+
+    def __init__(self, url: str, retry_after: float | None, reason: str):
+        super().__init__(f"deferred {url}: {reason}")
+        self.url = url
+        self.retry_after = retry_after
+
+def _retry_after_seconds(resp: requests.Response | None) -> float | None:
+    """Parse a Retry-After header (delta-seconds or HTTP-date)."""
+    v = ((resp.headers.get("Retry-After") if resp is not None else "") or "").strip()
+    if not v:
+        return None
+    if v.isdigit():
+        return float(v)
+    try:
+        return max(0.0, (email.utils.parsedate_to_datetime(v) - datetime.now(timezone.utc)).total_seconds())
+    except Exception:
+        return None
 
-def http_get(url: str, **kwargs) -> requests.Response:
-    """GET with exponential backoff."""
+# ====== 每主机限速（令牌桶）+ 熔断器，跨运行持久化 ======
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a host whose circuit breaker is open."""
+
+def _utc_from_epoch(ts: float | None) -> datetime | None:
+    return datetime.fromtimestamp(ts, tz=timezone.utc) if ts else None
+
+def _epoch_from_utc(dt: datetime | None) -> float | None:
+    if not dt:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+class _HostGuard:
+    """Token bucket (HOST_RPS / HOST_BURST) and consecutive-failure breaker for one host."""
+
+    def __init__(self, host: str, doc: dict):
+        self.host = host
+        self.rps = HOST_RPS_OVERRIDES.get(host, HOST_RPS)
+        self.lock = threading.Lock()
+        self.tokens = float(doc.get("tokens", HOST_BURST))
+        self.updated = _epoch_from_utc(doc.get("tokens_at")) or time.time()
+        self.failures = int(doc.get("failures") or 0)
+        self.open_until = _epoch_from_utc(doc.get("open_until"))
+
+    def acquire(self):
+        """Take one token (sleeping if needed); raise CircuitOpenError while the breaker is open."""
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.open_until and now < self.open_until:
+                    raise CircuitOpenError(f"circuit open for {self.host} until {_utc_from_epoch(self.open_until)}")
+                if self.rps <= 0:
+                    return
+                self.tokens = min(HOST_BURST, self.tokens + (now - self.updated) * self.rps)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rps
+            time.sleep(wait)
+
+    def record(self, ok: bool):
+        with self.lock:
+            was_open = bool(self.open_until)
+            if ok:
+                self.failures = 0
+                self.open_until = None
+            else:
+                self.failures += 1
+                if self.failures >= BREAKER_FAILURES:
+                    # 冷却结束后的半开请求再失败，会立刻重新熔断
+                    self.open_until = time.time() + BREAKER_COOLDOWN
+            now_open = bool(self.open_until)
+        if now_open and not was_open:
+            logging.warning("circuit opened for %s after %d failures (cooldown %.0fs)",
+                            self.host, self.failures, BREAKER_COOLDOWN)
+        if now_open != was_open or not ok:
+            self.save()
+
+    def state(self) -> dict:
+        with self.lock:
+            return {
+                "tokens": self.tokens,
+                "tokens_at": _utc_from_epoch(self.updated),
+                "failures": self.failures,
+                "open_until": _utc_from_epoch(self.open_until),
+            }
+
+    def save(self):
+        try:
+            host_state.update_one({"_id": self.host}, {"$set": self.state()}, upsert=True)
+        except Exception as e:
+            logging.warning("host_state save failed for %s: %s", self.host, e)
+
+_host_guards: dict[str, _HostGuard] = {}
+_host_guards_lock = threading.Lock()
+
+def _host_guard(url: str) -> _HostGuard:
+    host = (urlparse(url).netloc or "").lower()
+    with _host_guards_lock:
+        guard = _host_guards.get(host)
+        if guard is None:
+            try:
+                doc = host_state.find_one({"_id": host}) or {}
+            except Exception:
+                doc = {}
+            guard = _host_guards[host] = _HostGuard(host, doc)
+    return guard
+
+def save_host_state():
+    """Persist token buckets / breaker state of every host touched in this run."""
+    with _host_guards_lock:
+        guards = list(_host_guards.values())
+    ops = [UpdateOne({"_id": g.host}, {"$set": g.state()}, upsert=True) for g in guards]
+    if ops:
+        try:
+            host_state.bulk_write(ops, ordered=False)
+        except Exception as e:
+            logging.warning("host_state bulk save failed: %s", e)
+
+def http_get(url: str, defer: bool = False, **kwargs) -> requests.Response:
+    """
+    GET with per-host rate limit, circuit breaker and exponential backoff.
+    defer=True: one attempt only; a retryable failure raises RetryDeferred
+    (carrying Retry-After) instead of sleeping in this worker.
+    """
+    guard = _host_guard(url)
     last_err = None
     for i in range(MAX_RETRIES):
         resp = None
+        guard.acquire()
         try:
-            resp = _session.get(url, **kwargs)
+            resp = SESSION.get(url, **kwargs)
+            guard.record(not _retryable_http(resp, None))
             if not _retryable_http(resp, None):
                 return resp
+            if defer:
+                raise RetryDeferred(url, _retry_after_seconds(resp), f"HTTP {resp.status_code}")
             logging.warning("HTTP GET %s -> %s; retry %d/%d", url, resp.status_code, i + 1, MAX_RETRIES)
+        except RetryDeferred:
+            raise
         except Exception as e:
             last_err = e
+            guard.record(False)
+            if defer:
+                raise RetryDeferred(url, None, str(e)) from e
             logging.warning("HTTP GET %s error: %s; retry %d/%d", url, e, i + 1, MAX_RETRIES)
         _sleep_backoff(i)
     if last_err:
@@ -142,46 +574,191 @@ def http_get(url: str, **kwargs) -> requests.Response:
     raise RuntimeError(f"HTTP GET failed after {MAX_RETRIES} retries: {url}")
 
 def http_post(url: str, **kwargs) -> requests.Response:
-    """POST with exponential backoff."""
+    """POST with per-host rate limit, circuit breaker and exponential backoff."""
+    guard = _host_guard(url)
     last_err = None
     for i in range(MAX_RETRIES):
         resp = None
+        guard.acquire()
         try:
-            resp = _session.post(url, **kwargs)
+            resp = SESSION.post(url, **kwargs)
+            guard.record(not _retryable_http(resp, None))
             if not _retryable_http(resp, None):
                 return resp
             logging.warning("HTTP POST %s -> %s; retry %d/%d", url, resp.status_code, i + 1, MAX_RETRIES)
         except Exception as e:
             last_err = e
+            guard.record(False)
             logging.warning("HTTP POST %s error: %s; retry %d/%d", url, e, i + 1, MAX_RETRIES)
         _sleep_backoff(i)
     if last_err:
         raise last_err
     raise RuntimeError(f"HTTP POST failed after {MAX_RETRIES} retries: {url}")
 
-def parse_feed_with_backoff(feed_url: str):
-    """feedparser.parse with exponential backoff."""
+# ====== 文章并发抓取：有界线程池 + 每主机并发上限 ======
+_host_slots: dict[str, threading.BoundedSemaphore] = {}
+_host_slots_lock = threading.Lock()
+
+def _host_slot(url: str) -> threading.BoundedSemaphore:
+    """Per-host semaphore capping concurrent article requests to FETCH_PER_HOST."""
+    host = (urlparse(url).netloc or "").lower()
+    with _host_slots_lock:
+        sem = _host_slots.get(host)
+        if sem is None:
+            sem = _host_slots[host] = threading.BoundedSemaphore(max(1, FETCH_PER_HOST))
+    return sem
+
+def fetch_article(url: str, timeout: int = 25, source: str | None = None,
+                  defer: bool = DEFER_ARTICLE_RETRIES) -> requests.Response:
+    """
+    GET for article pages, holding a per-host slot (backoff sleeps included).
+    With defer=True retryable failures raise RetryDeferred right away (see enqueue_retry).
+    Deliberately unconditional: a 304 would drop an entry whose earlier write may
+    have failed, and per-article validators would only pile up in http_cache.
+    """
+    with _host_slot(url):
+        r = http_get(url, defer=defer, timeout=timeout, headers=UA_HEADERS)
+    r.raise_for_status()
+    return r
+
+def imap_ordered(fn, items, workers: int = FETCH_WORKERS):
+    """
+    Run fn over items on a bounded thread pool and yield results in input order
+    as soon as each one (and all before it) is done.
+    fn should handle its own errors (an exception aborts the whole map).
+    """
+    items = list(items)
+    if not items:
+        return
+    if workers <= 1 or len(items) == 1:
+        for x in items:
+            yield fn(x)
+        return
+    with ThreadPoolExecutor(max_workers=min(workers, len(items)), thread_name_prefix="fetch") as pool:
+        yield from pool.map(fn, items)
+
+def map_ordered(fn, items, workers: int = FETCH_WORKERS) -> list:
+    """List form of imap_ordered."""
+    return list(imap_ordered(fn, items, workers))
+
+# ====== 条件请求缓存（ETag / Last-Modified，持久化在 http_cache）======
+_cache_stats: dict[str, dict[str, int]] = {}
+_cache_stats_lock = threading.Lock()
+
+def _count_cache(source: str | None, key: str):
+    with _cache_stats_lock:
+        st = _cache_stats.setdefault(source or "-", {"hit": 0, "miss": 0})
+        st[key] += 1
+
+def http_cache_stats() -> dict:
+    """Snapshot of conditional GET hit (304) / miss (200) counters per source."""
+    with _cache_stats_lock:
+        return {k: dict(v) for k, v in _cache_stats.items()}
+
+def reset_run_stats():
+    """Zero the http_cache and transport counters (start of a run in a long-lived process)."""
+    with _cache_stats_lock:
+        _cache_stats.clear()
+    with _transport_lock:
+        for k in _transport_stats:
+            _transport_stats[k] = 0
+
+def remember_validators(url: str, resp: requests.Response, source: str | None = None):
+    """Persist a 200 response's ETag / Last-Modified for the next conditional GET."""
+    etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+    if not (HTTP_CACHE_ENABLED and resp.ok and (etag or last_modified)):
+        return
+    try:
+        http_cache.update_one(
+            {"_id": url},
+            {"$set": {
+                "etag": etag,
+                "last_modified": last_modified,
+                "source": source,
+                "updated_at": datetime.now(timezone.utc),
+            }},
+            upsert=True,
+        )
+    except Exception as e:
+        logging.warning("http_cache save failed for %s: %s", url, e)
+
+def http_get_cached(url: str, source: str | None = None, revalidate: bool = True,
+                    save: bool = True, **kwargs) -> requests.Response | None:
+    """
+    http_get with If-None-Match / If-Modified-Since from the `http_cache` collection.
+    Returns None on 304 Not Modified (the caller treats it as "no new entries").
+    revalidate=False: unconditional GET that still records fresh validators.
+    save=False: the caller records them with remember_validators() once whatever
+    it derived from the response is stored (otherwise a later 304 would hide it).
+    """
+    headers = dict(kwargs.pop("headers", None) or {})
+    if HTTP_CACHE_ENABLED and revalidate:
+        try:
+            cached = http_cache.find_one({"_id": url}) or {}
+        except Exception as e:
+            logging.warning("http_cache lookup failed for %s: %s", url, e)
+            cached = {}
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    resp = http_get(url, headers=headers, **kwargs)
+    if resp.status_code == 304:
+        _count_cache(source, "hit")
+        return None
+    _count_cache(source, "miss")
+    if save:
+        remember_validators(url, resp, source)
+    return resp
+
+def parse_feed_with_backoff(feed_url: str, source: str | None = None, cached: bool = True,
+                            headers: dict | None = None):
+    """
+    Conditional GET (with backoff) + feedparser.parse; feedparser never fetches by itself.
+    Returns None when the feed is unchanged since the last run (304).
+    cached=False: unconditional GET (for feeds whose 304 must not hide entries from
+    new subscribers); validators are still recorded for later conditional polls.
+    Validators are NOT saved here: the caller runs parsed["commit_validators"]()
+    (crawlers: as a Checkpoint) after the feed's entries were written.
+    """
     if feedparser is None:
         raise RuntimeError("feedparser is not installed")
+    resp = http_get_cached(feed_url, source=source, revalidate=cached, save=False,
+                           timeout=REQUEST_TIMEOUT, headers=headers or UA_HEADERS)
+    if resp is None:
+        return None
+    # content-location 让 feedparser 能正确解析相对链接
+    headers = dict(resp.headers)
+    headers["content-location"] = resp.url
+    parsed = feedparser.parse(resp.content, response_headers=headers)
+    parsed["status"] = resp.status_code
+    parsed["commit_validators"] = lambda: remember_validators(feed_url, resp, source)
+    return parsed
+
+def _only_duplicate_keys(err: BulkWriteError) -> bool:
+    details = err.details or {}
+    errors = details.get("writeErrors") or []
+    return bool(errors) and not details.get("writeConcernErrors") and all(e.get("code") == 11000 for e in errors)
+
+def bulk_write_with_backoff(ops, collection=None):
+    """
+    Unordered Mongo bulk_write (default: threats) with exponential backoff on transient errors.
+    A BulkWriteError made only of duplicate-key errors is raised at once (retrying cannot help;
+    fenced / conditional upserts use it to signal a rejected write).
+    """
+    target = coll if collection is None else collection
     last_err = None
     for i in range(MAX_RETRIES):
         try:
-            return feedparser.parse(feed_url)
-        except Exception as e:
+            return target.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            if _only_duplicate_keys(e):
+                raise
             last_err = e
-            logging.warning("feedparser %s error: %s; retry %d/%d", feed_url, e, i + 1, MAX_RETRIES)
+            logging.warning("Mongo bulk_write transient error: %s; retry %d/%d", e, i + 1, MAX_RETRIES)
             _sleep_backoff(i)
-    if last_err:
-        raise last_err
-    raise RuntimeError(f"feedparser failed after {MAX_RETRIES} retries: {feed_url}")
-
-def bulk_write_with_backoff(ops):
-    """Mongo bulk_write with exponential backoff on transient errors."""
-    last_err = None
-    for i in range(MAX_RETRIES):
-        try:
-            return coll.bulk_write(ops, ordered=False)
-        except (AutoReconnect, ConnectionFailure, NetworkTimeout, ExecutionTimeout, BulkWriteError) as e:
+        except (AutoReconnect, ConnectionFailure, NetworkTimeout, ExecutionTimeout) as e:
             last_err = e
             logging.warning("Mongo bulk_write transient error: %s; retry %d/%d", e, i + 1, MAX_RETRIES)
             _sleep_backoff(i)
@@ -192,9 +769,7 @@ def bulk_write_with_backoff(ops):
 
 # ====== 摘要与内容抽取（来自“文件1”）======
 _SENT_SPLIT = re.compile(r"(?<=[。！？!?\.])\s+")
-_ONLY_PUNCT = re.compile(r"^\W+$")
 _BRACE_NOISE = re.compile(r"[\{\}\(\)\[\]\|\/\\]{3,}")
-_JS_SNIPPET  = re.compile(r"(?:^|[\s;])!?\s*function\s*\(", re.I)
 _MULTI_SPACE = re.compile(r"\s{2,}")
 _BRAND_TAIL  = re.compile(r"\s*\|\s*MSRC\s*Blog\s*\|\s*Microsoft\s*Security\s*Response\s*Center.*$", re.I)
 
@@ -206,23 +781,8 @@ def _strip_noise(text: str) -> str:
     return text.strip()
 
 def _is_human_line(t: str) -> bool:
-    """Heuristics to drop nav/cookie/boilerplate lines."""
-    if not t or len(t) < 6:
-        return False
-    if _ONLY_PUNCT.match(t):
-        return False
-    if _BRACE_NOISE.search(t):
-        return False
-    if _JS_SNIPPET.search(t):
-        return False
-    low = t.lower()
-    for k in (
-        "cookie", "privacy", "terms", "navigation", "skip to content",
-        "microsoft security response center", "msrc blog", "rss", "search"
-    ):
-        if k in low:
-            return False
-    return True
+    """Heuristics to drop nav/cookie/boilerplate lines (see text_signals)."""
+    return is_human_line(t)
 
 def _brand_tail_cut(s: str) -> str:
     """Remove brand/site suffixes from titles."""
@@ -244,149 +804,846 @@ def make_summary(text: str, max_chars: int = 260, max_sents: int = 3) -> str:
         brief = brief[:max_chars].rstrip() + "..."
     return brief
 
-def extract_main_content(html_doc: str) -> tuple[str, str]:
+# ====== 单次解析的 HTML 抽取引擎（lxml）======
+# 每个页面只解析一次：title、站点特化选择器、通用容器回退以及 readability 都复用同一棵树。
+def _has_class(name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+if _etree is not None:
+    _HTML_PARSER = _lxml_html.HTMLParser(encoding="utf-8", remove_comments=True)
+    _XP_TITLE = _etree.XPath("//title")
+    _XP_NOISE = _etree.XPath("//script | //style | //noscript | //template")
+    _XP_MSRC_P = _etree.XPath(f"(//div[{_has_class('blog-post-content')}])[1]//p")
+    # 依次尝试：#content.site-content article，找不到再用 #primary.site-content article（同旧版 select_one(A) or select_one(B)；
+    # 不能写成 (A | B)[1]，那样取的是文档顺序中的第一个）
+    _XP_KREBS_ARTICLES = [_etree.XPath(f"(//*[@id='{i}' and {_has_class('site-content')}]//article)[1]")
+                          for i in ("content", "primary")]
+    _XP_P = _etree.XPath(".//p")
+    _XP_ARTICLE_P = _etree.XPath("(//article)[1]//p")
+    _XP_LINES = _etree.XPath(".//p | .//li")
+    # 与旧版 CSS 选择器列表一一对应（顺序保持，嵌套容器会重复计入，同旧行为）
+    _XP_CONTAINERS = [_etree.XPath(x) for x in (
+        "//article", "//main", f"//*[{_has_class('entry-content')}]", f"//*[{_has_class('post-content')}]",
+        f"//*[{_has_class('article-content')}]", f"//*[{_has_class('content')}]", "//*[@id='content']",
+        f"//*[{_has_class('post-body')}]",
+        f"//*[{_has_class('blog-post-content')}]",  # MSRC
+    )]
+
+if Document is not None:
+    try:
+        from readability.cleaners import html_cleaner as _rd_cleaner  # type: ignore
+        from readability.readability import shorten_title as _rd_shorten_title  # type: ignore
+
+        class _TreeDocument(Document):  # type: ignore[misc, valid-type]
+            """readability Document fed with a parsed tree: every pass deep-copies it instead of re-parsing."""
+
+            def _parse(self, input):
+                doc = _rd_cleaner.clean_html(input)  # Cleaner.clean_html deep-copies element input
+                doc.resolve_base_href(handle_failures=self.handle_failures)
+                return doc
+    except Exception:
+        _TreeDocument = None
+        _rd_shorten_title = None
+else:
+    _TreeDocument = None
+    _rd_shorten_title = None
+
+def _node_text(node) -> str:
+    return clean_text(" ".join(node.itertext()))
+
+class HtmlPage:
+    """A fetched page parsed once with lxml; extract_* functions accept it in place of a str."""
+
+    def __init__(self, html_doc: str):
+        self.html = html_doc or ""
+        self.root = None
+        if _etree is not None and self.html.strip():
+            try:
+                self.root = _lxml_html.document_fromstring(self.html.encode("utf-8", "replace"), parser=_HTML_PARSER)
+            except Exception:
+                self.root = None
+        self._title = None
+        self._short_title = None
+        self._denoised = False
+
+    @property
+    def title(self) -> str:
+        """<title> text, brand suffix removed."""
+        if self._title is None:
+            t = _XP_TITLE(self.root) if self.root is not None else []
+            self._title = _brand_tail_cut(_node_text(t[0])) if t else ""
+        return self._title
+
+    @property
+    def short_title(self) -> str:
+        """readability's shortened title (falls back to <title>)."""
+        if self._short_title is None:
+            t = ""
+            if self.root is not None and _rd_shorten_title is not None:
+                try:
+                    t = clean_text(_rd_shorten_title(self.root) or "")
+                except Exception:
+                    t = ""
+            self._short_title = _brand_tail_cut(t) or self.title
+        return self._short_title
+
+    def denoise(self):
+        """Drop script/style/noscript/template in place (once)."""
+        if self.root is not None and not self._denoised:
+            for el in _XP_NOISE(self.root):
+                el.drop_tree()
+            self._denoised = True
+
+    def readability_root(self):
+        """readability's main-content fragment, parsed from its (small) summary output."""
+        if self.root is None or _TreeDocument is None:
+            return None
+        try:
+            summary_html = _TreeDocument(self.root).summary(html_partial=True)
+            return _lxml_html.fragment_fromstring(summary_html, create_parent="div")
+        except Exception:
+            return None
+
+def _as_page(html_doc) -> HtmlPage:
+    return html_doc if isinstance(html_doc, HtmlPage) else HtmlPage(html_doc)
+
+def _human_lines(nodes, ban_substr=()) -> list[str]:
+    out = []
+    for n in nodes:
+        t = _node_text(n)
+        if ban_substr and any(b in t for b in ban_substr):
+            continue
+        t = _brand_tail_cut(_strip_noise(t))
+        if _is_human_line(t):
+            out.append(t)
+    return out
+
+def extract_main_content(html_doc) -> tuple[str, str]:
     """
-    Returns (title, text_without_scripts):
-    - Use readability to get the main article area
+    Returns (title, text_without_scripts) from a str or HtmlPage:
+    - Use readability (on the already-parsed tree) to get the main article area
     - Prefer paragraph/list text from common containers (incl. .blog-post-content)
     - Line-level denoising
     """
-    title, text = "", ""
+    page = _as_page(html_doc)
     try:
-        # 动态导入，避免全局硬依赖
-        from readability import Document as _Doc  # type: ignore
-        from bs4 import BeautifulSoup as _BS     # type: ignore
-
-        doc = _Doc(html_doc)
-        title = clean_text(doc.short_title() or "")
-        summary_html = doc.summary(html_partial=True)
-        soup = _BS(summary_html, "html.parser")
-
-        for tag in soup(["script", "style", "noscript", "template"]):
-            tag.decompose()
-
-        containers = []
-        for sel in [
-            "article", "main", ".entry-content", ".post-content",
-            ".article-content", ".content", "#content", ".post-body",
-            ".blog-post-content"  # MSRC
-        ]:
-            containers.extend(soup.select(sel))
+        if page.root is None:
+            raise ValueError("unparseable page")
+        title = page.short_title
+
+        area = page.readability_root()
+        if area is None:
+            page.denoise()
+            area = page.root
+        else:
+            for el in _XP_NOISE(area):
+                el.drop_tree()
 
         lines = []
-        def push_lines(node):
-            for p in node.select("p, li"):
-                t = clean_text(p.get_text(" "))
-                t = _brand_tail_cut(_strip_noise(t))
-                if _is_human_line(t):
-                    lines.append(t)
-
-        if containers:
-            for c in containers:
-                push_lines(c)
+        for xp in _XP_CONTAINERS:
+            for c in xp(area):
+                lines.extend(_human_lines(_XP_LINES(c)))
 
         if not lines:
-            all_text = clean_text(soup.get_text(" "))
-            all_text = _brand_tail_cut(_strip_noise(all_text))
+            all_text = _brand_tail_cut(_strip_noise(_node_text(area)))
             primer = _first_good_sentences(all_text, max_sents=6)
             lines = [primer] if primer else []
 
-        text = " ".join(lines)
-        text = _strip_noise(text)
-
-        if not title:
-            soup2 = _BS(html_doc, "html.parser")
-            t = soup2.find("title")
-            if t:
-                title = clean_text(t.get_text())
-        title = _brand_tail_cut(title)
-
+        text = _strip_noise(" ".join(lines))
     except Exception:
         title = ""
-        text = clean_text(re.sub("<[^>]+>", " ", html_doc))
+        text = clean_text(re.sub("<[^>]+>", " ", page.html))
         text = _brand_tail_cut(_strip_noise(text))
 
     return title, text
 
-def extract_msrc_body(html_doc: str) -> str:
-    # MSRC 特化
-    try:
-        from bs4 import BeautifulSoup as _BS  # type: ignore
-        soup = _BS(html_doc, "html.parser")
-
-        box = soup.select_one("div.blog-post-content")
-        paras = []
-        if box:
-            for p in box.select("p"):
-                t = clean_text(p.get_text(" "))
-                t = _brand_tail_cut(_strip_noise(t))
-                if _is_human_line(t):
-                    paras.append(t)
-        raw = " ".join(paras[:3]).strip()
-        if not raw:
-            _, full = extract_main_content(html_doc)
-            raw = full
-        return raw
-    except Exception:
-        _, full = extract_main_content(html_doc)
-        return full
-
-def extract_krebs_body(html_doc: str) -> str:
+def extract_msrc_body(html_doc) -> str:
+    # MSRC 特化：div.blog-post-content 内前 3 段；否则复用同一棵树做通用抽取
+    page = _as_page(html_doc)
+    if page.root is not None:
+        raw = " ".join(_human_lines(_XP_MSRC_P(page.root))[:3]).strip()
+        if raw:
+            return raw
+    _, full = extract_main_content(page)
+    return full
+
+def extract_krebs_body(html_doc) -> str:
     """
     Pull a few paragraphs from #content.site-content (or #primary.site-content) article,
-    dropping WordPress emoji init noise.
+    dropping WordPress emoji init noise. Lines go through _brand_tail_cut like the
+    other extractors (the bs4 version skipped it for Krebs).
     """
-    try:
-        from bs4 import BeautifulSoup as _BS  # type: ignore
-        soup = _BS(html_doc, "html.parser")
+    page = _as_page(html_doc)
+    if page.root is not None:
+        ban_substr = ("wpemojiSettings", "s.w.org/images/core/emoji", "SVGAnimated")
+        article = next((a[0] for a in (xp(page.root) for xp in _XP_KREBS_ARTICLES) if a), None)
+        paras = _XP_P(article) if article is not None else []
+        raw = " ".join(_human_lines(paras, ban_substr)[:3]).strip()
+        if raw:
+            return raw
+    _, full = extract_main_content(page)
+    return full
+
+# ---------- 近重复检测（MinHash-LSH）：同一公告经 MSRC / 用户 RSS 镜像 / Krebs 多次入库时聚类 ----------
+# 特征 = 标题 + 正文的词与相邻词对；64 个 MinHash 签名，分 16 段 × 4 行做 LSH（lsh_bands，多键索引）。
+# 同段即为候选，再用签名估计 Jaccard，≥ NEAR_DUP_MIN_JACCARD 判为近重复。
+# （SimHash 在 ~260 字符的摘要上一词之差就会漂移 5~10 位，区分度不如 MinHash。）
+# 近重复文档：dup_of = cluster_id = 规范条目的 source_id（策划来源优先于 per-user 源，其次最早入库；
+# 只在 allowed_roles 相同的条目之间聚类）；规范条目 cluster_id = 自身 source_id。
+_MH_PERMS, _MH_ROWS = 64, 4
+_MH_PRIME = (1 << 61) - 1
+_mh_rng = random.Random(0x5EED)   # 固定种子：签名必须跨进程、跨版本稳定
+_MH_A = [_mh_rng.randrange(1, _MH_PRIME) for _ in range(_MH_PERMS)]
+_MH_B = [_mh_rng.randrange(0, _MH_PRIME) for _ in range(_MH_PERMS)]
+_NEAR_DUP_FIELDS = ("minhash", "lsh_bands", "cluster_id", "dup_of", "dup_source")
+
+def _source_rank(source: str | None) -> int:
+    """Which copy of an article wins (lower first): curated sites before per-user feeds."""
+    return 1 if source == "user" else 0
+
+def _roles_cover(a, b) -> bool:
+    """Everyone allowed to see a doc with allowed_roles `b` may also see one with `a`."""
+    return set(a or ()) >= set(b or ())
+
+def _shadowing_copy(copies, source_id: str, source: str | None, roles):
+    """
+    Another stored copy of the same canonical URL that makes this one redundant:
+    ranked at least as high (_source_rank) and visible to every role this one is.
+    A copy with narrower visibility never shadows, so both are kept then.
+    """
+    for c in copies:
+        if c["source_id"] != source_id and _source_rank(c.get("source")) <= _source_rank(source) \
+                and _roles_cover(c.get("allowed_roles"), roles):
+            return c
+    return None
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+def minhash(text: str) -> list[int] | None:
+    """64 MinHash values over words + word pairs; None if the text is too short to be meaningful."""
+    words = _WORD_RE.findall((text or "").lower())
+    if len(words) < NEAR_DUP_MIN_WORDS:
+        return None
+    feats = set(words) | {f"{x} {y}" for x, y in zip(words, words[1:])}
+    xs = [int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "big") for f in feats]
+    return [min((a * x + b) % _MH_PRIME for x in xs) & 0xFFFFFFFF for a, b in zip(_MH_A, _MH_B)]
 
-        container = soup.select_one("#content.site-content article") or \
-                    soup.select_one("#primary.site-content article")
+def _lsh_bands(sig: list[int]) -> list[str]:
+    out = []
+    for i in range(0, _MH_PERMS, _MH_ROWS):
+        rows = ",".join(map(str, sig[i:i + _MH_ROWS]))
+        out.append(f"{i // _MH_ROWS}:{hashlib.blake2b(rows.encode(), digest_size=6).hexdigest()}")
+    return out
 
-        ban_substr = ("wpemojiSettings", "s.w.org/images/core/emoji", "SVGAnimated")
-        paras = []
-        if container:
-            for p in container.select("p"):
-                t = clean_text(p.get_text(" "))
-                if any(b in t for b in ban_substr):
-                    continue
-                t = _strip_noise(t)
-                if _is_human_line(t):
-                    paras.append(t)
-
-        raw = " ".join(paras[:3]).strip()
-        if not raw:
-            _, full = extract_main_content(html_doc)
-            raw = full
-        return raw
-    except Exception:
-        _, full = extract_main_content(html_doc)
-        return full
+def _jaccard(s1: list[int], s2: list[int]) -> float:
+    return sum(1 for x, y in zip(s1, s2) if x == y) / _MH_PERMS
 
-def upsert_many(docs):
-    """Bulk upsert by source_id. Returns (inserted_count, matched_count)."""
-    if not docs:
-        return (0, 0)
+def _assign_near_dups(docs: list, stored: dict) -> tuple[int, dict]:
+    """
+    Set minhash / lsh_bands / cluster_id (and dup_of / dup_source for near-duplicates)
+    on the docs of NEAR_DUP_SOURCES. Candidates are stored threats within
+    NEAR_DUP_WINDOW_DAYS sharing an LSH band, plus earlier docs of the same batch,
+    and only with exactly the same allowed_roles: an item is never hidden behind a
+    canonical item that some of its readers cannot see. Docs that already belong to
+    a cluster keep it.
+    The canonical item is the best-ranked source (_source_rank), then the earliest:
+    a curated doc matching a cluster led by a per-user copy takes the lead instead.
+    Returns (number of docs newly marked as duplicates, {old canonical: new canonical});
+    the caller applies the re-pointing with _promote_canonicals once the docs are written.
+    """
+    todo = []
+    for d in docs:
+        if d.get("source") not in NEAR_DUP_SOURCES:
+            continue
+        sig = minhash(f"{d.get('title') or ''} {d.get('content') or ''}")
+        if sig is None:
+            continue
+        d["minhash"], d["lsh_bands"] = sig, _lsh_bands(sig)
+        old = stored.get(d["source_id"]) or {}
+        if old.get("cluster_id"):
+            d["cluster_id"] = old["cluster_id"]
+            if old.get("dup_of"):
+                d["dup_of"], d["dup_source"] = old["dup_of"], old.get("dup_source")
+            continue
+        todo.append(d)
+    if not todo:
+        return 0, {}
+
+    bands = sorted({b for d in todo for b in d["lsh_bands"]})
+    since = datetime.now(timezone.utc) - timedelta(days=NEAR_DUP_WINDOW_DAYS)
+    try:
+        cands = list(coll.find(
+            {"lsh_bands": {"$in": bands}, "timestamp": {"$gte": since}},
+            {"_id": 0, "source_id": 1, "source": 1, "allowed_roles": 1, "minhash": 1, "lsh_bands": 1,
+             "cluster_id": 1, "dup_of": 1},
+        ))
+        # 候选条目所属簇的规范条目来源（规范条目本身可能不在候选中）
+        canon_ids = {c.get("dup_of") or c.get("cluster_id") or c["source_id"] for c in cands}
+        canon_source = {c["source_id"]: c.get("source") for c in cands}
+        missing = sorted(canon_ids - set(canon_source))
+        if missing:
+            for c in coll.find({"source_id": {"$in": missing}}, {"_id": 0, "source_id": 1, "source": 1}):
+                canon_source[c["source_id"]] = c.get("source")
+    except Exception as e:
+        logging.warning("near-dup candidate lookup failed: %s", e)
+        cands, canon_source = [], {}
+    pool = [{"bands": set(c.get("lsh_bands") or ()), "sig": c["minhash"], "sid": c["source_id"],
+             "roles": sorted(c.get("allowed_roles") or ()),
+             "canon": c.get("dup_of") or c.get("cluster_id") or c["source_id"]}
+            for c in cands if c.get("minhash")]
+    for c in pool:
+        c["canon_source"] = canon_source.get(c["canon"])
+
+    dups, promoted = 0, {}
+    for d in todo:
+        roles = sorted(d.get("allowed_roles") or ())
+        best = None
+        for c in pool:
+            if c["sid"] == d["source_id"] or c["roles"] != roles or c["bands"].isdisjoint(d["lsh_bands"]):
+                continue
+            sim = _jaccard(d["minhash"], c["sig"])
+            if sim >= NEAR_DUP_MIN_JACCARD and (best is None or sim > best[0]):
+                best = (sim, c)
+        if best and _source_rank(d.get("source")) < _source_rank(best[1]["canon_source"]):
+            old = best[1]["canon"]
+            promoted[old] = d["source_id"]
+            for c in pool:
+                if c["canon"] == old:
+                    c["canon"], c["canon_source"] = d["source_id"], d.get("source")
+            best = None
+        if best:
+            d["cluster_id"] = d["dup_of"] = best[1]["canon"]
+            d["dup_source"] = best[1]["canon_source"]
+            dups += 1
+        else:
+            d["cluster_id"] = d["source_id"]
+        pool.append({"bands": set(d["lsh_bands"]), "sig": d["minhash"], "sid": d["source_id"], "roles": roles,
+                     "canon": d["cluster_id"], "canon_source": d.get("dup_source") or d.get("source")})
+    if dups or promoted:
+        logging.info("[near_dup] %d of %d docs clustered under an existing item, %d clusters re-led",
+                     dups, len(todo), len(promoted))
+    return dups, promoted
+
+def _promote_canonicals(promoted: dict, docs: list):
+    """Re-point clusters whose lead moved to a better-ranked doc (after that doc was written)."""
+    source_of = {d["source_id"]: d.get("source") for d in docs}
+    ops = [UpdateMany({"cluster_id": old, "source_id": {"$ne": new}},
+                      {"$set": {"cluster_id": new, "dup_of": new, "dup_source": source_of.get(new)}})
+           for old, new in promoted.items()]
+    if ops:
+        bulk_write_with_backoff(ops)
+
+def backfill_near_dups(days: int = NEAR_DUP_WINDOW_DAYS, batch: int = WRITE_BATCH) -> dict:
+    """Fingerprint / cluster stored threats that predate near-dup detection (oldest first)."""
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    cur = coll.find(
+        {"source": {"$in": sorted(NEAR_DUP_SOURCES)}, "timestamp": {"$gte": since}, "minhash": {"$exists": False}},
+        {"_id": 0, "source_id": 1, "source": 1, "allowed_roles": 1, "title": 1, "content": 1},
+    ).sort([("timestamp", 1)])
+    stats = {"scanned": 0, "duplicates": 0, "promoted": 0}
+
+    def _flush(chunk):
+        dups, promoted = _assign_near_dups(chunk, {})
+        stats["duplicates"] += dups
+        stats["promoted"] += len(promoted)
+        ops = [UpdateOne({"source_id": d["source_id"]}, {"$set": {k: d[k] for k in _NEAR_DUP_FIELDS if k in d}})
+               for d in chunk if "minhash" in d]
+        if ops:
+            bulk_write_with_backoff(ops)
+        _promote_canonicals(promoted, chunk)
+
+    chunk = []
+    for d in cur:
+        stats["scanned"] += 1
+        chunk.append(d)
+        if len(chunk) >= batch:
+            _flush(chunk)
+            chunk = []
+    if chunk:
+        _flush(chunk)
+    logging.info("[near_dup] backfill %s", stats)
+    return stats
+
+# 文章型来源：source_id = "<source>:sha1(canonical_url)"，文档带 canonical_url 字段
+CANONICAL_URL_SOURCES = ("krebsonsecurity", "msrc_blog", "exploitdb", "user")
+
+def _repoint_source_ids(renamed: dict | None = None, merged: dict | None = None):
+    """
+    Follow source_id changes in everything that references a threat by source_id
+    (near-dup clusters, html_snapshots.source_id, fetch_retries._id).
+    renamed: {old: new}, the same doc under a new id.
+    merged:  {old: (new, new source)}, the doc was deleted in favour of another copy
+             whose allowed_roles cover its own (callers check _roles_cover): its
+             snapshots move to the survivor, its queued retry is dropped and the members
+             of its near-dup cluster are unclustered (the survivor may be visible to more
+             roles than they are; backfill_near_dups re-clusters them).
+    """
+    renamed, merged = renamed or {}, merged or {}
     ops = []
+    for old, new in renamed.items():
+        ops.append(UpdateMany({"cluster_id": old}, {"$set": {"cluster_id": new}}))
+        ops.append(UpdateMany({"dup_of": old}, {"$set": {"dup_of": new}}))
+    for old in merged:
+        ops.append(UpdateMany({"cluster_id": old},
+                              [{"$set": {"cluster_id": "$source_id"}}, {"$unset": ["dup_of", "dup_source"]}]))
+    for i in range(0, len(ops), WRITE_BATCH):
+        bulk_write_with_backoff(ops[i:i + WRITE_BATCH])
+
+    ops = [UpdateMany({"source_id": old}, {"$set": {"source_id": new}}) for old, new in renamed.items()]
+    ops += [UpdateMany({"source_id": old}, {"$set": {"source_id": new, "source": src}})
+            for old, (new, src) in merged.items()]
+    for i in range(0, len(ops), WRITE_BATCH):
+        bulk_write_with_backoff(ops[i:i + WRITE_BATCH], collection=html_snapshots)
+
+    # fetch_retries 以 source_id 为 _id（不可修改）：按新 _id 重新写入
+    if renamed:
+        for item in fetch_retries.find({"_id": {"$in": list(renamed)}}):
+            new = renamed[item["_id"]]
+            item["doc"] = {**(item.get("doc") or {}), "source_id": new}
+            fetch_retries.replace_one({"_id": new}, {**item, "_id": new}, upsert=True)
+            fetch_retries.delete_one({"_id": item["_id"]})
+    if merged:
+        fetch_retries.delete_many({"_id": {"$in": list(merged)}})
+
+def migrate_canonical_urls() -> dict:
+    """
+    One-off (idempotent) migration to canonical article URLs:
+    - threats of CANONICAL_URL_SOURCES get canonical_url, and hash-form source_ids
+      are recomputed from it; docs sharing a canonical URL are merged (curated source
+      before "user", then earliest timestamp) into a kept copy whose allowed_roles
+      cover theirs, otherwise kept side by side; near-dup clusters,
+      html_snapshots and fetch_retries follow the changes (_repoint_source_ids);
+    - user_rss_items get canonical_url; per owner, rows sharing one are merged
+      (earliest created_at kept);
+    - finally the unique (canonical_url, min_role) / (owner, canonical_url) indexes are created.
+    """
+    stats = {"threats_scanned": 0, "threats_merged": 0, "source_ids_changed": 0,
+             "items_scanned": 0, "items_merged": 0}
+
+    groups: dict[str, list] = {}
+    cur = coll.find({"source": {"$in": list(CANONICAL_URL_SOURCES)}, "url": {"$type": "string"}},
+                    {"_id": 1, "source": 1, "source_id": 1, "allowed_roles": 1, "url": 1, "canonical_url": 1,
+                     "timestamp": 1})
+    for d in cur:
+        stats["threats_scanned"] += 1
+        canon = canonical_url(d["url"])
+        if canon:
+            groups.setdefault(canon, []).append(d)
+
+    epoch = datetime.min.replace(tzinfo=timezone.utc)
+    def _ts(d):
+        t = d.get("timestamp") or epoch
+        return t if t.tzinfo else t.replace(tzinfo=timezone.utc)
+
+    deletes, updates, renamed, merged = [], [], {}, {}
+    for canon, docs in groups.items():
+        docs.sort(key=lambda d: (_source_rank(d["source"]), _ts(d)))
+        kept = []   # [(doc, new source_id)]
+        for d in docs:
+            into = next(((k, sid) for k, sid in kept if _roles_cover(k.get("allowed_roles"), d.get("allowed_roles"))),
+                        None)
+            if into is not None:
+                deletes.append(DeleteOne({"_id": d["_id"]}))
+                if d["source_id"] != into[1]:
+                    merged[d["source_id"]] = (into[1], into[0]["source"])
+                stats["threats_merged"] += 1
+                continue
+            sid = d["source_id"]
+            if sid == _legacy_source_id(d["source"], d["url"]):
+                sid = _source_id(d["source"], d["url"])
+                if any(sid == k_sid for _, k_sid in kept):
+                    sid = d["source_id"]   # 同来源、可见范围不同的两份副本：保留旧 id，避免 source_id 冲突
+            kept.append((d, sid))
+            if d["source_id"] != sid:
+                renamed[d["source_id"]] = sid
+                stats["source_ids_changed"] += 1
+            if d["source_id"] != sid or d.get("canonical_url") != canon:
+                updates.append(UpdateOne({"_id": d["_id"]}, {"$set": {"source_id": sid, "canonical_url": canon}}))
+
+    # 先删重复、再改 source_id，避免与 source_id 唯一索引冲突
+    for i in range(0, len(deletes), WRITE_BATCH):
+        bulk_write_with_backoff(deletes[i:i + WRITE_BATCH])
+    for i in range(0, len(updates), WRITE_BATCH):
+        bulk_write_with_backoff(updates[i:i + WRITE_BATCH])
+    _repoint_source_ids(renamed, merged)
+
+    item_groups: dict[tuple, list] = {}
+    cur = user_rss_items.find({"url": {"$type": "string"}},
+                              {"_id": 1, "owner_username": 1, "url": 1, "canonical_url": 1, "created_at": 1})
+    for d in cur:
+        stats["items_scanned"] += 1
+        canon = canonical_url(d["url"])
+        if canon:
+            item_groups.setdefault((d.get("owner_username"), canon), []).append(d)
+    ops = []
+    for (_, canon), docs in item_groups.items():
+        docs.sort(key=lambda d: (d.get("created_at") is None, d.get("created_at") or epoch))
+        ops.extend(DeleteOne({"_id": d["_id"]}) for d in docs[1:])
+        stats["items_merged"] += len(docs) - 1
+        if docs[0].get("canonical_url") != canon:
+            ops.append(UpdateOne({"_id": docs[0]["_id"]}, {"$set": {"canonical_url": canon}}))
+    for i in range(0, len(ops), WRITE_BATCH):
+        bulk_write_with_backoff(ops[i:i + WRITE_BATCH], collection=user_rss_items)
+
+    _ensure_canonical_url_indexes()
+    logging.info("[canonical_url] migration %s", stats)
+    return stats
+
+# 每次抓取都会变化、但不代表内容变化的字段（不参与 content_hash）
+_VOLATILE_FIELDS = ("timestamp", "content_hash") + _NEAR_DUP_FIELDS
+
+def _content_hash(d: dict) -> str:
+    return _fingerprint({k: v for k, v in d.items() if k not in _VOLATILE_FIELDS})
+
+def upsert_many(docs, raise_errors: bool = False):
+    """
+    Bulk upsert by source_id, skipping docs whose stored content_hash is unchanged
+    (unless flagged stale). Returns (inserted_count, updated_count, skipped_count).
+    One article is stored once per canonical_url and visibility: a doc shadowed by
+    another copy (_shadowing_copy) is skipped; a copy it outranks and whose roles it
+    covers (curated source vs per-user feed) is replaced; otherwise both are kept.
+    Docs still stored under their legacy source_id are renamed in place.
+    A failed bulk_write is logged and counted as nothing written, or re-raised
+    with raise_errors=True (BatchWriter needs to know before running a Checkpoint).
+    Duplicate-key errors alone (a concurrent crawler stored the same canonical_url
+    first) are not failures: those docs count as skipped.
+    """
+    if not docs:
+        return (0, 0, 0)
+    by_sid, aliases = {}, {}
     for d in docs:
+        d["content_hash"] = _content_hash(d)
+        by_sid[d["source_id"]] = d   # 同批重复 source_id：保留最后一条
+        if d.get("canonical_url") and d.get("url"):
+            lid = _legacy_source_id(d["source_id"].split(":", 1)[0], d["url"])
+            if lid != d["source_id"]:
+                aliases[lid] = d["source_id"]
+
+    urls = [d["canonical_url"] for d in by_sid.values() if d.get("canonical_url")]
+    try:
+        cur = coll.find(
+            {"$or": [{"source_id": {"$in": list(by_sid) + list(aliases)}}, {"canonical_url": {"$in": urls}}]},
+            {"_id": 0, "source_id": 1, "source": 1, "allowed_roles": 1, "canonical_url": 1, "content_hash": 1,
+             "stale": 1, "cluster_id": 1, "dup_of": 1, "dup_source": 1},
+        )
+        stored, url_owner, renames = {}, {}, {}
+        for x in cur:
+            if x["source_id"] in aliases:
+                renames[aliases[x["source_id"]]] = x
+            else:
+                stored[x["source_id"]] = x
+            if x.get("canonical_url"):
+                url_owner.setdefault(x["canonical_url"], []).append(x)
+        for sid in [sid for sid in renames if sid in stored]:
+            del renames[sid]   # 新旧 source_id 都存在时只写新的（旧的由 migrate_canonical_urls 合并）
+        for sid, x in renames.items():
+            stored[sid] = x
+        renames = {sid: x["source_id"] for sid, x in renames.items()}
+    except Exception as e:
+        logging.warning("content_hash lookup failed, writing all docs: %s", e)
+        stored, url_owner, renames = {}, {}, {}
+
+    changed, claimed, replaced = [], {}, {}
+    for d in sorted(by_sid.values(), key=lambda d: _source_rank(d.get("source"))):
+        sid = d["source_id"]
+        old = stored.get(sid)
+        if old and old.get("content_hash") == d["content_hash"] and not old.get("stale"):
+            continue
+        canon = d.get("canonical_url")
+        if canon:
+            roles = d.get("allowed_roles")
+            copies = [c for c in url_owner.get(canon, []) if c["source_id"] not in replaced]
+            # 同批中排名更高（或更早）的条目、或已入库的其他来源副本已覆盖本条的可见范围
+            if _shadowing_copy(claimed.get(canon, []) + copies, sid, d.get("source"), roles):
+                continue
+            for c in copies:
+                if c["source_id"] != sid and _source_rank(d.get("source")) < _source_rank(c.get("source")) \
+                        and _roles_cover(roles, c.get("allowed_roles")):
+                    replaced[c["source_id"]] = d
+            claimed.setdefault(canon, []).append(d)
+        changed.append(d)
+
+    try:
+        if replaced:
+            # 先删除被替换的 per-user 副本，腾出 (canonical_url, min_role) 唯一索引
+            bulk_write_with_backoff([DeleteOne({"source_id": old}) for old in replaced])
+            _repoint_source_ids(merged={old: (d["source_id"], d.get("source")) for old, d in replaced.items()})
+            logging.info("[canonical_url] %d per-user feed copies replaced by curated sources", len(replaced))
+    except Exception as e:
+        logging.error("Mongo replace of per-user copies failed: %s", e)
+        if raise_errors:
+            raise
+        return (0, 0, len(docs))
+    _, promoted = _assign_near_dups(changed, stored)
+
+    ops = []
+    for d in changed:
+        sid = d["source_id"]
+        if sid in renames:
+            ops.append(UpdateOne(
+                {"source_id": renames[sid]},
+                {"$set": {k: v for k, v in d.items() if k != "source"}, "$unset": {"stale": ""}},
+            ))
+            continue
         ops.append(UpdateOne(
-            {"source_id": d["source_id"]},
+            {"source_id": sid},
             {
-                "$setOnInsert": {"source_id": d["source_id"], "source": d.get("source")},
+                "$setOnInsert": {"source_id": sid, "source": d.get("source")},
                 "$set": {k: v for k, v in d.items() if k not in ("source_id", "source")},
+                "$unset": {"stale": ""},
             },
             upsert=True,
         ))
+    skipped = len(docs) - len(ops)
+    if not ops:
+        return (0, 0, skipped)
+    lost = set()
     try:
         res = bulk_write_with_backoff(ops)
         ins = getattr(res, "upserted_count", 0)
-        return ins, len(ops) - ins
+    except BulkWriteError as e:
+        if not _only_duplicate_keys(e):
+            logging.error("Mongo bulk_write error: %s", e)
+            if raise_errors:
+                raise
+            return (0, 0, skipped)
+        # 并发爬虫先写入了同一 (canonical_url, min_role)：这些条目视为已有归属（跳过），其余写入照常生效
+        ins = int(e.details.get("nUpserted") or 0)
+        lost = {changed[w["index"]]["source_id"] for w in e.details["writeErrors"]}
+        logging.info("[canonical_url] %d docs already stored by a concurrent writer, skipped", len(lost))
+    except Exception as e:
+        logging.error("Mongo bulk_write error: %s", e)
+        if raise_errors:
+            raise
+        return (0, 0, skipped)
+    written = {d["source_id"] for d in changed} - lost
+    try:
+        _repoint_source_ids(renamed={old: sid for sid, old in renames.items() if sid in written})
+        _promote_canonicals({old: new for old, new in promoted.items() if new in written}, changed)
     except Exception as e:
         logging.error("Mongo bulk_write error: %s", e)
-        return (0, 0)
+        if raise_errors:
+            raise
+    return ins, len(ops) - len(lost) - ins, skipped + len(lost)
+
+# ---------- 原始 HTML 快照：改进抽取规则后可离线重新抽取，无需重新下载 ----------
+# 索引文档（html_snapshots, _id=URL）：body_hash / codec / size / raw_size / encoding / source / source_id / fetched_at
+# 正文块按 body_hash（sha256 原始字节）内容寻址，同一正文只存一份。
+_snapshot_fs = None
+_snapshot_fs_lock = threading.Lock()
+
+def _snapshot_gridfs():
+    global _snapshot_fs
+    with _snapshot_fs_lock:
+        if _snapshot_fs is None:
+            _snapshot_fs = gridfs.GridFS(db, collection="html_snapshots_fs")
+        return _snapshot_fs
+
+def _compress(raw: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if _zstd is None:
+            raise RuntimeError("zstandard is not installed (pip install zstandard)")
+        return _zstd.ZstdCompressor(level=10).compress(raw)
+    return gzip.compress(raw, compresslevel=6)
+
+def _decompress(blob: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if _zstd is None:
+            raise RuntimeError("zstandard is not installed (pip install zstandard)")
+        return _zstd.ZstdDecompressor().decompress(blob)
+    return gzip.decompress(blob)
+
+def _snapshot_path(body_hash: str, codec: str) -> Path:
+    return SNAPSHOT_DIR / body_hash[:2] / f"{body_hash}.{'zst' if codec == 'zstd' else 'gz'}"
+
+def _put_blob(body_hash: str, codec: str, blob: bytes):
+    if SNAPSHOT_STORE == "local":
+        path = _snapshot_path(body_hash, codec)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(path.suffix + f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(blob)
+        os.replace(tmp, path)
+    else:
+        fs = _snapshot_gridfs()
+        if not fs.exists({"filename": body_hash}):
+            try:
+                # 固定 _id：并发写入同一正文只会留下一份
+                fs.put(blob, _id=f"{body_hash}.{codec}", filename=body_hash, codec=codec)
+            except gridfs.errors.FileExists:
+                pass
+
+def _get_blob(body_hash: str, codec: str) -> bytes | None:
+    try:
+        if SNAPSHOT_STORE == "local":
+            return _snapshot_path(body_hash, codec).read_bytes()
+        return _snapshot_gridfs().get_last_version(filename=body_hash).read()
+    except (OSError, gridfs.errors.NoFile):
+        return None
+
+def _delete_blob(body_hash: str, codec: str):
+    if SNAPSHOT_STORE == "local":
+        _snapshot_path(body_hash, codec).unlink(missing_ok=True)
+    else:
+        fs = _snapshot_gridfs()
+        for f in fs.find({"filename": body_hash}):
+            fs.delete(f._id)
+
+def _count_snapshot_bytes(delta: int):
+    """Adjust the running blob byte total (no-op until evict_snapshots has counted it once)."""
+    if delta:
+        try:
+            sync_state.update_one({"_id": "html_snapshots", "bytes": {"$exists": True}}, {"$inc": {"bytes": delta}})
+        except Exception as e:
+            logging.warning("snapshot byte count update failed: %s", e)
 
-def _entry_datetime(e):
-    """Build a timezone-aware datetime from feed entry, fallback to now."""
+def _claim_blob(body_hash: str, codec: str, size: int) -> bool:
+    """Writer side: mark a blob live before storing it; False while a release is deleting it."""
+    now = datetime.now(timezone.utc)
+    try:
+        res = html_snapshot_blobs.update_one(
+            {"_id": body_hash, "$or": [
+                {"state": "live"},
+                {"since": {"$lt": now - timedelta(seconds=SNAPSHOT_DELETE_STALE_SECONDS)}},
+            ]},
+            {"$set": {"state": "live", "codec": codec, "since": now}, "$setOnInsert": {"size": size}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False
+    if res.upserted_id is not None:
+        _count_snapshot_bytes(size)   # 新正文块；已存在的块（去重）不重复计数
+    return True
+
+def _blob_live(body_hash: str) -> bool:
+    return html_snapshot_blobs.find_one({"_id": body_hash, "state": "live"}, {"_id": 1}) is not None
+
+def save_snapshot(url: str, resp: requests.Response, source: str, source_id: str | None = None):
+    """
+    Keep the compressed raw body of a successfully fetched article (best effort).
+    Unchanged bodies (same URL + body_hash) only refresh fetched_at.
+    The blob is claimed live (_claim_blob) before it is stored and still live after
+    the index doc points at it; otherwise a concurrent _release_blob may have deleted
+    it, and the snapshot is dropped rather than left dangling.
+    """
+    if SNAPSHOT_STORE == "off" or resp is None or not resp.content:
+        return
+    raw = resp.content
+    body_hash = hashlib.sha256(raw).hexdigest()
+    now = datetime.now(timezone.utc)
+    try:
+        cur = html_snapshots.find_one({"_id": url}, {"body_hash": 1, "codec": 1})
+        if cur and cur.get("body_hash") == body_hash:
+            html_snapshots.update_one({"_id": url}, {"$set": {"fetched_at": now}})
+            return
+        blob = _compress(raw, SNAPSHOT_CODEC)
+        if not _claim_blob(body_hash, SNAPSHOT_CODEC, len(blob)):
+            logging.info("snapshot skipped for %s: blob is being deleted", url)
+            return
+        _put_blob(body_hash, SNAPSHOT_CODEC, blob)
+        html_snapshots.update_one(
+            {"_id": url},
+            {"$set": {
+                "body_hash": body_hash,
+                "codec": SNAPSHOT_CODEC,
+                "size": len(blob),
+                "raw_size": len(raw),
+                "encoding": resp.encoding or "utf-8",
+                "source": source,
+                "source_id": source_id,
+                "fetched_at": now,
+            }},
+            upsert=True,
+        )
+        if not _blob_live(body_hash):
+            html_snapshots.delete_one({"_id": url, "body_hash": body_hash})
+            _release_blob(body_hash, SNAPSHOT_CODEC)
+            logging.info("snapshot dropped for %s: blob deleted concurrently", url)
+        if cur and cur.get("body_hash"):
+            _release_blob(cur["body_hash"], cur.get("codec") or "gzip")
+    except Exception as e:
+        logging.warning("snapshot save failed for %s: %s", url, e)
+
+def _release_blob(body_hash: str, codec: str):
+    """
+    Delete a blob once no snapshot references it any more. The blob is marked
+    "deleting" before the reference check, so a concurrent save_snapshot either
+    fails to claim it or notices the mark after writing its index doc.
+    """
+    now = datetime.now(timezone.utc)
+    mark = os.urandom(8).hex()
+    try:
+        html_snapshot_blobs.update_one(
+            {"_id": body_hash, "$or": [
+                {"state": {"$ne": "deleting"}},
+                {"since": {"$lt": now - timedelta(seconds=SNAPSHOT_DELETE_STALE_SECONDS)}},
+            ]},
+            {"$set": {"state": "deleting", "codec": codec, "since": now, "mark": mark}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return   # 另一个进程正在删除
+    if html_snapshots.find_one({"body_hash": body_hash}, {"_id": 1}):
+        html_snapshot_blobs.update_one({"_id": body_hash, "mark": mark}, {"$set": {"state": "live"}})
+        return
+    size = (html_snapshot_blobs.find_one({"_id": body_hash, "mark": mark}, {"size": 1}) or {}).get("size")
+    _delete_blob(body_hash, codec)
+    if html_snapshot_blobs.delete_one({"_id": body_hash, "mark": mark}).deleted_count:
+        _count_snapshot_bytes(-int(size or 0))
+
+def load_snapshot(url: str) -> str | None:
+    """Decoded HTML of the latest snapshot of `url`, or None."""
+    snap = html_snapshots.find_one({"_id": url})
+    if not snap:
+        return None
+    blob = _get_blob(snap["body_hash"], snap["codec"])
+    if blob is None:
+        return None
+    return _decompress(blob, snap["codec"]).decode(snap.get("encoding") or "utf-8", errors="replace")
+
+def evict_snapshots(max_bytes: int = SNAPSHOT_MAX_BYTES) -> dict:
+    """
+    Size-based eviction: while the stored (compressed, de-duplicated) total exceeds
+    max_bytes, drop the blobs whose newest fetch is oldest, with their index docs.
+    The per-blob aggregation only runs when the running byte total (sync_state)
+    is over max_bytes or not counted yet; it then resets the total, which also
+    corrects any drift from interrupted writes.
+    """
+    if SNAPSHOT_STORE == "off":
+        return {"evicted": 0, "bytes": 0}
+    try:
+        counted = (sync_state.find_one({"_id": "html_snapshots"}) or {}).get("bytes")
+        if counted is not None and counted <= max_bytes:
+            return {"evicted": 0, "bytes": counted}
+        blobs = list(html_snapshots.aggregate([
+            {"$group": {"_id": "$body_hash", "size": {"$first": "$size"}, "codec": {"$first": "$codec"},
+                        "last": {"$max": "$fetched_at"}}},
+            {"$sort": {"last": 1}},
+        ], allowDiskUse=True))
+    except Exception as e:
+        logging.warning("snapshot eviction skipped: %s", e)
+        return {"evicted": 0, "bytes": 0}
+    total = sum(int(b.get("size") or 0) for b in blobs)
+    evicted = 0
+    for b in blobs:
+        if total <= max_bytes:
+            break
+        html_snapshots.delete_many({"body_hash": b["_id"]})
+        _release_blob(b["_id"], b["codec"])
+        total -= int(b.get("size") or 0)
+        evicted += 1
+    try:
+        sync_state.update_one({"_id": "html_snapshots"},
+                              {"$set": {"bytes": total, "counted_at": datetime.now(timezone.utc)}}, upsert=True)
+    except Exception as e:
+        logging.warning("snapshot byte count reset failed: %s", e)
+    if evicted:
+        logging.info("[snapshots] evicted %d blobs, %.1f MB kept", evicted, total / 1048576)
+    return {"evicted": evicted, "bytes": total}
+
+def _entry_datetime(e, fallback: datetime | None = None):
+    """Build a timezone-aware datetime from feed entry, fallback (default: now) when undated."""
     try:
         if getattr(e, "published_parsed", None):
             return datetime(*e.published_parsed[:6], tzinfo=timezone.utc)
@@ -394,218 +1651,470 @@ def _entry_datetime(e):
             return datetime(*e.updated_parsed[:6], tzinfo=timezone.utc)
     except Exception:
         pass
+    if fallback is not None:
+        return fallback if fallback.tzinfo else fallback.replace(tzinfo=timezone.utc)
     return datetime.now(timezone.utc)
 
 def _iso8601_z(dt: datetime) -> str:
     return dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
 
+def _source_id(prefix: str, link: str) -> str:
+    return f"{prefix}:{hashlib.sha1(canonical_url(link).encode()).hexdigest()}"
+
+def _legacy_source_id(prefix: str, link: str) -> str:
+    """source_id of docs stored before canonical URLs (sha1 of the raw link)."""
+    return f"{prefix}:{hashlib.sha1(link.encode()).hexdigest()}"
+
+def _known_docs(source_ids, canonical_urls=(), aliases=None) -> tuple[dict, dict]:
+    """
+    One batched lookup of already-stored threats by source_id or canonical_url.
+    `aliases` maps legacy source_ids (_legacy_source_id) to current ones; a doc stored
+    under a legacy id is returned under the current id unless that one exists too.
+    Returns ({source_id: doc}, {canonical_url: [stored copies]}).
+    """
+    source_ids, canonical_urls, aliases = list(source_ids), list(canonical_urls), aliases or {}
+    if not source_ids and not canonical_urls:
+        return {}, {}
+    try:
+        cur = coll.find(
+            {"$or": [{"source_id": {"$in": source_ids + list(aliases)}}, {"canonical_url": {"$in": canonical_urls}}]},
+            {"_id": 0, "source_id": 1, "source": 1, "allowed_roles": 1, "canonical_url": 1, "stale": 1,
+             "timestamp": 1},
+        )
+        by_sid, by_url, legacy = {}, {}, {}
+        for d in cur:
+            if d["source_id"] in aliases:
+                legacy[aliases[d["source_id"]]] = d
+            else:
+                by_sid[d["source_id"]] = d
+            if d.get("canonical_url"):
+                by_url.setdefault(d["canonical_url"], []).append(d)
+        for sid, d in legacy.items():
+            by_sid.setdefault(sid, d)
+        return by_sid, by_url
+    except Exception as e:
+        logging.warning("known source_id lookup failed: %s", e)
+        return {}, {}
+
+def _entries_to_fetch(name: str, entries: list, roles) -> list:
+    """
+    entries: [(feed_entry, link, source_id)]; roles: allowed_roles their docs will get.
+    Keep unseen entries, entries flagged `stale` in Mongo (see reextract_from_snapshots),
+    and stored entries published within ARTICLE_REFRESH_HOURS (recent posts still get
+    edited); an undated entry counts from its stored doc's timestamp.
+    Links whose canonical URL is already stored under another source are dropped
+    when that copy shadows them (_shadowing_copy: ranked at least as high and
+    visible to at least the same roles; see upsert_many).
+    """
+    urls = {item[2]: canonical_url(item[1]) for item in entries}
+    aliases = {}
+    for _, link, sid in entries:
+        lid = _legacy_source_id(sid.split(":", 1)[0], link)
+        if lid != sid:
+            aliases[lid] = sid
+    known, url_owner = _known_docs(urls, urls.values(), aliases)
+    now = datetime.now(timezone.utc)
+    window = timedelta(hours=ARTICLE_REFRESH_HOURS)
+    todo, elsewhere = [], 0
+    for item in entries:
+        if _shadowing_copy(url_owner.get(urls[item[2]], ()), item[2], item[2].split(":", 1)[0], roles):
+            elsewhere += 1
+            continue
+        doc = known.get(item[2])
+        if doc is None or doc.get("stale") or now - _entry_datetime(item[0], doc.get("timestamp")) <= window:
+            todo.append(item)
+    logging.info("[%s] entries=%d known=%d other_source=%d to_fetch=%d",
+                 name, len(entries), len(known), elsewhere, len(todo))
+    return todo
+
 # ---------- 站点爬虫（来自“文件1”）----------
 
-def crawl_cisa_kev(limit=2000):
+def _kev_date(s: str | None, fallback: datetime) -> datetime:
+    try:
+        return datetime.strptime((s or "")[:10], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except Exception:
+        return fallback
+
+def iter_cisa_kev(limit=2000):
+    """
+    Change-aware KEV ingestion:
+      - skip the catalog entirely when catalogVersion/dateReleased match the last run
+      - diff entries by cveID (kev_hash of the raw entry) and yield only added/changed ones
+      - timestamp = dateAdded
+      - the catalog version is recorded through a final Checkpoint, i.e. only after
+        every yielded entry was written, and never when the catalog was truncated
+    """
     logging.info("[cisa_kev] min_role=pro limit=%d", limit)
     urls = [
         "https://www.cisa.gov/sites/default/files/feeds/known_exploited_vulnerabilities.json",
         "https://www.cisa.gov/sites/default/files/feeds/known_exploited_vulnerabilities.csv.json",
     ]
-    docs, now = [], datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc)
     for url in urls:
         try:
-            r = http_get(url, timeout=30, headers=UA_HEADERS)
+            r = http_get_cached(url, source="cisa_kev", save=False, timeout=30, headers=UA_HEADERS)
+            if r is None:
+                logging.info("[cisa_kev] catalog not modified, skip")
+                break
             r.raise_for_status()
             data = r.json()
+
+            version = {"catalogVersion": data.get("catalogVersion"), "dateReleased": data.get("dateReleased")}
+            state = sync_state.find_one({"_id": "cisa_kev"}) or {}
+            if version["catalogVersion"] and all(state.get(k) == v for k, v in version.items()):
+                logging.info("[cisa_kev] catalog %s unchanged, skip", version["catalogVersion"])
+                remember_validators(url, r, "cisa_kev")
+                break
+
+            stored = {
+                d["source_id"]: d.get("kev_hash")
+                for d in coll.find({"source": "cisa_kev"}, {"_id": 0, "source_id": 1, "kev_hash": 1})
+            }
             vulns = data.get("vulnerabilities") or []
+            added = changed = 0
             for v in vulns[:limit]:
                 cve = v.get("cveID") or v.get("cve") or v.get("cveId")
                 if not cve:
                     continue
+                source_id = f"cisa_kev:{cve}"
+                kev_hash = _fingerprint(v)
+                if source_id not in stored:
+                    added += 1
+                elif stored[source_id] != kev_hash:
+                    changed += 1
+                else:
+                    continue
                 title = f"{cve} - {v.get('vendorProject','')}/{v.get('product','')}"
                 desc = v.get("shortDescription") or v.get("description") or ""
                 page_url = "https://www.cisa.gov/known-exploited-vulnerabilities-catalog"
-                docs.append({
+                yield {
                     "source": "cisa_kev",
-                    "source_id": f"cisa_kev:{cve}",
+                    "source_id": source_id,
                     "title": clean_text(title),
                     "url": page_url,
                     "content": make_summary(desc, max_chars=240),
-                    "timestamp": now,
+                    "timestamp": _kev_date(v.get("dateAdded"), now),
                     "min_role": "pro",
                     "allowed_roles": roles_at_or_above("pro"),
                     "origin": "cisa.gov",
-                })
+                    "kev_hash": kev_hash,
+                }
+            logging.info("[cisa_kev] catalog %s: entries=%d added=%d changed=%d",
+                         version["catalogVersion"], len(vulns), added, changed)
+            if len(vulns) > limit:
+                logging.warning("[cisa_kev] catalog truncated to %d of %d entries; version not recorded",
+                                limit, len(vulns))
+            else:
+                def _commit(url=url, r=r, version=version):
+                    sync_state.update_one(
+                        {"_id": "cisa_kev"},
+                        {"$set": {**version, "updated_at": now}},
+                        upsert=True,
+                    )
+                    remember_validators(url, r, "cisa_kev")
+                yield Checkpoint(_commit, label="cisa_kev catalog version")
             break
         except Exception as e:
             logging.warning("[cisa_kev] fetch fail from %s: %s", url, e)
             continue
-    return docs
 
-def crawl_krebsonsecurity(limit=40):
+def crawl_cisa_kev(limit=2000):
+    return _docs_only(iter_cisa_kev(limit=limit))
+
+def iter_krebsonsecurity(limit=40):
     logging.info("[krebsonsecurity] min_role=public limit=%d", limit)
     feed_url = "https://krebsonsecurity.com/feed/"
-    docs = []
     try:
-        feed = parse_feed_with_backoff(feed_url)
+        feed = parse_feed_with_backoff(feed_url, source="krebsonsecurity")
+        if feed is None:
+            logging.info("[krebsonsecurity] feed not modified, skip")
+            return
+
+        entries = []
         for e in feed.entries[:limit]:
             link = (getattr(e, "link", "") or "").strip()
-            if not link:
-                continue
+            if link:
+                entries.append((e, link, _source_id("krebsonsecurity", link)))
+        entries = _entries_to_fetch("krebsonsecurity", entries, roles_at_or_above("public"))
+
+        def _one(item):
+            e, link, source_id = item
+            deferred = None
             try:
-                r = http_get(link, timeout=25, headers=UA_HEADERS)
-                r.raise_for_status()
+                r = fetch_article(link, timeout=25, source="krebsonsecurity")
+                save_snapshot(link, r, "krebsonsecurity", source_id)
                 raw = extract_krebs_body(r.text)
                 title = clean_text(getattr(e, "title", "") or link)
                 content = make_summary(raw, max_chars=260)
-            except Exception:
+            except Exception as err:
+                deferred = err if isinstance(err, (RetryDeferred, CircuitOpenError)) else None
                 title = clean_text(getattr(e, "title", "") or link)
                 raw = clean_text(getattr(e, "summary", "") or "")
                 content = make_summary(raw, max_chars=260)
-            docs.append({
+            doc = {
                 "source": "krebsonsecurity",
-                "source_id": f"krebsonsecurity:{hashlib.sha1(link.encode()).hexdigest()}",
+                "source_id": source_id,
                 "title": title or link,
                 "url": link,
+                "canonical_url": canonical_url(link),
                 "content": content,
                 "timestamp": datetime.now(timezone.utc),
                 "min_role": "public",
                 "allowed_roles": roles_at_or_above("public"),
                 "origin": urlparse(link).netloc,
-            })
+            }
+            if deferred:
+                enqueue_retry(doc, deferred)
+            return doc
+
+        for d in imap_ordered(_one, entries):
+            if d:
+                yield d
+        yield Checkpoint(feed["commit_validators"], label="krebsonsecurity feed validators")
     except Exception as e:
         logging.error("[krebsonsecurity] error: %s", e)
-    return docs
 
-def crawl_msrc_blog(limit=40):
+def crawl_krebsonsecurity(limit=40):
+    return _docs_only(iter_krebsonsecurity(limit=limit))
+
+def iter_msrc_blog(limit=40):
     logging.info("[msrc_blog] min_role=public limit=%d", limit)
     feed_url = "https://msrc.microsoft.com/blog/feed/"
-    docs = []
     try:
-        feed = parse_feed_with_backoff(feed_url)
+        feed = parse_feed_with_backoff(feed_url, source="msrc_blog")
+        if feed is None:
+            logging.info("[msrc_blog] feed not modified, skip")
+            return
+
+        entries = []
         for e in feed.entries[:limit]:
             link = (getattr(e, "link", "") or "").strip()
-            if not link:
-                continue
+            if link:
+                entries.append((e, link, _source_id("msrc_blog", link)))
+        entries = _entries_to_fetch("msrc_blog", entries, roles_at_or_above("public"))
+
+        def _one(item):
+            e, link, source_id = item
+            deferred = None
             try:
-                r = http_get(link, timeout=25, headers=UA_HEADERS)
-                r.raise_for_status()
-                raw = extract_msrc_body(r.text)  # Only body text (no title)
-                title = clean_text(getattr(e, "title", "") or "") or _brand_tail_cut(clean_text(r.text))
+                r = fetch_article(link, timeout=25, source="msrc_blog")
+                save_snapshot(link, r, "msrc_blog", source_id)
+                page = HtmlPage(r.text)
+                raw = extract_msrc_body(page)  # Only body text (no title)
+                title = clean_text(getattr(e, "title", "") or "") or page.title
                 content = make_summary(raw, max_chars=260, max_sents=3)
                 if not title:
                     title = link
-            except Exception:
+            except Exception as err:
+                deferred = err if isinstance(err, (RetryDeferred, CircuitOpenError)) else None
                 title = clean_text(getattr(e, "title", "") or link)
                 raw = clean_text(getattr(e, "summary", "") or getattr(e, "description", "") or "")
                 content = make_summary(raw, max_chars=260, max_sents=3)
 
-            docs.append({
+            doc = {
                 "source": "msrc_blog",
-                "source_id": f"msrc_blog:{hashlib.sha1(link.encode()).hexdigest()}",
+                "source_id": source_id,
                 "title": title or link,
                 "url": link,
+                "canonical_url": canonical_url(link),
                 "content": content,
                 "timestamp": datetime.now(timezone.utc),
                 "min_role": "public",
                 "allowed_roles": roles_at_or_above("public"),
                 "origin": urlparse(link).netloc,
-            })
+            }
+            if deferred:
+                enqueue_retry(doc, deferred)
+            return doc
+
+        for d in imap_ordered(_one, entries):
+            if d:
+                yield d
+        yield Checkpoint(feed["commit_validators"], label="msrc_blog feed validators")
     except Exception as e:
         logging.error("[msrc_blog] error: %s", e)
-    return docs
 
-def crawl_nvd_recent(days=7, max_items=200):
-    logging.info("[nvd] min_role=admin days=%d max=%d", days, max_items)
-    end = datetime.now(timezone.utc)
-    start = end - timedelta(days=days)
-    params = {
-        "pubStartDate": _iso8601_z(start),
-        "pubEndDate": _iso8601_z(end),
-        "resultsPerPage": min(2000, max_items),
-        "startIndex": 0,
+def crawl_msrc_blog(limit=40):
+    return _docs_only(iter_msrc_blog(limit=limit))
+
+_nvd_calls: deque = deque()
+_nvd_calls_lock = threading.Lock()
+
+def _nvd_throttle():
+    """Block until another request fits NVD's rolling rate window (5/30s, or 50/30s with an API key)."""
+    while True:
+        with _nvd_calls_lock:
+            now = time.monotonic()
+            while _nvd_calls and now - _nvd_calls[0] >= NVD_RATE_WINDOW:
+                _nvd_calls.popleft()
+            if len(_nvd_calls) < NVD_RATE_LIMIT:
+                _nvd_calls.append(now)
+                return
+            wait = NVD_RATE_WINDOW - (now - _nvd_calls[0])
+        time.sleep(max(0.05, wait))
+
+def _nvd_doc(cve: dict, fallback_ts: datetime) -> dict | None:
+    cve_id = cve.get("id")
+    if not cve_id:
+        return None
+
+    desc = ""
+    for d in (cve.get("descriptions") or []):
+        if d.get("lang") == "en":
+            desc = d.get("value", "")
+            break
+
+    metrics = cve.get("metrics") or {}
+    cvss = None
+    for key in ("cvssMetricV31", "cvssMetricV30", "cvssMetricV2"):
+        if metrics.get(key):
+            m = metrics[key][0]
+            data_cvss = m.get("cvssData", {})
+            cvss = {
+                "version": data_cvss.get("version"),
+                "baseScore": data_cvss.get("baseScore"),
+                "baseSeverity": m.get("baseSeverity"),
+                "vectorString": data_cvss.get("vectorString"),
+                "exploitabilityScore": m.get("exploitabilityScore"),
+                "impactScore": m.get("impactScore"),
+            }
+            break
+
+    weaknesses = []
+    for w in (cve.get("weaknesses") or []):
+        for dsc in (w.get("description") or []):
+            val = dsc.get("value")
+            if val:
+                weaknesses.append(val)
+    weaknesses = sorted(set(weaknesses))
+
+    refs = []
+    for rr in (cve.get("references") or []):
+        url = rr.get("url")
+        if url:
+            refs.append(url)
+
+    ts_str = cve.get("published") or cve.get("lastModified")
+    try:
+        ts = datetime.fromisoformat(ts_str.replace("Z", "+00:00"))
+    except Exception:
+        ts = fallback_ts
+
+    return {
+        "source": "nvd",
+        "source_id": f"nvd:{cve_id}",
+        "title": f"{cve_id} - {clean_text(desc)[:120]}",
+        "url": f"https://nvd.nist.gov/vuln/detail/{cve_id}",
+        "content": make_summary(desc, max_chars=260),
+        "timestamp": ts,
+        "min_role": "admin",
+        "allowed_roles": roles_at_or_above("admin"),
+        "origin": "nvd.nist.gov",
+        "nvd_cvss": cvss,
+        "nvd_cwes": weaknesses,
+        "nvd_refs": refs[:10],
+        "nvd_last_modified": cve.get("lastModified"),
     }
-    headers = {"User-Agent": "cti-crawler/1.0"}
-    if NVD_API_KEY:
-        headers["apiKey"] = NVD_API_KEY
 
-    docs = []
+def _nvd_changed(docs: list) -> list:
+    """Drop CVEs whose stored nvd_last_modified already equals the API value."""
+    if not docs:
+        return docs
     try:
-        r = http_get(
-            "https://services.nvd.nist.gov/rest/json/cves/2.0",
-            params=params, headers=headers, timeout=30
+        cur = coll.find(
+            {"source_id": {"$in": [d["source_id"] for d in docs]}},
+            {"_id": 0, "source_id": 1, "nvd_last_modified": 1},
         )
-        r.raise_for_status()
-        data = r.json()
-        vulns = data.get("vulnerabilities") or []
-        for v in vulns[:max_items]:
-            cve = (v.get("cve") or {})
-            cve_id = cve.get("id")
-            if not cve_id:
-                continue
+        stored = {x["source_id"]: x.get("nvd_last_modified") for x in cur}
+    except Exception as e:
+        logging.warning("[nvd] lastModified lookup failed: %s", e)
+        return docs
+    return [d for d in docs if stored.get(d["source_id"]) != d["nvd_last_modified"]]
 
-            desc = ""
-            for d in (cve.get("descriptions") or []):
-                if d.get("lang") == "en":
-                    desc = d.get("value", "")
-                    break
+def iter_nvd_recent(days=7, backfill_days=None):
+    """
+    Incremental NVD sync on lastModified:
+      - window starts at the persisted cursor (sync_state._id="nvd"), or `days` ago on first run
+      - `backfill_days` forces a one-off window of that many days
+      - pages through totalResults in <=120-day chunks, respecting the API rate window
+      - only CVEs whose lastModified differs from the stored copy are yielded
+    After each chunk a Checkpoint moves the cursor to the chunk end; BatchWriter
+    commits it only once that chunk's CVEs were written without errors, so a
+    failed upsert, a fetch error or an abandoned run never skips a window.
+    (Results inside a chunk are not ordered by lastModified, hence per chunk.)
+    """
+    end = datetime.now(timezone.utc)
+    state = {}
+    try:
+        state = sync_state.find_one({"_id": "nvd"}) or {}
+    except Exception as e:
+        logging.warning("[nvd] cursor read failed: %s", e)
+
+    cursor = state.get("last_mod_end")
+    if cursor is not None and cursor.tzinfo is None:
+        cursor = cursor.replace(tzinfo=timezone.utc)
+    if backfill_days:
+        start = end - timedelta(days=backfill_days)
+    elif cursor:
+        start = cursor - NVD_CURSOR_OVERLAP
+    else:
+        start = end - timedelta(days=days)
+    logging.info("[nvd] min_role=admin lastMod %s -> %s%s", _iso8601_z(start), _iso8601_z(end),
+                 " (backfill)" if backfill_days else "")
 
-            metrics = cve.get("metrics") or {}
-            cvss = None
-            for key in ("cvssMetricV31", "cvssMetricV30", "cvssMetricV2"):
-                if metrics.get(key):
-                    m = metrics[key][0]
-                    data_cvss = m.get("cvssData", {})
-                    cvss = {
-                        "version": data_cvss.get("version"),
-                        "baseScore": data_cvss.get("baseScore"),
-                        "baseSeverity": m.get("baseSeverity"),
-                        "vectorString": data_cvss.get("vectorString"),
-                        "exploitabilityScore": m.get("exploitabilityScore"),
-                        "impactScore": m.get("impactScore"),
-                    }
-                    break
+    headers = {"User-Agent": "cti-crawler/1.0"}
+    if NVD_API_KEY:
+        headers["apiKey"] = NVD_API_KEY
 
-            weaknesses = []
-            for w in (cve.get("weaknesses") or []):
-                for dsc in (w.get("description") or []):
-                    val = dsc.get("value")
-                    if val:
-                        weaknesses.append(val)
-            weaknesses = sorted(set(weaknesses))
-
-            refs = []
-            for rr in (cve.get("references") or []):
-                url = rr.get("url")
-                if url:
-                    refs.append(url)
-
-            ts_str = cve.get("published") or cve.get("lastModified")
-            try:
-                ts = datetime.fromisoformat(ts_str.replace("Z", "+00:00"))
-            except Exception:
-                ts = end
-
-            docs.append({
-                "source": "nvd",
-                "source_id": f"nvd:{cve_id}",
-                "title": f"{cve_id} - {clean_text(desc)[:120]}",
-                "url": f"https://nvd.nist.gov/vuln/detail/{cve_id}",
-                "content": make_summary(desc, max_chars=260),
-                "timestamp": ts,
-                "min_role": "admin",
-                "allowed_roles": roles_at_or_above("admin"),
-                "origin": "nvd.nist.gov",
-                "nvd_cvss": cvss,
-                "nvd_cwes": weaknesses,
-                "nvd_refs": refs[:10],
-            })
+    seen = pages = changed = 0
+    try:
+        win_start = start
+        while win_start < end:
+            win_end = min(end, win_start + timedelta(days=NVD_MAX_RANGE_DAYS))
+            start_index = 0
+            while True:
+                params = {
+                    "lastModStartDate": _iso8601_z(win_start),
+                    "lastModEndDate": _iso8601_z(win_end),
+                    "resultsPerPage": NVD_PAGE_SIZE,
+                    "startIndex": start_index,
+                }
+                _nvd_throttle()
+                r = http_get(NVD_API_URL, params=params, headers=headers, timeout=30)
+                r.raise_for_status()
+                data = r.json()
+                pages += 1
+                vulns = data.get("vulnerabilities") or []
+                page_docs = [d for d in (_nvd_doc(v.get("cve") or {}, end) for v in vulns) if d]
+                page_docs = _nvd_changed(page_docs)
+                changed += len(page_docs)
+                yield from page_docs
+                seen += len(vulns)
+                start_index += len(vulns)
+                if not vulns or start_index >= int(data.get("totalResults") or 0):
+                    break
+            if not cursor or win_end > cursor:
+                yield Checkpoint(lambda ts=win_end: sync_state.update_one(
+                    {"_id": "nvd"},
+                    {"$set": {"last_mod_end": ts, "updated_at": datetime.now(timezone.utc)}},
+                    upsert=True,
+                ), label=f"nvd cursor {_iso8601_z(win_end)}")
+            win_start = win_end
     except Exception as e:
-        logging.error("[nvd] error: %s", e)
-    return docs
+        logging.error("[nvd] error (cursor not advanced): %s", e)
+    logging.info("[nvd] pages=%d seen=%d changed=%d", pages, seen, changed)
 
-def crawl_exploitdb(limit=60):
+def crawl_nvd_recent(days=7, backfill_days=None):
+    return _docs_only(iter_nvd_recent(days=days, backfill_days=backfill_days))
+
+def iter_exploitdb(limit=60):
     logging.info("[exploitdb] min_role=admin limit=%d", limit)
     feed_url = "https://www.exploit-db.com/rss.xml"
-    docs = []
     try:
-        feed = parse_feed_with_backoff(feed_url)
+        feed = parse_feed_with_backoff(feed_url, source="exploitdb")
+        if feed is None:
+            logging.info("[exploitdb] feed not modified, skip")
+            return
         for e in feed.entries[:limit]:
             link = (getattr(e, "link", "") or "").strip()
             if not link:
@@ -617,11 +2126,12 @@ def crawl_exploitdb(limit=60):
             summary = clean_text(getattr(e, "summary", "") or getattr(e, "description", "") or "")
             cves = extract_cves(title + " " + summary)
 
-            docs.append({
+            yield {
                 "source": "exploitdb",
-                "source_id": f"exploitdb:{edb_id or hashlib.sha1(link.encode()).hexdigest()}",
+                "source_id": f"exploitdb:{edb_id}" if edb_id else _source_id("exploitdb", link),
                 "title": title,
                 "url": link,
+                "canonical_url": canonical_url(link),
                 "content": make_summary(summary, max_chars=260),
                 "timestamp": _entry_datetime(e),
                 "min_role": "admin",
@@ -629,18 +2139,21 @@ def crawl_exploitdb(limit=60):
                 "origin": urlparse(link).netloc,
                 "edb_id": edb_id,
                 "edb_cves": cves,
-            })
+            }
+        yield Checkpoint(feed["commit_validators"], label="exploitdb feed validators")
     except Exception as e:
         logging.error("[exploitdb] error: %s", e)
-    return docs
 
-def crawl_user_rss(limit_sources=200, max_items_per_feed=40, timeout=25):
+def crawl_exploitdb(limit=60):
+    return _docs_only(iter_exploitdb(limit=limit))
+
+def iter_user_rss(limit_sources=200, max_items_per_feed=40, timeout=25):
     """来自“文件1”的自定义源（custom_sources, mode=rss），写入 threats。"""
     logging.info("[user_rss] crawling enabled RSS sources (deferred)")
     recs = list(
         sources_coll.find({"enabled": True, "mode": "rss"}).sort([("updated_at", -1)]).limit(limit_sources)
     )
-    docs, now = [], datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc)
 
     for rcd in recs:
         feed_url = rcd.get("url")
@@ -648,39 +2161,61 @@ def crawl_user_rss(limit_sources=200, max_items_per_feed=40, timeout=25):
         if role not in ROLES:
             role = "public"
         try:
-            feed = parse_feed_with_backoff(feed_url)
-            cnt = 0
+            feed = parse_feed_with_backoff(feed_url, source="user_rss")
+            if feed is None:
+                sources_coll.update_one(
+                    {"_id": rcd["_id"]},
+                    {"$set": {"last_crawled": now, "last_status": "not_modified"}}
+                )
+                logging.info("[user_rss] %s -> not modified", feed_url)
+                continue
+            entries = []
             for e in feed.entries:
-                if cnt >= max_items_per_feed:
+                if len(entries) >= max_items_per_feed:
                     break
                 link = (getattr(e, "link", "") or "").strip()
                 if not link or not link.startswith(("http://", "https://")):
                     continue
+                entries.append((e, link, _source_id("user", link)))
+            entries = _entries_to_fetch(f"user_rss {feed_url}", entries, roles_at_or_above(role))
 
+            def _one(item, role=role):
+                e, link, source_id = item
+                deferred = None
                 try:
-                    resp = http_get(link, timeout=timeout, headers=UA_HEADERS)
-                    resp.raise_for_status()
+                    resp = fetch_article(link, timeout=timeout, source="user_rss")
+                    save_snapshot(link, resp, "user", source_id)
                     _, full = extract_main_content(resp.text)
                     title = clean_text(getattr(e, "title", "") or link)
                     content = make_summary(full, max_chars=260)
-                except Exception:
+                except Exception as err:
+                    deferred = err if isinstance(err, (RetryDeferred, CircuitOpenError)) else None
                     title = clean_text(getattr(e, "title", "") or link)
                     raw = clean_text(getattr(e, "summary", "") or getattr(e, "description", "") or "")
                     content = make_summary(raw, max_chars=260)
 
-                ts = _entry_datetime(e)
-                docs.append({
+                doc = {
                     "source": "user",
-                    "source_id": f"user:{hashlib.sha1(link.encode()).hexdigest()}",
+                    "source_id": source_id,
                     "title": title or link,
                     "url": link,
+                    "canonical_url": canonical_url(link),
                     "content": content,
-                    "timestamp": ts,
+                    "timestamp": _entry_datetime(e),
                     "min_role": role,
                     "allowed_roles": roles_at_or_above(role),
                     "origin": urlparse(link).netloc,
-                })
-                cnt += 1
+                }
+                if deferred:
+                    enqueue_retry(doc, deferred)
+                return doc
+
+            cnt = 0
+            for d in imap_ordered(_one, entries):
+                if d:
+                    cnt += 1
+                    yield d
+            yield Checkpoint(feed["commit_validators"], label=f"user_rss validators {feed_url}")
 
             sources_coll.update_one(
                 {"_id": rcd["_id"]},
@@ -693,7 +2228,9 @@ def crawl_user_rss(limit_sources=200, max_items_per_feed=40, timeout=25):
                 {"_id": rcd["_id"]},
                 {"$set": {"last_crawled": now, "last_status": f"error:{e.__class__.__name__}"}}
             )
-    return docs
+
+def crawl_user_rss(limit_sources=200, max_items_per_feed=40, timeout=25):
+    return _docs_only(iter_user_rss(limit_sources=limit_sources, max_items_per_feed=max_items_per_feed, timeout=timeout))
 
 # ---------- “文件2”的 per-user RSS 抓取到 user_rss_items ----------
 
@@ -707,34 +2244,26 @@ def _strip_html(html_str: str) -> str:
 def _extract_main_content_user(html_str: str) -> Tuple[str, str]:
     """
     “文件2”版本：返回 (title, text)，偏向于提炼 <article> 段落。
-    与 extract_main_content 同时存在不冲突。
+    与 extract_main_content 同时存在不冲突；同样只解析一次页面（HtmlPage）。
     """
     title, text = "", ""
     if html_str:
-        if Document:
-            try:
-                doc = Document(html_str)  # type: ignore
-                title = (doc.short_title() or "").strip()
-                text = _strip_html(doc.summary() or "")
-            except Exception:
-                pass
-        if not text and BeautifulSoup:
-            try:
-                soup = BeautifulSoup(html_str, "html.parser")  # type: ignore
-                article = soup.find("article") or soup
-                paras = [p.get_text(" ", strip=True) for p in article.find_all("p")]
-                text = " ".join(paras).strip()
-                if not title and soup.title and soup.title.string:
-                    title = soup.title.string.strip()
-            except Exception:
-                pass
+        page = HtmlPage(html_str)
+        area = page.readability_root()
+        if area is not None:
+            title = page.short_title
+            text = clean_text(" ".join(area.itertext()))
+        if not text and page.root is not None:
+            paras = _XP_ARTICLE_P(page.root) or page.root.xpath("//p")
+            text = " ".join(_node_text(p) for p in paras).strip()
+            title = title or page.title
         if not text:
             text = _strip_html(html_str)
     return title, text
 
 def _fetch_url(url: str) -> Optional[str]:
     try:
-        r = SESSION.get(url, timeout=REQUEST_TIMEOUT)
+        r = SESSION.get(url, timeout=REQUEST_TIMEOUT, headers={"User-Agent": UA_RSS})
         r.raise_for_status()
         return r.text
     except Exception:
@@ -774,57 +2303,113 @@ def _normalize_link(entry) -> Optional[str]:
         return None
     return str(url).strip()
 
-def _upsert_item(owner_username: str, feed_url: str, url: str, title: str, content: str, ts: datetime):
-    # Deduplicate per owner+url
-    existing = user_rss_items.find_one({"owner_username": owner_username, "url": url})
-    if existing:
-        user_rss_items.update_one(
-            {"_id": existing["_id"]},
-            {"$set": {
-                "title": title or existing.get("title"),
-                "content": content or existing.get("content"),
-                "timestamp": ts or existing.get("timestamp"),
-                "feed_url": feed_url,
-                "updated_at": datetime.now(timezone.utc),
-            }}
-        )
-        return False
-    user_rss_items.insert_one({
-        "owner_username": owner_username,
-        "feed_url": feed_url,
-        "url": url,
-        "title": title or url,
-        "content": content or "",
-        "timestamp": ts,
-        "created_at": datetime.now(timezone.utc),
-        "updated_at": datetime.now(timezone.utc),
-    })
-    return True
+def _fence_clause(fence: tuple[str, int] | None) -> tuple[dict, dict]:
+    """
+    (filter, $set) parts that make a write conditional on a lease's fencing token:
+    the row must not carry a newer token for the same lease (missing counts as older).
+    A rejected upsert surfaces as a duplicate-key error on the row's unique index.
+    """
+    if not fence:
+        return {}, {}
+    field, token = f"fence.{fence[0]}", fence[1]
+    return {field: {"$not": {"$gt": token}}}, {field: token}
+
+def _upsert_item_op(owner_username: str, feed_url: str, url: str, title: str, content: str,
+                    ts: datetime, now: datetime, fence: tuple[str, int] | None = None,
+                    legacy_id=None) -> UpdateOne:
+    """
+    Upsert keyed on the (owner_username, canonical_url) unique index. `legacy_id` is the
+    _id of a row written before canonical URLs existed (see _legacy_item_ids): that row
+    is upgraded in place instead.
+    Empty title/content never overwrite stored values; on insert they default to url / "".
+    `fence` = (lease key, token) makes the write conditional (see _fence_clause).
+    """
+    canon = canonical_url(url)
+    fence_filter, fence_set = _fence_clause(fence)
+    set_fields = {"url": url, "canonical_url": canon, "feed_url": feed_url, "timestamp": ts, "updated_at": now,
+                  **fence_set}
+    on_insert = {"created_at": now}
+    if title:
+        set_fields["title"] = title
+    else:
+        on_insert["title"] = url
+    if content:
+        set_fields["content"] = content
+    else:
+        on_insert["content"] = ""
+    key = {"_id": legacy_id} if legacy_id is not None else {"canonical_url": canon}
+    return UpdateOne(
+        {"owner_username": owner_username, **key, **fence_filter},
+        {"$set": set_fields, "$setOnInsert": on_insert},
+        upsert=True,
+    )
 
-def fetch_user_rss_once(owner_username: str, rss_url: str, limit: int = 200) -> dict:
+def _legacy_item_ids(owners: list, urls: dict) -> dict:
     """
-    从指定 rss_url 抓取该用户的 RSS 项，存入 user_rss_items / user_rss_sources。
-    函数名与行为保留与“文件2”一致。
+    {(owner, canonical_url): _id} of user_rss_items rows that predate canonical URLs
+    (matched by raw url) and have no canonical row beside them; `urls` maps
+    canonical_url -> raw url. Keeps _upsert_item_op to one row per key.
+    """
+    try:
+        rows = list(user_rss_items.find(
+            {"owner_username": {"$in": owners},
+             "$or": [{"canonical_url": {"$in": list(urls)}},
+                     {"url": {"$in": list(urls.values())}, "canonical_url": {"$exists": False}}]},
+            {"_id": 1, "owner_username": 1, "url": 1, "canonical_url": 1},
+        ))
+    except Exception as e:
+        logging.warning("user_rss_items legacy lookup failed: %s", e)
+        return {}
+    has_canon = {(r["owner_username"], r["canonical_url"]) for r in rows if r.get("canonical_url")}
+    legacy = {}
+    for r in rows:
+        if r.get("canonical_url"):
+            continue
+        key = (r["owner_username"], canonical_url(r["url"]))
+        if key not in has_canon:
+            legacy.setdefault(key, r["_id"])
+    return legacy
+
+def _feed_cadence(entries) -> float | None:
+    """Median gap (seconds) between the dated entries of a feed; None if fewer than two."""
+    stamps = set()
+    for e in entries:
+        for key in ("published_parsed", "updated_parsed"):
+            t = e.get(key) if isinstance(e, dict) else getattr(e, key, None)
+            if t:
+                try:
+                    stamps.add(time.mktime(t))
+                    break
+                except Exception:
+                    pass
+    ordered = sorted(stamps, reverse=True)[:20]
+    gaps = sorted(a - b for a, b in zip(ordered, ordered[1:]))
+    return gaps[len(gaps) // 2] if gaps else None
+
+def _parse_user_feed(rss_url: str, limit: int = 200, cached: bool = False) -> dict:
+    """
+    Network half of fetch_user_rss_once: download + parse the feed once and build
+    {canonical_url: {url, title, content, ts}} (article pages are fetched only for
+    entries without a summary). Returns {"status", "items", "total", "fetches", "entries_hash", "cadence"};
+    `items` is None when the feed answered with an HTTP error or (cached=True) 304.
     """
     if not feedparser:
         raise RuntimeError("feedparser is not installed")
-
-    parsed = feedparser.parse(rss_url)
-    status = getattr(parsed, "status", None) or (parsed.get("status") if isinstance(parsed, dict) else None)
+    try:
+        parsed = parse_feed_with_backoff(rss_url, source="user_feed", cached=cached, headers={"User-Agent": UA_RSS})
+    except Exception as e:
+        logging.warning("[user_feed] %s: %s", rss_url, e)
+        return {"status": f"error:{e.__class__.__name__}", "items": None, "total": 0, "fetches": 1}
+    if parsed is None:
+        return {"status": "not_modified", "items": None, "total": 0, "fetches": 1}
+    fetches = 1
+    status = parsed.get("status")
     if status and int(status) >= 400:
-        user_rss_sources.update_one(
-            {"owner_username": owner_username, "url": rss_url},
-            {"$set": {
-                "last_status": f"http {status}",
-                "last_crawled": datetime.now(timezone.utc)
-            }},
-            upsert=True
-        )
-        return {"ok": False, "new": 0, "total": 0, "status": status}
+        return {"status": status, "items": None, "total": 0, "fetches": fetches}
 
     entries = parsed.entries or []
     total = 0
-    new_count = 0
+    items: dict[str, dict] = {}   # canonical_url -> 字段；同一 feed 内重复 / 仅跟踪参数不同的 URL 合并为一次 upsert
 
     for entry in entries[:limit]:
         url = _normalize_link(entry)
@@ -844,6 +2429,7 @@ def fetch_user_rss_once(owner_username: str, rss_url: str, limit: int = 200) ->
         content_text = summary
         if not content_text:
             html_doc = _fetch_url(url)
+            fetches += 1
             if html_doc:
                 t2, txt2 = _extract_main_content_user(html_doc)
                 if not title and t2:
@@ -852,29 +2438,140 @@ def fetch_user_rss_once(owner_username: str, rss_url: str, limit: int = 200) ->
 
         ts = _entry_time(entry)
 
-        inserted = _upsert_item(
-            owner_username=owner_username,
-            feed_url=rss_url,
-            url=url,
-            title=title,
-            content=content_text,
-            ts=ts
-        )
+        item = items.setdefault(canonical_url(url), {"url": url, "title": "", "content": ""})
+        item["title"] = title or item["title"]
+        item["content"] = content_text or item["content"]
+        item["ts"] = ts
         total += 1
-        if inserted:
-            new_count += 1
-
-    user_rss_sources.update_one(
-        {"owner_username": owner_username, "url": rss_url},
-        {"$set": {
-            "last_crawled": datetime.now(timezone.utc),
-            "last_status": f"ok: {new_count} new / {total} scanned"
-        }},
-        upsert=True
-    )
-    return {"ok": True, "new": new_count, "total": total, "status": "ok"}
 
+    return {"status": status or "ok", "items": items, "total": total, "fetches": fetches,
+            "commit_validators": parsed["commit_validators"],
+            "entries_hash": _fingerprint(sorted(items)), "cadence": _feed_cadence(entries[:limit])}
+
+def _next_poll(prev: dict, feed: dict, now: datetime) -> dict:
+    """
+    Learned schedule fields for a feed after one poll.
+    Changed entry set -> poll about twice per observed posting cadence; 304, an
+    unchanged entry set or an error -> stretch the previous interval by
+    RSS_POLL_BACKOFF. Always clamped to [RSS_POLL_MIN, RSS_POLL_MAX].
+    """
+    prev_interval = float(prev.get("poll_interval") or RSS_POLL_MIN)
+    cadence = feed.get("cadence") or prev.get("poll_cadence")
+    changed = bool(feed.get("entries_hash")) and feed["entries_hash"] != prev.get("entries_hash")
+    if changed:
+        interval = cadence / 2 if cadence else RSS_POLL_MIN
+        unchanged = 0
+    else:
+        interval = max(prev_interval * RSS_POLL_BACKOFF, cadence / 2 if cadence else 0)
+        unchanged = int(prev.get("unchanged_polls") or 0) + 1
+    interval = min(max(interval, RSS_POLL_MIN), RSS_POLL_MAX)
+    fields = {
+        "poll_interval": interval,
+        "unchanged_polls": unchanged,
+        # 略微提前，分散同一时刻到期的 feed，且不会错过下一次整点任务
+        "next_poll_at": now + timedelta(seconds=interval * random.uniform(0.85, 1.0)),
+    }
+    if cadence:
+        fields["poll_cadence"] = cadence
+    if changed:
+        fields["entries_hash"] = feed["entries_hash"]
+        fields["last_changed_at"] = now
+    return fields
+
+def _feed_status_label(status) -> str:
+    return status if isinstance(status, str) else f"http {status}"
+
+class StaleLeaseError(RuntimeError):
+    """A fenced write was rejected: a newer lease holder already wrote this feed."""
+
+def _fenced_bulk_write(ops, collection, lease: "LeaseLock | None") -> tuple[set, set]:
+    """
+    bulk_write_with_backoff; returns (upserted op indexes, rejected op indexes).
+    Duplicate-key rejections either mean a newer holder fenced us out (raise
+    StaleLeaseError, checked through lease.fence_ok()) or an insert race with another
+    feed upserting the same item (that op is skipped; the row is written either way).
+    """
+    try:
+        res = bulk_write_with_backoff(ops, collection=collection)
+        return set((res.upserted_ids or {}).keys()), set()
+    except BulkWriteError as e:
+        if not _only_duplicate_keys(e):
+            raise
+        if lease is not None and not lease.fence_ok():
+            raise StaleLeaseError(f"lease {lease.name} superseded") from e
+        details = e.details or {}
+        return ({u["index"] for u in details.get("upserted") or []},
+                {w["index"] for w in details.get("writeErrors") or []})
+
+def _write_user_feed(owner_feeds: dict[str, str], feed: dict, schedule: dict | None = None,
+                     lease: "LeaseLock | None" = None) -> dict[str, dict]:
+    """
+    Storage half: write one parsed feed to every subscribing owner.
+    owner_feeds maps owner_username -> that owner's own rss_url (user_rss_sources.url).
+    All owners' items go out in ONE unordered bulk_write on user_rss_items, and the
+    per-owner source status (plus the `schedule` fields from _next_poll) in one
+    bulk_write on user_rss_sources. The feed's HTTP validators are saved only
+    after both writes succeeded.
+    With a (distributed) `lease` every write is conditional on its fencing token, so
+    a holder that stalls past its lease cannot overwrite a newer holder's rows.
+    Returns {owner: {"new", "updated", "total"}} (counts from the bulk result).
+    """
+    schedule = schedule or {}
+    owners = list(owner_feeds)
+    now = datetime.now(timezone.utc)
+    items, total = feed["items"], feed["total"]
+    result = {o: {"new": 0, "updated": 0, "total": total} for o in owners}
+    fence = lease.fence if lease is not None else None
+    fence_filter, fence_set = _fence_clause(fence)
+
+    def _status_op(o, fields):
+        return UpdateOne(
+            {"owner_username": o, "url": owner_feeds[o], **fence_filter},
+            {"$set": {**fields, "last_crawled": now, **schedule, **fence_set}},
+            upsert=True,
+        )
+
+    if items is None:
+        status_ops = [_status_op(o, {"last_status": _feed_status_label(feed["status"])}) for o in owners]
+        _fenced_bulk_write(status_ops, user_rss_sources, lease)
+        return result
+
+    ops, op_owner = [], []
+    legacy = _legacy_item_ids(owners, {canon: it["url"] for canon, it in items.items()}) if items else {}
+    for o in owners:
+        for canon, it in items.items():
+            ops.append(_upsert_item_op(o, owner_feeds[o], it["url"], it["title"], it["content"], it["ts"], now,
+                                       fence=fence, legacy_id=legacy.get((o, canon))))
+            op_owner.append(o)
+    if ops:
+        upserted, rejected = _fenced_bulk_write(ops, user_rss_items, lease)
+        for idx, o in enumerate(op_owner):
+            if idx in upserted:
+                result[o]["new"] += 1
+            elif idx not in rejected:
+                result[o]["updated"] += 1
+
+    status_ops = [
+        _status_op(o, {"last_status": f"ok: {r['new']} new / {r['updated']} updated / {total} scanned"})
+        for o, r in result.items()
+    ]
+    _fenced_bulk_write(status_ops, user_rss_sources, lease)
+    if feed.get("commit_validators"):
+        feed["commit_validators"]()
+    return result
 
+def fetch_user_rss_once(owner_username: str, rss_url: str, limit: int = 200) -> dict:
+    """
+    从指定 rss_url 抓取该用户的 RSS 项，存入 user_rss_items / user_rss_sources。
+    函数名与行为保留与“文件2”一致。
+    """
+    feed = _parse_user_feed(rss_url, limit=limit)
+    prev = user_rss_sources.find_one({"owner_username": owner_username, "url": rss_url}) or {}
+    schedule = _next_poll(prev, feed, datetime.now(timezone.utc))
+    res = _write_user_feed({owner_username: rss_url}, feed, schedule)[owner_username]
+    if feed["items"] is None:
+        return {"ok": False, "new": 0, "total": 0, "status": feed["status"]}
+    return {"ok": True, "new": res["new"], "updated": res["updated"], "total": res["total"], "status": "ok"}
 
 
 
@@ -885,66 +2582,211 @@ def fetch_user_rss_once(owner_username: str, rss_url: str, limit: int = 200) ->
 
 
 
-# --- 放在 fetch_user_rss_once(...) 之后、main() 之前 ---
 
-from pathlib import Path
-from contextlib import contextmanager
+
+# --- 放在 fetch_user_rss_once(...) 之后、main() 之前 ---
 
 def _normalize_url_for_dedup(u: str) -> str:
     """
-    规范化 URL 以便去重：小写主机名、去掉 fragment、保留 path/query。
+    规范化 URL 以便去重（同 canonical_url）；实际抓取仍使用订阅者填写的原始 URL。
     """
-    u = (u or "").strip()
-    if not u:
-        return ""
-    parts = urlsplit(u)
-    scheme = parts.scheme or "http"
-    netloc = (parts.netloc or "").lower()
-    path = parts.path or "/"
-    query = parts.query
-    return urlunsplit((scheme, netloc, path, query, ""))
-
-# 抓取阶段的跨进程文件锁，避免并发导入/初始化导致的死锁
-_LOCK_PATH = Path(os.getenv("CTI_FETCH_LOCK_FILE", os.path.join(os.getenv("TMP", os.getenv("TEMP", "/tmp")), "cti_fetch.lock")))
-
-@contextmanager
-def _fetch_lock():
-    import time as _t
-    while True:
+    return canonical_url(u)
+
+# ---------- 分布式租约锁（Redis）：按 feed URL 加锁，多 worker / 多节点可并行处理不同 feed ----------
+# SET key token NX PX ttl 获取租约；token 来自 INCR 的单调递增 fencing token。
+# 释放 / 续约都先比对 token（Lua 原子执行），过期锁自动失效，崩溃的 worker 不会永久占锁。
+_LUA_RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+_LUA_EXTEND = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+
+_lock_redis = None
+_lock_redis_lock = threading.Lock()
+_local_leases: dict[str, tuple[int, float]] = {}   # Redis 不可用时的单进程退化实现
+_local_fence = 0
+
+def _lock_client():
+    """
+    Redis client for leases (FETCH_LOCK_REDIS_URL, else the Celery broker) on a pool
+    bounded by FETCH_LOCK_REDIS_MAX_CONNECTIONS; None if unavailable.
+    """
+    global _lock_redis
+    with _lock_redis_lock:
+        if _lock_redis is None:
+            url = FETCH_LOCK_REDIS_URL
+            if not url:
+                try:
+                    from worker.celery_app import BROKER_URL as url  # type: ignore
+                except Exception:
+                    url = ""
+            if _redis is None or not url.startswith(("redis://", "rediss://")):
+                logging.warning("Redis lease lock unavailable, falling back to an in-process lock")
+                _lock_redis = False
+            else:
+                pool = _redis.BlockingConnectionPool.from_url(
+                    url, max_connections=FETCH_LOCK_REDIS_MAX_CONNECTIONS, timeout=10,
+                    socket_timeout=10, socket_connect_timeout=10,
+                )
+                _lock_redis = _redis.Redis(connection_pool=pool)
+        return _lock_redis or None
+
+class LeaseLock:
+    """
+    Non-blocking lease on `name` for `ttl` seconds. On success `token` holds a
+    fencing token that increases with every grant of this name; writers check it
+    with fence_ok() so a holder whose lease expired mid-run cannot overwrite the
+    results of a newer holder.
+    """
+
+    def __init__(self, name: str, ttl: float = FETCH_LOCK_TTL):
+        self.key = f"cti:lease:{name}"
+        self.name = name
+        self.ttl_ms = int(ttl * 1000)
+        self.token: int | None = None
+
+    def acquire(self) -> bool:
+        global _local_fence
+        r = _lock_client()
+        if r is None:
+            with _lock_redis_lock:
+                held = _local_leases.get(self.key)
+                if held and held[1] > time.monotonic():
+                    return False
+                _local_fence += 1
+                self.token = _local_fence
+                _local_leases[self.key] = (self.token, time.monotonic() + self.ttl_ms / 1000)
+            return True
+        token = int(r.incr(f"{self.key}:fence"))
+        if r.set(self.key, str(token), nx=True, px=self.ttl_ms):
+            self.token = token
+            return True
+        return False
+
+    def extend(self) -> bool:
+        """Renew the lease for another ttl; False if it was lost (expired / taken over)."""
+        if self.token is None:
+            return False
+        r = _lock_client()
+        if r is None:
+            with _lock_redis_lock:
+                held = _local_leases.get(self.key)
+                if not held or held[0] != self.token:
+                    return False
+                _local_leases[self.key] = (self.token, time.monotonic() + self.ttl_ms / 1000)
+            return True
+        return bool(r.eval(_LUA_EXTEND, 1, self.key, str(self.token), self.ttl_ms))
+
+    def release(self):
+        if self.token is None:
+            return
+        r = _lock_client()
         try:
-            fd = os.open(str(_LOCK_PATH), os.O_CREAT | os.O_EXCL | os.O_RDWR)
-            os.write(fd, str(os.getpid()).encode("utf-8"))
-            os.close(fd)
-            break
-        except FileExistsError:
-            _t.sleep(0.2)
-    try:
-        yield
-    finally:
+            if r is None:
+                with _lock_redis_lock:
+                    held = _local_leases.get(self.key)
+                    if held and held[0] == self.token:
+                        del _local_leases[self.key]
+            else:
+                r.eval(_LUA_RELEASE, 1, self.key, str(self.token))
+        except Exception as e:
+            logging.warning("lease release failed for %s: %s (expires after ttl)", self.name, e)
+        finally:
+            self.token = None
+
+    @property
+    def fence(self) -> tuple[str, int] | None:
+        """
+        (field key, token) for conditional writes (_fence_clause), or None when there is
+        nothing to fence: no lease held, or in-process leases whose tokens are per process.
+        """
+        if self.token is None or _lock_client() is None:
+            return None
+        return self.name.replace(":", "_").replace(".", "_"), self.token
+
+    def fence_ok(self) -> bool:
+        """
+        Record this token as the newest writer of `name` in Mongo (sync_state) unless a
+        newer token already wrote; False means this lease is stale and must not write.
+        Only an early check: the writes themselves carry the token (see `fence`).
+        """
+        if self.token is None:
+            return False
+        if _lock_client() is None:
+            return True   # 进程内锁的 token 不跨进程，无需 fencing
         try:
-            os.remove(_LOCK_PATH)
-        except FileNotFoundError:
-            pass
+            sync_state.update_one(
+                {"_id": f"fence:{self.name}", "token": {"$lte": self.token}},
+                {"$set": {"token": self.token, "updated_at": datetime.now(timezone.utc)}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
 
-def fetch_all_rss_dedup(limit: int = 200, owner_filter=None, sample: int | None = None) -> dict:
+_PRELOAD_FEED = b"""<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel><title>t</title>
+<item><title>t</title><link>https://example.com/a</link><description>&lt;p&gt;x&lt;/p&gt;</description>
+<pubDate>Mon, 06 Jan 2025 10:00:00 GMT</pubDate></item></channel></rss>"""
+_preloaded = False
+_preload_lock = threading.Lock()
+
+def _preload_feed_parsing():
+    """
+    Run the lazily-importing parse paths once in the calling thread before feeds are
+    parsed in parallel. The old global fetch lock serialized the whole fetch+write
+    only because concurrent FIRST imports (xml.sax.make_parser's __import__ of the
+    expat driver, codec lookups, charset detection inside requests / feedparser)
+    could raise importlib's _DeadlockError. Once those modules are in sys.modules
+    threads no longer contend on module locks; the Mongo writes themselves never
+    needed serializing (pymongo is thread-safe, and concurrent upserts on the same
+    unique key end as duplicate-key rejections handled by _fenced_bulk_write).
+    """
+    global _preloaded
+    if _preloaded:
+        return
+    with _preload_lock:
+        if _preloaded:
+            return
+        for enc in ("utf-8", "latin-1", "cp1252", "ascii", "utf-16", "gb18030", "big5", "shift_jis", "euc-kr"):
+            codecs.lookup(enc)
+        if feedparser is not None:
+            feedparser.parse(_PRELOAD_FEED)
+        _strip_html("<p>x &amp; y</p>")
+        _preloaded = True
+
+def fetch_all_rss_dedup(limit: int = 200, owner_filter=None, sample: int | None = None,
+                        force: bool = False) -> dict:
     """
     去重抓取仓库里所有 RSS URL：
       - 来源：MongoDB collection `user_rss_sources`
       - 去重：按规范化后的 URL 合并
-      - 调用：对每个 URL，按它关联到的所有 owner 逐一调用 fetch_user_rss_once(owner, url, limit)
+      - 调度：只抓取到期的 URL（任一订阅者 next_poll_at 为空或已到期，见 _next_poll）；
+              所有订阅者都已收到过该 feed 时使用条件请求（304 视为无变化）
+      - 抓取：每个 URL 只下载/解析一次（_parse_user_feed），RSS_DEDUP_WORKERS 个 feed 并行
+      - 加锁：每个 URL 一把 Redis 租约锁（LeaseLock）；已被其他 worker 持有的 URL 直接跳过
+      - 写入：解析结果一次 bulk 写给订阅该 URL 的所有 owner（_write_user_feed），写前校验 fencing token
 
     参数:
-      limit         每条 feed 抓取的最大条数（传给 fetch_user_rss_once）
+      limit         每条 feed 抓取的最大条数
       owner_filter  仅抓取某个 owner 或 owner 列表（None 表示全部）
       sample        仅处理去重后的前 N 个 URL（用于测试）
+      force         忽略 next_poll_at，抓取全部 URL
 
     返回:
       {
         "ok": True,
-        "url_count": 去重后的 URL 数量,
-        "invocations": 总调用次数（owner×url）,
+        "url_count": 本次处理（到期）的 URL 数量,
+        "not_due": 未到期而跳过的 URL 数量,
+        "network_fetches": 网络请求数（feed + 无摘要条目的正文）,
+        "owner_writes": 写入的 (owner, url) 组合数,
+        "invocations": 同 owner_writes（兼容旧字段）,
+        "locked": 因其他 worker 正在处理而跳过的 URL 数,
         "by_url": {
-          url: {"owners": [...], "calls": X, "new_sum": Y, "total_sum": Z}
+          url: {"owners": [...], "fetches": F, "calls": X, "new_sum": Y, "updated_sum": U, "total_sum": Z}
         }
       }
     """
@@ -955,77 +2797,500 @@ def fetch_all_rss_dedup(limit: int = 200, owner_filter=None, sample: int | None
     if owner_filter:
         q["owner_username"] = {"$in": owner_filter}
 
-    # 从 user_rss_sources 读 (owner_username, url)
-    cursor = user_rss_sources.find(q, {"owner_username": 1, "url": 1})
+    # 从 user_rss_sources 读 (owner_username, url) 及调度字段；保留每个 owner 自己存的原始 URL 用于回写状态
+    cursor = user_rss_sources.find(q, {
+        "owner_username": 1, "url": 1, "next_poll_at": 1, "poll_interval": 1,
+        "poll_cadence": 1, "unchanged_polls": 1, "entries_hash": 1,
+    })
 
-    url_to_owners: dict[str, set[str]] = {}
+    now = datetime.now(timezone.utc)
+    cutoff = now + timedelta(seconds=RSS_DUE_SLACK)
+    url_to_owners: dict[str, dict[str, str]] = {}
+    url_prev: dict[str, dict] = {}       # 该 URL 上一次学到的调度状态
+    url_due: dict[str, bool] = {}
+    url_seen_by_all: dict[str, bool] = {}  # 所有订阅者都已收到过 → 可用条件请求
     for doc in cursor:
         owner = (doc.get("owner_username") or "").strip()
-        url = _normalize_url_for_dedup(doc.get("url") or "")
+        raw_url = (doc.get("url") or "").strip()
+        url = _normalize_url_for_dedup(raw_url)
         if not owner or not url:
             continue
-        url_to_owners.setdefault(url, set()).add(owner)
-
-    urls = sorted(url_to_owners.keys())
+        url_to_owners.setdefault(url, {}).setdefault(owner, raw_url)
+        nxt = doc.get("next_poll_at")
+        if nxt is not None and nxt.tzinfo is None:
+            nxt = nxt.replace(tzinfo=timezone.utc)
+        url_due[url] = url_due.get(url, False) or nxt is None or nxt <= cutoff
+        url_seen_by_all[url] = url_seen_by_all.get(url, True) and bool(doc.get("entries_hash"))
+        if doc.get("poll_interval") and not url_prev.get(url):
+            url_prev[url] = doc
+
+    all_urls = sorted(url_to_owners.keys())
+    urls = all_urls if force else [u for u in all_urls if url_due[u]]
+    not_due = len(all_urls) - len(urls)
     if sample is not None:
         urls = urls[: int(sample)]
 
     summary = {
         "ok": True,
         "url_count": len(urls),
+        "not_due": not_due,
+        "network_fetches": 0,
+        "owner_writes": 0,
         "invocations": 0,
+        "locked": 0,
         "by_url": {}
     }
 
-    # 串行“抓取阶段”，避免并发导入/初始化死锁（你之前遇到的 _DeadlockError）
-    with _fetch_lock():
-        for url in urls:
-            owners = sorted(url_to_owners[url])
-            by_url_entry = {"owners": owners, "calls": 0, "new_sum": 0, "total_sum": 0}
-            for owner in owners:
-                try:
-                    res = fetch_user_rss_once(owner_username=owner, rss_url=url, limit=limit)
-                except Exception as e:
-                    res = {"ok": False, "error": str(e)}
-                by_url_entry["calls"] += 1
-                summary["invocations"] += 1
-                if isinstance(res, dict):
-                    by_url_entry["new_sum"] += int(res.get("new", 0) or 0)
-                    by_url_entry["total_sum"] += int(res.get("total", 0) or 0)
-            summary["by_url"][url] = by_url_entry
+    def _one(url):
+        owner_feeds = dict(sorted(url_to_owners[url].items()))
+        by_url_entry = {"owners": list(owner_feeds), "fetches": 0, "calls": 0,
+                        "new_sum": 0, "updated_sum": 0, "total_sum": 0}
+        lease = LeaseLock(f"rss:{hashlib.sha1(url.encode()).hexdigest()}")
+        try:
+            if not lease.acquire():
+                by_url_entry["skipped"] = "locked"
+                return url, by_url_entry
+            feed = _parse_user_feed(next(iter(owner_feeds.values())), limit=limit, cached=url_seen_by_all[url])
+            by_url_entry["fetches"] = feed["fetches"]
+            schedule = _next_poll(url_prev.get(url) or {}, feed, datetime.now(timezone.utc))
+            by_url_entry["next_poll_at"] = schedule["next_poll_at"].isoformat()
+            # 写前续约并登记 fencing token；租约已丢失或已有更新的持有者写过，则放弃本次写入。
+            # 写入本身也以 token 为条件（_fence_clause），写入途中被接管同样会被拒绝。
+            if not lease.extend():
+                by_url_entry["error"] = "lease lost"
+                return url, by_url_entry
+            if not lease.fence_ok():
+                by_url_entry["error"] = "stale lease"
+                return url, by_url_entry
+            per_owner = _write_user_feed(owner_feeds, feed, schedule, lease=lease)
+            by_url_entry["calls"] = len(per_owner)
+            for res in per_owner.values():
+                by_url_entry["new_sum"] += res["new"]
+                by_url_entry["updated_sum"] += res["updated"]
+                by_url_entry["total_sum"] += res["total"]
+            if feed["status"] == "not_modified":
+                by_url_entry["status"] = "not_modified"
+            elif feed["items"] is None:
+                by_url_entry["error"] = _feed_status_label(feed["status"])
+        except StaleLeaseError as e:
+            logging.warning("[rss_dedup] %s: %s, writes abandoned", url, e)
+            by_url_entry["error"] = "stale lease"
+        except Exception as e:
+            logging.warning("[rss_dedup] %s failed: %s", url, e)
+            by_url_entry["error"] = str(e)
+        finally:
+            lease.release()
+        return url, by_url_entry
+
+    _preload_feed_parsing()
+
+    for url, by_url_entry in imap_ordered(_one, urls, workers=RSS_DEDUP_WORKERS):
+        summary["network_fetches"] += by_url_entry["fetches"]
+        summary["owner_writes"] += by_url_entry["calls"]
+        summary["locked"] += 1 if by_url_entry.get("skipped") == "locked" else 0
+        summary["by_url"][url] = by_url_entry
+    summary["invocations"] = summary["owner_writes"]
+    logging.info("[rss_dedup] due=%d not_due=%d network_fetches=%d owner_writes=%d locked=%d",
+                 summary["url_count"], summary["not_due"], summary["network_fetches"],
+                 summary["owner_writes"], summary["locked"])
 
     return summary
 
 
-# ---------- Main entry（融合主流程） ----------
-def main():
-    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+# ---------- 延后重试：文章抓取失败不在 worker 内 sleep，而是入队由 Celery 稍后处理 ----------
+# 重试成功 / 快照重抽取时用于抽取正文的函数（按 source）
+_RETRY_EXTRACTORS = {
+    "krebsonsecurity": extract_krebs_body,
+    "msrc_blog": extract_msrc_body,
+    "user": lambda h: extract_main_content(h)[1],
+}
 
-    sites = [
-        ("cisa_kev", crawl_cisa_kev, {"limit": 2000}),
-        ("krebsonsecurity", crawl_krebsonsecurity, {"limit": 40}),
-        ("msrc_blog", crawl_msrc_blog, {"limit": 40}),
-        ("nvd", crawl_nvd_recent, {"days": 7, "max_items": 200}),
-        ("exploitdb", crawl_exploitdb, {"limit": 60}),
-    ]
-    logging.info("Sites to crawl: %s", [n for (n, _, _) in sites])
+def _extract_summary(source: str, html_doc: str) -> str:
+    extractor = _RETRY_EXTRACTORS.get(source, lambda h: extract_main_content(h)[1])
+    return make_summary(extractor(html_doc), max_chars=260)
+
+def enqueue_retry(doc: dict, err: RetryDeferred | CircuitOpenError):
+    """
+    Queue an article whose fetch hit a retryable failure (or an open breaker, retried
+    after BREAKER_COOLDOWN). `doc` is the feed-summary fallback that the crawler still
+    yields; the retry upgrades its content later.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        cur = fetch_retries.find_one({"_id": doc["source_id"]}, {"attempts": 1}) or {}
+        attempts = int(cur.get("attempts") or 0)
+        if isinstance(err, CircuitOpenError):
+            delay = BREAKER_COOLDOWN
+        else:
+            delay = err.retry_after if err.retry_after is not None else _backoff_delay(attempts)
+        fetch_retries.update_one(
+            {"_id": doc["source_id"]},
+            {"$set": {
+                "url": doc["url"],
+                "source": doc["source"],
+                "doc": doc,
+                "due_at": now + timedelta(seconds=delay),
+                "last_error": str(err),
+                "updated_at": now,
+            }, "$setOnInsert": {"attempts": 0, "created_at": now}},
+            upsert=True,
+        )
+        logging.info("[%s] deferred %s (retry in %.0fs)", doc["source"], doc["url"], delay)
+    except Exception as e:
+        logging.warning("enqueue_retry failed for %s: %s", doc.get("url"), e)
+
+def next_retry_due_in() -> float | None:
+    """Seconds until the earliest queued retry is due (0 if overdue), None if the queue is empty."""
+    try:
+        item = fetch_retries.find_one({}, {"due_at": 1}, sort=[("due_at", 1)])
+    except Exception as e:
+        logging.warning("fetch_retries lookup failed: %s", e)
+        return None
+    if not item:
+        return None
+    due = item["due_at"]
+    if due.tzinfo is None:
+        due = due.replace(tzinfo=timezone.utc)
+    return max(0.0, (due - datetime.now(timezone.utc)).total_seconds())
+
+def process_fetch_retries(limit: int = 100) -> dict:
+    """
+    Retry due articles once each (never sleeping): success re-extracts and upserts
+    the doc, a retryable failure re-queues with Retry-After/backoff, anything else
+    (or RETRY_MAX_ATTEMPTS reached) drops the item. Items are claimed with a lease
+    so overlapping runs do not double-fetch. A fetched item leaves the queue only
+    once its doc was written; if the write fails it comes back when its lease expires.
+    """
+    now = datetime.now(timezone.utc)
+    due = list(fetch_retries.find({"due_at": {"$lte": now}}).sort([("due_at", 1)]).limit(limit))
+    claimed = []
+    for item in due:
+        res = fetch_retries.update_one(
+            {"_id": item["_id"], "due_at": item["due_at"]},
+            {"$set": {"due_at": now + timedelta(seconds=RETRY_LEASE_SECONDS)}},
+        )
+        if res.modified_count:
+            claimed.append(item)
 
-    for name, func, kwargs in sites:
+    stats = {"done": 0, "requeued": 0, "dropped": 0, "unsaved": 0}
+
+    def _one(item):
+        doc, attempts = item["doc"], int(item.get("attempts") or 0) + 1
         try:
-            docs = func(**kwargs)
-            ins, _ = upsert_many(docs)
-            logging.info("[%s] saved: upserted=%d matched=%d", name, ins, len(docs) - ins)
+            r = fetch_article(item["url"], timeout=25, source=item["source"], defer=True)
+            save_snapshot(item["url"], r, item["source"], item["_id"])
+            doc["content"] = _extract_summary(item["source"], r.text)
+            return "done", item, doc, None
+        except (RetryDeferred, CircuitOpenError) as e:
+            if attempts >= RETRY_MAX_ATTEMPTS:
+                return "dropped", item, None, e
+            delay = e.retry_after if isinstance(e, RetryDeferred) and e.retry_after is not None \
+                else (BREAKER_COOLDOWN if isinstance(e, CircuitOpenError) else _backoff_delay(attempts))
+            fetch_retries.update_one(
+                {"_id": item["_id"]},
+                {"$set": {"attempts": attempts, "last_error": str(e),
+                          "due_at": datetime.now(timezone.utc) + timedelta(seconds=delay)}},
+            )
+            return "requeued", item, None, e
         except Exception as e:
-            logging.error("[%s] fatal: %s", name, e)
-
+            return "dropped", item, None, e
+
+    docs, done, finished = [], [], []
+    for outcome, item, doc, err in imap_ordered(_one, claimed):
+        stats[outcome] += 1
+        if outcome == "done":
+            docs.append(doc)
+            done.append(item["_id"])
+        elif outcome == "dropped":
+            logging.warning("[%s] retry dropped %s: %s", item["source"], item["url"], err)
+            finished.append(item["_id"])
+    if docs:
+        try:
+            upsert_many(docs, raise_errors=True)
+            finished.extend(done)
+        except Exception as e:
+            # 条目保留在队列中，租约到期后重试
+            logging.error("[fetch_retries] writing %d retried docs failed, kept queued: %s", len(docs), e)
+            stats["unsaved"] = len(docs)
+    if finished:
+        fetch_retries.delete_many({"_id": {"$in": finished}})
+    logging.info("[fetch_retries] done=%d requeued=%d dropped=%d unsaved=%d",
+                 stats["done"], stats["requeued"], stats["dropped"], stats["unsaved"])
+    return {**stats, "next_due_in": next_retry_due_in()}
+
+# ---------- 快照重抽取：抽取规则更新后，用已存 HTML 重建 threats.content ----------
+# 文章型爬虫（krebs / msrc / user_rss）构建的字段：重抽取只读回这些字段，
+# 因此 content_hash 与爬虫写入时的算法一致，recommendations 等派生字段也不会被旧值覆盖
+_ARTICLE_FIELDS = ("source", "source_id", "title", "url", "canonical_url", "content", "timestamp",
+                   "min_role", "allowed_roles", "origin")
+
+def _reextract_blob(args) -> str | None:
+    """Worker: (source, codec, encoding, blob) -> new summary (runs in a child process)."""
+    source, codec, encoding, blob = args
     try:
-        docs = crawl_user_rss(limit_sources=200, max_items_per_feed=40)
-        ins, _ = upsert_many(docs)
-        logging.info("[user_rss] saved: upserted=%d total=%d", ins, len(docs))
+        html_doc = _decompress(blob, codec).decode(encoding or "utf-8", errors="replace")
+        return _extract_summary(source, html_doc)
     except Exception as e:
-        logging.error("[user_rss] fatal: %s", e)
+        logging.warning("re-extract failed (%s): %s", source, e)
+        return None
+
+def _reextract_pool(workers: int):
+    # 抽取是 CPU 密集（lxml + 正则）：优先 fork 子进程；无 fork 的平台退化为线程
+    if workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+    return ThreadPoolExecutor(max_workers=max(1, workers))
+
+def reextract_from_snapshots(source: str | None = None, workers: int = os.cpu_count() or 2,
+                             batch: int = WRITE_BATCH) -> dict:
+    """
+    Rebuild `content` of stored threats from their HTML snapshots, without any
+    network access. Extraction runs in parallel; the crawler-built fields
+    (_ARTICLE_FIELDS) go back through upsert_many, so items whose summary did not
+    change are skipped and nothing else on the doc is touched. Docs that cannot be
+    rebuilt (blob gone, extraction failed) are flagged `stale`, so the next crawl
+    refetches them while they are still in their feed.
+    """
+    q = {"source_id": {"$ne": None}}
+    if source:
+        q["source"] = source
+    stats = {"snapshots": 0, "updated": 0, "unchanged": 0, "missing": 0, "failed": 0, "flagged_stale": 0}
+    started = time.monotonic()
+
+    def _flush(snaps, pool):
+        blobs = map_ordered(lambda sn: _get_blob(sn["body_hash"], sn["codec"]), snaps)
+        jobs = [(sn, b) for sn, b in zip(snaps, blobs) if b is not None]
+        stats["missing"] += len(snaps) - len(jobs)
+        refetch = [sn["source_id"] for sn, b in zip(snaps, blobs) if b is None]
+        stored = {d["source_id"]: d for d in coll.find(
+            {"source_id": {"$in": [sn["source_id"] for sn, _ in jobs]}},
+            {"_id": 0, **{f: 1 for f in _ARTICLE_FIELDS}})}
+        args = [(sn["source"], sn["codec"], sn.get("encoding"), b) for sn, b in jobs]
+        docs = []
+        for (sn, _), content in zip(jobs, pool.map(_reextract_blob, args, chunksize=8)):
+            doc = stored.get(sn["source_id"])
+            if doc is None:
+                stats["missing"] += 1
+            elif content is None:
+                stats["failed"] += 1
+                refetch.append(sn["source_id"])
+            else:
+                doc["content"] = content
+                docs.append(doc)
+        _, upd, skipped = upsert_many(docs)
+        stats["updated"] += upd
+        stats["unchanged"] += skipped
+        if refetch:
+            res = coll.update_many({"source_id": {"$in": refetch}}, {"$set": {"stale": True}})
+            stats["flagged_stale"] += res.modified_count
+
+    with _reextract_pool(workers) as pool:
+        buf = []
+        for sn in html_snapshots.find(q, {"source": 1, "source_id": 1, "body_hash": 1, "codec": 1, "encoding": 1}):
+            stats["snapshots"] += 1
+            buf.append(sn)
+            if len(buf) >= batch:
+                _flush(buf, pool)
+                buf = []
+        if buf:
+            _flush(buf, pool)
+
+    stats["elapsed_s"] = round(time.monotonic() - started, 2)
+    logging.info("[reextract] %s", stats)
+    return stats
+
+# ---------- 流式写入：爬虫 yield → 批量 upsert ----------
+class Checkpoint:
+    """
+    Yielded by a crawler generator between its docs. BatchWriter flushes every doc
+    yielded before it and calls `commit()` only if no write of this run has failed,
+    so sync cursors / catalog versions / HTTP validators never get ahead of the
+    data actually stored. A crawler abandoned before reaching it commits nothing.
+    """
+    __slots__ = ("commit", "label")
+
+    def __init__(self, commit, label: str = ""):
+        self.commit = commit
+        self.label = label
+
+def _docs_only(items) -> list:
+    """crawl_* helpers: the yielded docs without Checkpoints (nothing is committed)."""
+    return [x for x in items if not isinstance(x, Checkpoint)]
+
+class BatchWriter:
+    """
+    Buffers docs from a crawler generator and flushes them through upsert_many
+    every `batch` docs or `interval` seconds (checked on add), plus once on close.
+    Checkpoints force a flush and are committed only while no flush has failed.
+    """
+    def __init__(self, name: str, batch: int = WRITE_BATCH, interval: float = WRITE_FLUSH_SECONDS):
+        self.name = name
+        self.batch = max(1, batch)
+        self.interval = interval
+        self.counts = {"inserted": 0, "updated": 0, "skipped": 0, "total": 0, "flushes": 0,
+                       "errors": 0, "checkpoints": 0, "checkpoints_skipped": 0}
+        self._buf: list[dict] = []
+        self._last_flush = time.monotonic()
+
+    def add(self, doc):
+        if isinstance(doc, Checkpoint):
+            self.checkpoint(doc)
+            return
+        self._buf.append(doc)
+        if len(self._buf) >= self.batch or time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._buf:
+            return
+        docs, self._buf = self._buf, []
+        self.counts["total"] += len(docs)
+        self.counts["flushes"] += 1
+        try:
+            ins, upd, skipped = upsert_many(docs, raise_errors=True)
+        except Exception:
+            self.counts["errors"] += 1
+            return
+        self.counts["inserted"] += ins
+        self.counts["updated"] += upd
+        self.counts["skipped"] += skipped
+
+    def checkpoint(self, cp: Checkpoint):
+        self.flush()
+        if self.counts["errors"]:
+            self.counts["checkpoints_skipped"] += 1
+            logging.warning("[%s] checkpoint %s not committed: %d failed write(s) in this run",
+                            self.name, cp.label, self.counts["errors"])
+            return
+        try:
+            cp.commit()
+            self.counts["checkpoints"] += 1
+        except Exception as e:
+            self.counts["checkpoints_skipped"] += 1
+            logging.warning("[%s] checkpoint %s commit failed: %s", self.name, cp.label, e)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        return False
+
+# ---------- 站点调度：各站点并发运行，边抓边写库 ----------
+def _crawl_and_save(name: str, func, kwargs: dict) -> dict:
+    t0 = time.monotonic()
+    with BatchWriter(name) as writer:
+        for doc in func(**kwargs):
+            writer.add(doc)
+    elapsed = time.monotonic() - t0
+    c = writer.counts
+    logging.info("[%s] saved: inserted=%d updated=%d skipped=%d flushes=%d errors=%d (%.1fs)",
+                 name, c["inserted"], c["updated"], c["skipped"], c["flushes"], c["errors"], elapsed)
+    return {"ok": not c["errors"], **c, "seconds": round(elapsed, 1)}
+
+# 上一轮超时被放弃、仍在运行的站点线程（长驻进程如 Celery worker 中跨轮次保留）
+_site_threads: dict[str, threading.Thread] = {}
+_site_threads_lock = threading.Lock()
+
+def run_sites(sites) -> dict:
+    """
+    Run every (name, iter_func, kwargs, timeout|None) crawler in its own thread,
+    streaming its docs into a BatchWriter while it runs. A failure or an exhausted
+    time budget only affects that site. Timed-out crawlers are abandoned (daemon
+    threads), not killed; whatever they already yielded has been written. A site
+    whose abandoned thread from an earlier run is still alive is skipped, so a
+    long-lived process never stacks up crawlers of one site.
+    """
+    reset_run_stats()
+    results: dict[str, dict] = {}
+
+    def _target(name, func, kwargs):
+        try:
+            results[name] = _crawl_and_save(name, func, kwargs)
+        except Exception as e:
+            logging.error("[%s] fatal: %s", name, e)
+            results[name] = {"ok": False, "error": str(e)}
+
+    started = time.monotonic()
+    threads, summary = [], {}
+    for name, func, kwargs, budget in sites:
+        with _site_threads_lock:
+            prev = _site_threads.get(name)
+            if prev is not None and prev.is_alive():
+                logging.warning("[%s] skipped: the crawler abandoned by an earlier run is still running", name)
+                summary[name] = {"ok": False, "error": "still running"}
+                continue
+            t = threading.Thread(target=_target, args=(name, func, kwargs), name=f"site-{name}", daemon=True)
+            _site_threads[name] = t
+        t.start()
+        threads.append((name, t, None if budget is None else started + budget))
+
+    for name, t, deadline in threads:
+        t.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        if t.is_alive():
+            logging.error("[%s] timeout: exceeded its time budget, abandoned", name)
+            summary[name] = {"ok": False, "error": "timeout"}
+        else:
+            summary[name] = results.get(name, {"ok": False, "error": "no result"})
+    logging.info("All sites done in %.1fs", time.monotonic() - started)
+    save_host_state()
+    evict_snapshots()
+    for src, st in sorted(http_cache_stats().items()):
+        logging.info("[http_cache] %s: hit(304)=%d miss=%d", src, st["hit"], st["miss"])
+    logging.info("[transport] %s", transport_stats())
+    return summary
+
+# ---------- Main entry（融合主流程） ----------
+def run_all() -> dict:
+    """One crawl of every site (no argparse / logging setup: safe to call from a worker)."""
+    sites = [
+        ("cisa_kev", iter_cisa_kev, {"limit": 2000}, SITE_TIMEOUT),
+        ("krebsonsecurity", iter_krebsonsecurity, {"limit": 40}, SITE_TIMEOUT),
+        ("msrc_blog", iter_msrc_blog, {"limit": 40}, SITE_TIMEOUT),
+        ("nvd", iter_nvd_recent, {"days": 7}, SITE_TIMEOUT),
+        ("exploitdb", iter_exploitdb, {"limit": 60}, SITE_TIMEOUT),
+        ("user_rss", iter_user_rss, {"limit_sources": 200, "max_items_per_feed": 40}, SITE_TIMEOUT * 2),
+    ]
+    logging.info("Sites to crawl: %s", [n for (n, _, _, _) in sites])
 
     # 注意：per-user 拉取函数 fetch_user_rss_once 保持独立，由业务调用时传入 owner_username / rss_url。
+    return run_sites(sites)
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    ap = argparse.ArgumentParser(description="CTI site crawlers")
+    ap.add_argument("--nvd-backfill", type=int, metavar="DAYS",
+                    help="one-off NVD backfill of the last DAYS days (lastModified), then exit")
+    ap.add_argument("--reextract", action="store_true",
+                    help="rebuild threats.content from stored HTML snapshots (no network), then exit")
+    ap.add_argument("--source", help="with --reextract: only this source (krebsonsecurity, msrc_blog, user)")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 2,
+                    help="with --reextract: parallel extraction processes")
+    ap.add_argument("--near-dup-backfill", type=int, metavar="DAYS",
+                    help="fingerprint/cluster stored articles of the last DAYS days, then exit")
+    ap.add_argument("--process-retries", action="store_true",
+                    help="fetch the deferred articles that are due (fetch_retries), then exit")
+    ap.add_argument("--migrate-canonical-urls", action="store_true",
+                    help="canonicalize stored article URLs, merge duplicates and create the URL indexes, then exit")
+    args = ap.parse_args(argv)
+
+    if args.process_retries:
+        return process_fetch_retries()
+    if args.migrate_canonical_urls:
+        return migrate_canonical_urls()
+    if args.near_dup_backfill:
+        return backfill_near_dups(days=args.near_dup_backfill)
+    if args.reextract:
+        return reextract_from_snapshots(source=args.source, workers=args.workers)
+    if args.nvd_backfill:
+        return run_sites([("nvd", iter_nvd_recent, {"backfill_days": args.nvd_backfill}, None)])
+    summary = run_all()
+    due_in = next_retry_due_in()
+    if due_in is not None:
+        # CLI 运行没有 Celery 调度：提示何时用 --process-retries 处理延后的文章
+        logging.info("deferred articles queued; next due in %.0fs (run with --process-retries)", due_in)
+    return summary
 
 if __name__ == "__main__":
     main()
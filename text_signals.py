@@ -0,0 +1,89 @@
+# text_signals.py
+# -*- coding: utf-8 -*-
+"""
+Precompiled text matchers shared by the crawler (task_fetch) and the web app (app.py).
+
+- Boilerplate / noise lines (nav, cookie banners, JS snippets, brand lines).
+- Threat signals ("exploit", "zero-day", ...) used for the pro-view key points.
+
+Each line / sentence is lower()-ed ONCE and checked against pre-lowered keyword
+tuples with C-level substring search; the regex checks only run when a cheap
+literal pre-filter says they can match. (A single combined `re.I` alternation was
+measured ~3x slower than this under CPython's `re`; see bench/bench_text_signals.py.)
+
+Semantics are unchanged: case-insensitive substring matching (e.g. "RCE" also
+hits "source"), exactly like the previous `k.lower() in s.lower()` checks.
+No third-party dependencies, so importing it from app.py is cheap.
+"""
+import re
+
+# 整行剔除的样板词（子串、大小写不敏感）
+BOILERPLATE_TERMS = (
+    "cookie", "privacy", "terms", "navigation", "skip to content",
+    "microsoft security response center", "msrc blog", "rss", "search",
+)
+
+# 专业视图里“威胁要点”的信号词（子串、大小写不敏感）
+THREAT_SIGNALS = (
+    "critical", "remote execution", "RCE", "exploit", "zero-day",
+    "in the wild", "privilege escalation", "bypass", "vulnerability", "attack",
+)
+
+MIN_LINE_LEN = 6
+
+class KeywordMatcher:
+    """Case-insensitive "contains any of" matcher over a fixed keyword set."""
+
+    __slots__ = ("terms",)
+
+    def __init__(self, terms):
+        # 去重、预先小写；短词在前（短词通常更常命中，能更早短路）
+        self.terms = tuple(sorted({t.lower() for t in terms if t}, key=len))
+
+    def search_lower(self, low: str) -> str | None:
+        """Like search(), for text that is already lower-cased."""
+        for k in self.terms:
+            if k in low:
+                return k
+        return None
+
+    def search(self, text: str) -> str | None:
+        """Return the first matching keyword (lower-cased), or None."""
+        return self.search_lower(text.lower()) if text else None
+
+BOILERPLATE = KeywordMatcher(BOILERPLATE_TERMS)
+SIGNALS = KeywordMatcher(THREAT_SIGNALS)
+
+_ONLY_PUNCT  = re.compile(r"^\W+$")
+_BRACE_NOISE = re.compile(r"[\{\}\(\)\[\]\|\/\\]{3,}")
+_JS_SNIPPET  = re.compile(r"(?:^|[\s;])!?\s*function\s*\(")   # 在小写文本上匹配
+_SENT_SPLIT  = re.compile(r"(?<=[。.!?])\s+")
+
+def is_human_line(t: str) -> bool:
+    """Heuristics to drop nav/cookie/boilerplate lines."""
+    if not t or len(t) < MIN_LINE_LEN:
+        return False
+    low = t.lower()
+    if BOILERPLATE.search_lower(low) is not None:
+        return False
+    if _ONLY_PUNCT.match(t) or _BRACE_NOISE.search(t):
+        return False
+    return not ("function" in low and _JS_SNIPPET.search(low))
+
+def has_threat_signal(s: str) -> bool:
+    """True if the sentence mentions any THREAT_SIGNALS keyword."""
+    return SIGNALS.search(s) is not None
+
+def threat_sentences(body: str, limit: int = 2) -> list[str]:
+    """
+    Split plain text into sentences and return the first `limit` that carry a
+    threat signal; falls back to the first `limit` sentences if none do.
+    """
+    sentences = _SENT_SPLIT.split(body or "")
+    picked = []
+    for s in sentences:
+        if SIGNALS.search(s) is not None:
+            picked.append(s)
+            if len(picked) >= limit:
+                break
+    return picked or sentences[:limit]
@@ -65,6 +65,7 @@ celery.conf.task_routes = {
     "worker.tasks.run_cybok_reco_gridfs": {"queue": "scheduled"},
     "worker.tasks.run_ingest_cybok_intro_pdf": {"queue": "scheduled"},
     "worker.tasks.run_fetch_and_reco": {"queue": "scheduled"},
+    "worker.tasks.run_fetch_retries": {"queue": "scheduled"},
 }
 
 
@@ -77,7 +78,7 @@ if os.getenv("DISABLE_BEAT", "0") != "1":
             "schedule": 600.0,
         },
 
-        # 每天 03:00：重建 CyBOK 推荐
+        # 每天 03:00：重建 CyBOK 推荐（增量；全量重算需手动 run_cybok_reco_gridfs(full=True) / --full）
         "run-reco-gridfs-3am": {
             "task": "worker.tasks.run_cybok_reco_gridfs",
             "schedule": crontab(minute=0, hour=3),
@@ -1,8 +1,8 @@
 # worker/tasks.py
-import os, sys, time, subprocess, shlex, logging
+import os, sys, time, subprocess, shlex, logging, threading
 from pathlib import Path
 from datetime import datetime, timezone
-from celery.signals import worker_ready
+from celery.signals import worker_ready, worker_process_init, celeryd_after_setup
 import redis
 from contextlib import contextmanager
 
@@ -16,7 +16,7 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# ---------- 子进程执行器 ----------
+# ---------- 子进程执行器（仅用于一次性的重任务，如 CyBOK PDF 入库） ----------
 def _run(pyfile: str, args: list[str] | None = None):
     cmd = [sys.executable, str(BASE / pyfile), *(args or [])]
     p = subprocess.run(cmd, capture_output=True, text=True)
@@ -27,6 +27,78 @@ def _run(pyfile: str, args: list[str] | None = None):
         "stdout": p.stdout.strip(),
     }
 
+# ---------- 进程内执行：抓取 / 推荐直接在常驻 worker 进程里跑 ----------
+# 每个 worker 进程只 import 一次 task_fetch / torch / sentence-transformers，
+# 模型与 CyBOK 索引由 task_cybok_reco_gridfs 的进程级 holder 常驻。
+# WARM_RECO_ON_START: auto（默认）= 仅当本 worker 消费推荐任务所在队列（-Q）时预热；1 = 总是；0 = 从不。
+# realtime/default 专用 worker 不会为 torch + 模型 + FAISS 付出启动时间和内存。
+WARM_RECO_ON_START = os.getenv("WARM_RECO_ON_START", "auto").strip().lower()
+_RECO_TASKS = ("worker.tasks.run_cybok_reco_gridfs", "worker.tasks.run_fetch_and_reco")
+_warm_reco_here = WARM_RECO_ON_START == "1"
+
+def _fetch_in_process():
+    t0 = time.monotonic()
+    try:
+        from task_fetch import run_all as _fetch_all
+    except ImportError:
+        from worker.task_fetch import run_all as _fetch_all
+    setup = time.monotonic() - t0
+    summary = _fetch_all()
+    logger.info("[fetch] setup=%.2fs total=%.2fs", setup, time.monotonic() - t0)
+    return {"setup_seconds": round(setup, 3), "seconds": round(time.monotonic() - t0, 3), "sites": summary}
+
+def _reco_in_process(full: bool = False):
+    t0 = time.monotonic()
+    try:
+        from task_cybok_reco_gridfs import run as _reco_run
+    except ImportError:
+        from worker.task_cybok_reco_gridfs import run as _reco_run
+    setup = time.monotonic() - t0
+    stats = _reco_run(full=full)
+    # run() 只计模型/索引的准备时间，这里再加上首次 import 的开销
+    stats["setup_seconds"] = round(stats.get("setup_seconds", 0) + setup, 3)
+    return stats
+
+def _warm_reco():
+    try:
+        try:
+            from task_cybok_reco_gridfs import warm
+        except ImportError:
+            from worker.task_cybok_reco_gridfs import warm
+        logger.info("reco model/index warmed in %.2fs (pid=%s)", warm(), os.getpid())
+    except Exception as e:
+        logger.warning("reco warm-up failed, will load on first run: %s", e)
+
+def _reco_queues() -> set[str]:
+    routes = celery.conf.task_routes or {}
+    return {(routes.get(t) or {}).get("queue") or celery.conf.task_default_queue for t in _RECO_TASKS}
+
+@celeryd_after_setup.connect
+def _decide_reco_warmup(sender, instance, **kwargs):
+    """
+    Runs in the main worker process after -Q is applied and before the pool forks,
+    so child processes inherit the decision made here.
+    """
+    global _warm_reco_here
+    if WARM_RECO_ON_START != "auto":
+        return
+    queues = instance.app.amqp.queues
+    consumed = set(queues.consume_from or queues)   # 未指定 -Q 时消费全部队列
+    _warm_reco_here = bool(consumed & _reco_queues())
+    logger.info("reco warm-up %s (worker queues: %s)",
+                "enabled" if _warm_reco_here else "skipped", ",".join(sorted(consumed)))
+
+@worker_process_init.connect
+def _warm_worker_process(**kwargs):
+    """
+    Warm each (forked) worker process once, if this worker serves the reco queue.
+    Runs in a background thread because worker_process_init must return within
+    worker_proc_alive_timeout; a task that arrives earlier simply waits on the
+    holder's lock.
+    """
+    if _warm_reco_here:
+        threading.Thread(target=_warm_reco, name="reco-warmup", daemon=True).start()
+
 # ---------- 占位任务 ----------
 @celery.task(name="worker.tasks.run_ingest_cybok_intro_pdf")
 def run_ingest_cybok_intro_pdf():
@@ -37,7 +109,9 @@ def run_ingest_cybok_intro_pdf():
 @celery.task(name="worker.tasks.run_fetch")
 def run_fetch():
     try:
-        return _run("task_fetch.py")
+        res = _fetch_in_process()
+        _schedule_fetch_retries()
+        return res
     except Exception as e:
         logger.exception("run_fetch failed: %s", e)
         return {"ok": False, "error": str(e)}
@@ -62,6 +136,7 @@ def run_fetch_user_rss_once(self, owner_username: str, rss_url: str, limit: int
             "owner_username": owner_username,
             "rss_url": rss_url,
             "new": int(result.get("new", 0)),
+            "updated": int(result.get("updated", 0)),
             "total": int(result.get("total", 0)),
             "status": result.get("status", "ok"),
             "finished_at": datetime.now(timezone.utc).isoformat(),
@@ -73,12 +148,12 @@ def run_fetch_user_rss_once(self, owner_username: str, rss_url: str, limit: int
 
 # ---------- 去重抓取所有 RSS ----------
 @celery.task(name="worker.tasks.run_fetch_all_rss_dedup")
-def run_fetch_all_rss_dedup(limit: int = 200, owner_filter=None, sample: int | None = None):
+def run_fetch_all_rss_dedup(limit: int = 200, owner_filter=None, sample: int | None = None, force: bool = False):
     try:
         from task_fetch import fetch_all_rss_dedup as _fetch_all
     except ImportError:
         from worker.task_fetch import fetch_all_rss_dedup as _fetch_all
-    return _fetch_all(limit=limit, owner_filter=owner_filter, sample=sample)
+    return _fetch_all(limit=limit, owner_filter=owner_filter, sample=sample, force=force)
 
 # ---------- 抓取+推荐 ----------
 @celery.task(bind=True, name="worker.tasks.run_fetch_and_reco")
@@ -87,10 +162,11 @@ def run_fetch_and_reco(self):
         logger.info("[Celery] run_fetch_and_reco: start")
         self.update_state(state="PROGRESS", meta={"step": "fetch"})
 
-        res1 = _run("task_fetch.py")
+        res1 = _fetch_in_process()
+        _schedule_fetch_retries()
 
         self.update_state(state="PROGRESS", meta={"step": "reco"})
-        res2 = _run("task_cybok_reco_gridfs.py")
+        res2 = _reco_in_process()
 
         logger.info("[Celery] run_fetch_and_reco: done")
         return {"fetch": res1, "reco": res2}
@@ -99,9 +175,36 @@ def run_fetch_and_reco(self):
         self.update_state(state="FAILURE", meta={"step": "error", "err": str(e)})
         raise
 
-# ---------- 仅推荐 ----------
+# ---------- 延后重试（抓取阶段不再 sleep 等待） ----------
+RETRY_MAX_COUNTDOWN = 600  # 与 beat 的 10 分钟周期对齐，更晚到期的项由下一轮处理
+
+def _schedule_fetch_retries():
+    """Schedule run_fetch_retries for when the earliest deferred article is due."""
+    try:
+        from task_fetch import next_retry_due_in
+    except ImportError:
+        from worker.task_fetch import next_retry_due_in
+    try:
+        due_in = next_retry_due_in()
+        if due_in is not None and due_in <= RETRY_MAX_COUNTDOWN:
+            run_fetch_retries.apply_async(countdown=int(due_in) + 1)
+            logger.info("run_fetch_retries scheduled in %ss", int(due_in) + 1)
+    except Exception as e:
+        logger.warning("could not schedule run_fetch_retries: %s", e)
+
+@celery.task(name="worker.tasks.run_fetch_retries")
+def run_fetch_retries(limit: int = 100):
+    try:
+        from task_fetch import process_fetch_retries as _process
+    except ImportError:
+        from worker.task_fetch import process_fetch_retries as _process
+    res = _process(limit=limit)
+    _schedule_fetch_retries()   # 重新排队 / 写入失败的条目
+    return res
+
+# ---------- 仅推荐（默认增量；full=True 忽略 cybok_stamp 全量重算） ----------
 @celery.task(name="worker.tasks.run_cybok_reco_gridfs")
-def run_cybok_reco_gridfs():
-    return _run("task_cybok_reco_gridfs.py")
+def run_cybok_reco_gridfs(full: bool = False):
+    return _reco_in_process(full=full)
 
 